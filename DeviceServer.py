@@ -8,29 +8,30 @@ Created on Sat May 26 09:54:02 2018
 from PyQt5 import Qt,QtCore,QtGui,QtWidgets
 import time
 from devices.demo.demo import WorkerForDummyDevice
-import zmq
+from devices.zeromq_device import Subscription, channels
 import devices
 import sys,traceback
 
 class ZMQ_Listener(QtCore.QObject):
-    """ A class to implement a thread listening for stdout/stderr 
-    from other thread via a ZeroMQ PUB/SUB socket pair """
+    """ A class forwarding stdout/stderr of a worker process, published
+    via a ZeroMQ PUB/SUB socket pair, as Qt signals. Messages are received
+    by the IOLoop thread shared with the devices. """
     msg_info = QtCore.pyqtSignal(str)
     msg_err = QtCore.pyqtSignal(str)
 
-    def __init__(self, socket):
+    def __init__(self, channel):
         QtCore.QObject.__init__(self)
-        self.socket = socket
-        self.continue_running = True
+        self.subscription = Subscription(channel, [b'std'], self.receive)
          
-    def loop(self):
-        while self.continue_running:
-            [address, contents] = self.socket.recv_multipart()
-            if address == b'stderr':
-                self.msg_err.emit(contents.decode('ascii'))
-            else:
-                self.msg_info.emit(contents.decode('ascii'))
-        print("stopped")
+    def receive(self, frames):
+        [address, contents] = [frame.bytes for frame in frames]
+        if address == b'stderr':
+            self.msg_err.emit(contents.decode('ascii'))
+        else:
+            self.msg_info.emit(contents.decode('ascii'))
+
+    def close(self):
+        self.subscription.close()
 
 
 
@@ -44,11 +45,6 @@ class WidgetForProcess(QtWidgets.QWidget):
         self.process_class = process_class
         self.kwargs = kwargs
         
-        zmq_context = zmq.Context()
-        self.sub_socket = zmq_context.socket(zmq.SUB)
-        self.sub_socket.connect("tcp://localhost:%s" % str(pub_port))
-        self.sub_socket.setsockopt(zmq.SUBSCRIBE, b'std')
-        
         self.process = None
 
         layout = QtWidgets.QVBoxLayout()
@@ -84,13 +80,10 @@ class WidgetForProcess(QtWidgets.QWidget):
             textedit.setTextColor(QtGui.QColor(0,0,64))
             textedit.append(text)
             
-        self.thread = QtCore.QThread(self)
-        self.listener = ZMQ_Listener(self.sub_socket)
-        self.listener.moveToThread(self.thread)
-        self.thread.started.connect(self.listener.loop)
+        _, pub_channel = channels(kwargs.get('transport', 'tcp'), 'localhost', req_port, pub_port)
+        self.listener = ZMQ_Listener(pub_channel)
         self.listener.msg_info.connect(appendInfo)
         self.listener.msg_err.connect(appendErr)
-        self.thread.start()
         layout.addWidget(textedit)
         
         self.timer = QtCore.QTimer(self)
@@ -98,7 +91,7 @@ class WidgetForProcess(QtWidgets.QWidget):
         self.timer.start(5000)
         
     def __del__(self):
-        self.listener.continue_running = False
+        self.listener.close()
         if self.process:
             self.process.terminate()
             self.process.join()
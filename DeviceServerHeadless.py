@@ -10,31 +10,32 @@ of Ultrafast MagnetoSpectroscopy at Faculty of Physics, University of Warsaw
 
 from PyQt5 import Qt,QtCore
 import time
-import zmq
+from devices.zeromq_device import Subscription, channels
 import devices
 import socket
 import sys,traceback
 
 
 class ZMQ_Listener(QtCore.QObject):
-    """ A class to implement a thread listening for stdout/stderr 
-    from other thread via a ZeroMQ PUB/SUB socket pair """
+    """ A class forwarding stdout/stderr of a worker process, published
+    via a ZeroMQ PUB/SUB socket pair, as Qt signals. Messages are received
+    by the IOLoop thread shared with the devices. """
     msg_info = QtCore.pyqtSignal(str)
     msg_err = QtCore.pyqtSignal(str)
 
-    def __init__(self, socket):
+    def __init__(self, channel):
         QtCore.QObject.__init__(self)
-        self.socket = socket
-        self.continue_running = True
+        self.subscription = Subscription(channel, [b'std'], self.receive)
          
-    def loop(self):
-        while self.continue_running:
-            [address, contents] = self.socket.recv_multipart()
-            if address == b'stderr':
-                self.msg_err.emit(contents.decode('ascii'))
-            else:
-                self.msg_info.emit(contents.decode('ascii'))
-        print("stopped")
+    def receive(self, frames):
+        [address, contents] = [frame.bytes for frame in frames]
+        if address == b'stderr':
+            self.msg_err.emit(contents.decode('ascii'))
+        else:
+            self.msg_info.emit(contents.decode('ascii'))
+
+    def close(self):
+        self.subscription.close()
 
 
 class Process(QtCore.QObject):
@@ -46,11 +47,6 @@ class Process(QtCore.QObject):
         self.process_class = process_class
         self.kwargs = kwargs
         
-        zmq_context = zmq.Context()
-        self.sub_socket = zmq_context.socket(zmq.SUB)
-        self.sub_socket.connect("tcp://localhost:%s" % str(pub_port))
-        self.sub_socket.setsockopt(zmq.SUBSCRIBE, b'std')
-        
         self.process = None
         
         def appendErr(text):
@@ -59,20 +55,17 @@ class Process(QtCore.QObject):
         def appendInfo(text):
             print(text)
             
-        self.thread = QtCore.QThread(self)
-        self.listener = ZMQ_Listener(self.sub_socket)
-        self.listener.moveToThread(self.thread)
-        self.thread.started.connect(self.listener.loop)
+        _, pub_channel = channels(kwargs.get('transport', 'tcp'), 'localhost', req_port, pub_port)
+        self.listener = ZMQ_Listener(pub_channel)
         self.listener.msg_info.connect(appendInfo)
         self.listener.msg_err.connect(appendErr)
-        self.thread.start()
 
         self.timer = QtCore.QTimer(self)
         self.timer.timeout.connect(self.checkOnProcess)
         self.timer.start(200)
 
     def __del__(self):
-        self.listener.continue_running = False
+        self.listener.close()
         if self.process:
             self.process.terminate()
             self.process.join()
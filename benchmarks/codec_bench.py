@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of the message codecs in devices.serialization.
+
+Compares encode/decode time and message size for a payload shaped like
+RoverWorker.status(), optionally with a numpy array attached.
+
+Usage (from the repository root):
+    python -m benchmarks.codec_bench [-n 20000] [--array 480x640]
+"""
+
+import argparse
+import timeit
+
+import numpy as np
+
+from devices.serialization import available_codecs, encode_message, decode_message
+
+
+def rover_status():
+    """ A status dictionary with the same keys and types as RoverWorker.status() """
+    return {
+        "connected": True,
+        "position": (12.345678, -3.210987),
+        "coordinates": (51.470876, -112.752628),
+        "heading": 4.712389,
+        "terrain_direction": 1.570796,
+        "terrain_slope": 0.087266,
+        "voltage": 24.61,
+        "encoders": {188: 153.8, 190: 117.7, 195: 152.0, 196: 300.0},
+        "index_pulses": {188: 500.0, 190: 500.0, 195: 500.0, 196: 500.0},
+        "wheels": [123456, -123450, 123470, -123460],
+        "air_temperature": 0,
+        "air_humidity": 0,
+        "air_co2": 412.5,
+        "soil_temperature": 0,
+        "soil_humidity": 37.2,
+        "battery": 87,
+        "autonomy": {
+            "state": ("State.DRIVE_TO", "((51.4709, -112.7526),)"),
+            "tasks": ["(<Task.DRIVE_TO: 1>, ((51.4709, -112.7526),))"] * 5,
+            "next_task": 2,
+        },
+        "cmd_stream_quality": 0.98,
+    }
+
+
+def bench_codec(codec, payload, number, binary_arrays=True):
+    frames = encode_message(payload, binary_arrays, codec)
+    size = sum(len(f) if isinstance(f, bytes) else f.nbytes for f in frames)
+    encode = timeit.timeit(lambda: encode_message(payload, binary_arrays, codec), number=number)
+    decode = timeit.timeit(lambda: decode_message(frames), number=number)
+    return {
+        "codec": codec if binary_arrays else codec + " (base64)",
+        "bytes": size,
+        "encode_us": encode / number * 1e6,
+        "decode_us": decode / number * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("-n", "--number", type=int, default=20000, help="iterations per measurement")
+    parser.add_argument("--array", default=None, help="also attach a uint8 array of given shape, e.g. 480x640")
+    args = parser.parse_args()
+
+    payload = rover_status()
+    if args.array:
+        shape = tuple(int(v) for v in args.array.split("x"))
+        payload["image"] = np.zeros(shape, dtype=np.uint8)
+
+    results = [bench_codec("json", payload, args.number, binary_arrays=False)]
+    results += [bench_codec(codec, payload, args.number) for codec in available_codecs()]
+
+    print("{:<16} {:>10} {:>12} {:>12}".format("codec", "bytes", "encode [us]", "decode [us]"))
+    for r in results:
+        print("{codec:<16} {bytes:>10} {encode_us:>12.2f} {decode_us:>12.2f}".format(**r))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of the PID controllers in devices.pid.
+
+Compares the time of a step of PID with the previous deque-based
+implementation (LegacyPID below), and of stepping the four wheel
+controllers of RoverWorker one by one with a single MultiPID step.
+All controllers are fed the same errors and their outputs are checked
+to agree.
+
+Usage (from the repository root):
+    python -m benchmarks.pid_bench [-n 100000]
+"""
+
+import argparse
+import itertools
+import timeit
+from collections import deque
+
+import numpy as np
+
+from devices.pid import PID, MultiPID
+
+
+class LegacyPID():
+    """ devices.pid.PID before the ring buffer """
+
+    def __init__(self, params=[0.004, 10, 0]):
+        self.set_params(params)
+        self.integral = 0
+        self.lastvals = deque([0 for i in range(1001)])
+
+    def set_params(self, params):
+        self.Ap = params[0]
+        self.Fi = params[1]
+        self.Td = params[2]
+
+    def step(self, dt, error):
+        deriv = (error - self.lastvals[9]) / (10 * dt)
+        self.integral = sum(list(itertools.islice(self.lastvals, 0, 100 + 1))) / (100 + 1) * dt
+        self.lastvals.rotate(1)
+        self.lastvals[0] = error
+        power = self.Ap * (error + deriv * self.Td + self.integral * self.Fi)
+
+        if power > 0.35:
+            power = 0.35
+        if power < -0.35:
+            power = -0.35
+        return power
+
+
+def check(number, params):
+    """ Largest difference between the outputs of the implementations """
+    errors = np.random.default_rng(0).normal(0, 50, size=(number, 4))
+    legacy = [LegacyPID(params) for _ in range(4)]
+    single = [PID(params) for _ in range(4)]
+    multi = MultiPID(4, params)
+    worst = 0.0
+    for row in errors:
+        expected = [c.step(0.01, e) for c, e in zip(legacy, row)]
+        worst = max(worst,
+                    max(abs(a - c.step(0.01, e)) for a, c, e in zip(expected, single, row)),
+                    float(np.max(np.abs(np.array(expected) - multi.step(0.01, row)))))
+    return worst
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("-n", "--number", type=int, default=100000, help="steps per measurement")
+    args = parser.parse_args()
+    params = [0.004, 10, 0.05]
+
+    print("max. output difference: {:.3g}".format(check(min(args.number, 20000), params)))
+
+    errors = [10.0, -3.0, 7.5, 0.25]
+    legacy = [LegacyPID(params) for _ in range(4)]
+    single = [PID(params) for _ in range(4)]
+    multi = MultiPID(4, params)
+    cases = [
+        ("LegacyPID x1", lambda: legacy[0].step(0.01, 10.0)),
+        ("PID x1", lambda: single[0].step(0.01, 10.0)),
+        ("LegacyPID x4", lambda: [c.step(0.01, e) for c, e in zip(legacy, errors)]),
+        ("PID x4", lambda: [c.step(0.01, e) for c, e in zip(single, errors)]),
+        ("MultiPID(4)", lambda: multi.step(0.01, errors)),
+    ]
+    print("{:<14} {:>12}".format("controller", "step [us]"))
+    for name, step in cases:
+        t = min(timeit.repeat(step, number=args.number, repeat=3))
+        print("{:<14} {:>12.2f}".format(name, t / args.number * 1e6))
+
+
+if __name__ == '__main__':
+    main()
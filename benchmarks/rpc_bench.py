@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""
+Latency and throughput benchmark of the @remote machinery in devices.zeromq_device.
+
+A WorkerForDummyDevice extended with an echo() method is started over each
+transport and measured for:
+    - latency of sequential calls (p50, p99) and calls per second,
+    - calls per second with requests pipelined through call_async(),
+    - rate of status messages received by 1..N subscribers (PUB fan-out).
+
+Transports: tcp, ipc (worker in a separate process), inproc (worker in a
+thread, messages still serialized) and direct (worker in a thread, called
+without serialization, see DeviceWorker.start_in_thread).
+
+Usage (from the repository root):
+    python -m benchmarks.rpc_bench [-n 2000] [--arrays 64x64,480x640]
+        [--transports tcp,ipc,inproc,direct] [--output results.json]
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+
+import numpy as np
+import zmq
+
+from devices.demo.demo import WorkerForDummyDevice, FrontEndForDummyDevice
+from devices.zeromq_device import remote, include_remote_methods, context, decode_message
+from benchmarks.codec_bench import rover_status
+
+
+class BenchWorker(WorkerForDummyDevice):
+    """ Publishes a fixed payload as its status, as often as it can """
+
+    def __init__(self, *args, payload=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.payload = payload if payload is not None else {}
+
+    def init_device(self):
+        pass
+
+    def status(self):
+        return self.payload
+
+    @remote
+    def echo(self, x):
+        return x
+
+
+@include_remote_methods(BenchWorker)
+class BenchFrontEnd(FrontEndForDummyDevice):
+    pass
+
+
+def payloads(arrays):
+    """ Payloads by name: a tiny dictionary, a rover status and rover
+    statuses with an uint8 array of each of the given shapes """
+    result = {"small": {"v": 1}, "rover": rover_status()}
+    for shape in arrays:
+        payload = rover_status()
+        payload["image"] = np.zeros(shape, dtype=np.uint8)
+        result["rover+" + "x".join(str(v) for v in shape)] = payload
+    return result
+
+
+def start(transport, port, payload, refresh_rate):
+    """ Returns (worker, front-end) once the worker answers """
+    kwargs = dict(req_port=port, pub_port=port + 1, refresh_rate=refresh_rate,
+                  status_keepalive=0, payload=payload)
+    if transport == 'direct':
+        worker = BenchWorker(**kwargs)
+        worker.start_in_thread()
+        frontend = BenchFrontEnd(req_port=port, pub_port=port + 1, worker=worker)
+    elif transport == 'inproc':
+        worker = BenchWorker(transport=transport, **kwargs)
+        worker.start_in_thread()
+        frontend = BenchFrontEnd(req_port=port, pub_port=port + 1, transport=transport)
+    else:
+        worker = BenchWorker(transport=transport, **kwargs)
+        worker.daemon = True
+        worker.start()
+        frontend = BenchFrontEnd(req_port=port, pub_port=port + 1, transport=transport)
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            frontend.echo(None)
+            return worker, frontend
+        except ConnectionError:
+            if time.monotonic() > deadline:
+                raise
+
+
+def stop(worker, frontend):
+    frontend.call_async('quit')
+    if worker.in_thread:
+        worker._thread.join(5)
+    else:
+        worker.join(5)
+
+
+def bench_calls(frontend, payload, number):
+    latencies = np.empty(number)
+    for i in range(number):
+        t = time.perf_counter()
+        frontend.echo(payload)
+        latencies[i] = time.perf_counter() - t
+    t = time.perf_counter()
+    futures = [frontend.call_async('echo', (payload,), timeout=60000) for _ in range(number)]
+    for future in futures:
+        future.result()
+    pipelined = time.perf_counter() - t
+    return {
+        "p50_us": float(np.percentile(latencies, 50) * 1e6),
+        "p99_us": float(np.percentile(latencies, 99) * 1e6),
+        "calls_per_s": float(number / latencies.sum()),
+        "pipelined_calls_per_s": float(number / pipelined),
+    }
+
+
+def bench_publish(worker, frontend, subscribers, duration):
+    """ Status messages per second received by each of the subscribers """
+    counts = [0] * subscribers
+    if frontend.worker is not None:
+        def counter(i):
+            def count(obj):
+                counts[i] += 1
+            return count
+        for i in range(subscribers):
+            worker.add_local_subscriber(b'status', counter(i))
+        time.sleep(duration)
+        return [c / duration for c in counts]
+
+    sockets = []
+    poller = zmq.Poller()
+    for _ in range(subscribers):
+        socket = context.socket(zmq.SUB)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(frontend.pub_channel)
+        socket.setsockopt(zmq.SUBSCRIBE, b'status')
+        poller.register(socket, zmq.POLLIN)
+        sockets.append(socket)
+    time.sleep(0.3) # let subscriptions propagate
+    for socket in sockets:
+        while socket.poll(0):
+            socket.recv_multipart()
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        for socket, _ in poller.poll(100):
+            decode_message(socket.recv_multipart(copy=False)[1:])
+            counts[sockets.index(socket)] += 1
+    for socket in sockets:
+        socket.close()
+    return [c / duration for c in counts]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("-n", "--number", type=int, default=2000, help="calls per measurement")
+    parser.add_argument("--arrays", default="64x64,480x640", help="array shapes attached to payloads, comma separated")
+    parser.add_argument("--transports", default="tcp,ipc,inproc,direct", help="comma separated")
+    parser.add_argument("--fanout", default="1,4", help="numbers of status subscribers, comma separated")
+    parser.add_argument("--duration", type=float, default=1.0, help="seconds per publish rate measurement")
+    parser.add_argument("--refresh-rate", type=float, default=0.0005, help="status period of the worker [s]")
+    parser.add_argument("--port", type=int, default=15900, help="first port used")
+    parser.add_argument("--output", default=None, help="write results to this JSON file")
+    args = parser.parse_args()
+
+    arrays = [tuple(int(v) for v in a.split("x")) for a in args.arrays.split(",") if a]
+    fanout = [int(v) for v in args.fanout.split(",")]
+    port = args.port
+    results = []
+
+    print("{:<8} {:<16} {:>10} {:>10} {:>10} {:>12} {:>16}".format(
+        "transport", "payload", "p50 [us]", "p99 [us]", "calls/s", "pipelined/s",
+        "status/s per sub"))
+    for transport in args.transports.split(","):
+        for name, payload in payloads(arrays).items():
+            worker, frontend = start(transport, port, payload, args.refresh_rate)
+            port += 2
+            try:
+                result = {"transport": transport, "payload": name}
+                result.update(bench_calls(frontend, payload, args.number))
+                result["status_per_s"] = {
+                    str(n): float(np.mean(bench_publish(worker, frontend, n, args.duration)))
+                    for n in fanout}
+            finally:
+                stop(worker, frontend)
+            results.append(result)
+            print("{transport:<8} {payload:<16} {p50_us:>10.1f} {p99_us:>10.1f} {calls_per_s:>10.0f} "
+                  "{pipelined_calls_per_s:>12.0f}".format(**result), " ".join(
+                  "{}:{:.0f}".format(n, r) for n, r in result["status_per_s"].items()))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": sys.version.split()[0],
+                "pyzmq": zmq.__version__,
+                "platform": platform.platform(),
+                "number": args.number,
+                "refresh_rate": args.refresh_rate,
+                "results": results,
+            }, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Table-driven decoding of CAN frames into a preallocated telemetry record.
+
+Modules on the bus prefix their data with an opcode which selects the
+layout of the remaining bytes. Decoders are registered for a pair
+(arbitration id, opcode), where either may be None to match any value, and
+are looked up with at most three dictionary probes per frame:
+(id, opcode), then (None, opcode), then (id, None).
+"""
+
+import struct
+import time
+from array import array
+
+
+class Telemetry:
+    """ Latest decoded values, stored in a single preallocated array of
+    doubles. A field is one value or a fixed number of consecutive values;
+    index[name] is its position in `values`, or a slice for several.
+
+    The array is written by a single thread under a seqlock: values[0] is a
+    sequence number, odd while an update is in progress. Readers take a
+    snapshot(), i.e. a copy of the whole array, which is atomic as it is
+    made while holding the GIL, and retry if it caught an update halfway.
+    The writer never waits for readers. """
+
+    def __init__(self, fields):
+        """ fields is a sequence of (name, count, initial value) """
+        self.index = {}
+        initial = [0] # sequence number
+        for name, count, value in fields:
+            if count == 1:
+                self.index[name] = len(initial)
+            else:
+                self.index[name] = slice(len(initial), len(initial) + count)
+            initial += [value] * count
+        self.values = array('d', initial)
+
+    def __getitem__(self, name):
+        """ Current value, for the writing thread """
+        return self.values[self.index[name]]
+
+    def position(self, name, i=0):
+        """ Index in `values` of the i-th value of a field """
+        index = self.index[name]
+        return index + i if isinstance(index, int) else index.start + i
+
+    def begin_update(self):
+        self.values[0] += 1
+
+    def end_update(self):
+        self.values[0] += 1
+
+    def snapshot(self):
+        """ Consistent copy of all fields """
+        while True:
+            values = self.values[:]
+            if not values[0] % 2:
+                return Snapshot(values, self.index)
+            time.sleep(0) # let the writer finish the update
+
+
+class Snapshot:
+    __slots__ = ('values', 'index')
+
+    def __init__(self, values, index):
+        self.values = values
+        self.index = index
+
+    def __getitem__(self, name):
+        return self.values[self.index[name]]
+
+    @property
+    def sequence(self):
+        """ Grows with every update of the record """
+        return int(self.values[0]) // 2
+
+
+class CanDecoder:
+    def __init__(self):
+        self.handlers = {}
+
+    def register(self, arbitration_id, opcode, handler, keep=False):
+        """ Call handler(arbitration_id, data) for matching frames. With keep,
+        decode() still reports the frame as one to be kept. A handler which
+        returns False marks the frame as not decoded. """
+        self.handlers[(arbitration_id, opcode)] = (handler, keep)
+
+    def add(self, arbitration_id, opcode, layout, targets, values, offset=1, keep=False):
+        """ Declare a layout without writing a handler: the fields unpacked
+        with `layout` (a struct format) from `offset` are stored in the
+        array `values` as value * scale + shift. `targets` holds an
+        (index, scale, shift) tuple per field, or None to skip it. """
+        unpack_from = struct.Struct(layout).unpack_from
+        targets = [(n, t) for n, t in enumerate(targets) if t is not None]
+
+        def handler(arbitration_id, data):
+            fields = unpack_from(data, offset)
+            for n, (index, scale, shift) in targets:
+                values[index] = fields[n] * scale + shift
+
+        self.register(arbitration_id, opcode, handler, keep)
+
+    def decode(self, arbitration_id, data):
+        """ Decode one frame. Returns False if the frame was consumed, True
+        if it should be kept, i.e. it has no decoder, the decoder asked to
+        keep it or failed. """
+        opcode = data[0] if data else None
+        handlers = self.handlers
+        entry = handlers.get((arbitration_id, opcode)) \
+            or handlers.get((None, opcode)) \
+            or handlers.get((arbitration_id, None))
+        if entry is None:
+            return True
+        handler, keep = entry
+        try:
+            if handler(arbitration_id, data) is False:
+                return True
+        except struct.error:
+            return True # frame too short for its layout
+        return keep
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""
+Recording of CAN traffic to a compact binary log and its replay.
+
+A log starts with an 8 byte magic followed by fixed-size records:
+    timestamp (double, seconds since the epoch), arbitration id (uint32),
+    flags (uint8, see FLAG_*), dlc (uint8), data (8 bytes, zero padded)
+all little-endian. Records are only ever appended, so a log cut short by a
+crash loses at most its last, partial record. Fixed-size records make
+record n addressable at len(MAGIC) + n * RECORD.size; the index file
+(log path + ".idx") maps times to record numbers with one (timestamp,
+record number) entry per index_interval of traffic, so a replay can start
+at any time without scanning the log.
+
+RecordingBus wraps a bus to log everything sent and received through it,
+ReplayBus is a bus fed from a log, e.g. for running RoverWorker offline.
+"""
+
+import bisect
+import os
+import struct
+import threading
+import time
+
+try:
+    import can
+    _BusABC = can.BusABC
+except ImportError:
+    can = None
+    _BusABC = object
+
+
+MAGIC = b'PTCANLG1'
+RECORD = struct.Struct('<dIBB8s')
+INDEX = struct.Struct('<dQ')
+
+FLAG_SENT = 1
+FLAG_EXTENDED = 2
+
+
+class CanLogWriter:
+    """ Appends frames to a log. Safe to use from several threads. """
+
+    def __init__(self, path, index_interval=1.0, flush_interval=1.0):
+        self.path = path
+        self.index_interval = index_interval
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._file = open(path, 'ab')
+        size = self._file.tell()
+        if size == 0:
+            self._file.write(MAGIC)
+            self.count = 0
+        else:
+            with open(path, 'rb') as f:
+                if f.read(len(MAGIC)) != MAGIC:
+                    self._file.close()
+                    raise ValueError("{} is not a CAN log".format(path))
+            self.count = (size - len(MAGIC)) // RECORD.size
+            # Drop a partial record left by an interrupted write
+            self._file.truncate(len(MAGIC) + self.count * RECORD.size)
+            self._file.seek(0, os.SEEK_END)
+        self._index = open(path + '.idx', 'ab')
+        self._next_index = None
+        self._next_flush = time.monotonic() + flush_interval
+
+    def write(self, message, sent=False):
+        timestamp = message.timestamp or time.time()
+        flags = (FLAG_SENT if sent else 0) | (FLAG_EXTENDED if message.is_extended_id else 0)
+        data = bytes(message.data)
+        record = RECORD.pack(timestamp, message.arbitration_id, flags, len(data), data)
+        with self._lock:
+            if self._file.closed:
+                return
+            if self._next_index is None or timestamp >= self._next_index:
+                self._index.write(INDEX.pack(timestamp, self.count))
+                self._next_index = timestamp + self.index_interval
+            self._file.write(record)
+            self.count += 1
+            now = time.monotonic()
+            if now >= self._next_flush:
+                self._file.flush()
+                self._index.flush()
+                self._next_flush = now + self.flush_interval
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+            self._index.close()
+
+
+class CanLogReader:
+    """ Iterates over the records of a log as (timestamp, arbitration id,
+    flags, data) tuples """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError("{} is not a CAN log".format(path))
+        self.count = (os.path.getsize(path) - len(MAGIC)) // RECORD.size
+        self.index_times = []
+        self.index_records = []
+        try:
+            with open(path + '.idx', 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b''
+        for timestamp, record in INDEX.iter_unpack(data[:len(data) - len(data) % INDEX.size]):
+            if record < self.count:
+                self.index_times.append(timestamp)
+                self.index_records.append(record)
+
+    def record_at(self, timestamp):
+        """ Number of a record at most index_interval before the first one
+        at or after timestamp """
+        i = bisect.bisect_right(self.index_times, timestamp) - 1
+        return self.index_records[i] if i >= 0 else 0
+
+    def records(self, start=0, stop=None, chunk=4096):
+        """ Records from number start up to stop (exclusive) """
+        stop = self.count if stop is None else min(stop, self.count)
+        with open(self.path, 'rb') as f:
+            f.seek(len(MAGIC) + start * RECORD.size)
+            n = start
+            while n < stop:
+                block = f.read(min(chunk, stop - n) * RECORD.size)
+                if len(block) < RECORD.size:
+                    return
+                block = block[:len(block) - len(block) % RECORD.size]
+                for timestamp, arbitration_id, flags, dlc, data in RECORD.iter_unpack(block):
+                    yield timestamp, arbitration_id, flags, data[:dlc]
+                n += len(block) // RECORD.size
+
+    def __iter__(self):
+        return self.records()
+
+    def between(self, start=None, end=None):
+        """ Records with start <= timestamp < end """
+        first = 0 if start is None else self.record_at(start)
+        for record in self.records(first):
+            if start is not None and record[0] < start:
+                continue
+            if end is not None and record[0] >= end:
+                return
+            yield record
+
+
+class RecordingBus:
+    """ Forwards to `bus`, logging every frame sent or received """
+
+    def __init__(self, bus, path, **kwargs):
+        self.bus = bus
+        self.log = CanLogWriter(path, **kwargs)
+
+    def send(self, message, timeout=None):
+        self.bus.send(message, timeout)
+        self.log.write(message, sent=True)
+
+    def recv(self, timeout=None):
+        message = self.bus.recv(timeout)
+        if message is not None:
+            self.log.write(message)
+        return message
+
+    def __iter__(self):
+        while True:
+            message = self.recv(1.0)
+            if message is not None:
+                yield message
+
+    def shutdown(self):
+        self.bus.shutdown()
+        self.log.close()
+
+
+class ReplayBus(_BusABC):
+    """ A bus receiving the frames received in a log, at the pace they were
+    recorded divided by `speed` (None or 0 for as fast as they are read).
+    Frames sent through the bus are counted and dropped, as are frames
+    which were sent when the log was recorded.
+
+    `finished` is set once the log has been replayed, unless `loop`. """
+
+    def __init__(self, channel, speed=1.0, start=None, end=None, loop=False, **kwargs):
+        super().__init__(channel=channel, **kwargs)
+        self.channel_info = "replay of {}".format(channel)
+        self.reader = CanLogReader(channel)
+        self.speed = speed
+        self.start = start
+        self.end = end
+        self.loop = loop
+        self.sent = 0
+        self.finished = threading.Event()
+        self._records = None
+        self._pending = None
+        self._origin = None
+
+    def _next_record(self):
+        while True:
+            restarted = self._records is None
+            if restarted:
+                self._records = self.reader.between(self.start, self.end)
+                self._origin = None
+            for record in self._records:
+                if not record[2] & FLAG_SENT:
+                    return record
+            if not self.loop or restarted: # nothing to replay at all
+                return None
+            self._records = None
+
+    def _recv_internal(self, timeout):
+        if self._pending is None:
+            self._pending = self._next_record()
+            if self._pending is None:
+                self.finished.set()
+                if timeout:
+                    time.sleep(timeout)
+                return None, False
+        timestamp, arbitration_id, flags, data = self._pending
+        if self.speed:
+            now = time.monotonic()
+            if self._origin is None:
+                self._origin = (now, timestamp)
+            due = self._origin[0] + (timestamp - self._origin[1]) / self.speed
+            if due > now:
+                if timeout is not None and due - now > timeout:
+                    time.sleep(timeout)
+                    return None, False
+                time.sleep(due - now)
+        self._pending = None
+        message = can.Message(timestamp=timestamp, arbitration_id=arbitration_id,
+                              is_extended_id=bool(flags & FLAG_EXTENDED), data=data)
+        return message, False
+
+    def send(self, msg, timeout=None):
+        self.sent += 1
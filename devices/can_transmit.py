@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Single-threaded CAN transmission with priorities, coalescing of setpoints
+and rate limiting.
+"""
+
+import heapq
+import itertools
+import threading
+from time import perf_counter as clock
+
+
+HIGH = 0
+NORMAL = 1
+
+
+class _Entry:
+    __slots__ = ('priority', 'seq', 'message', 'queued')
+
+    def __init__(self, priority, seq, message, queued):
+        self.priority = priority
+        self.seq = seq
+        self.message = message
+        self.queued = queued
+
+
+class CanTransmitter:
+    """ Sends the frames given to send() from a thread of its own.
+
+    A frame replaces the pending frame with the same key, so a burst of
+    setpoints for one actuator results in a single frame carrying the
+    newest one. Frames leave in order of priority, then of queueing.
+    NORMAL frames to one node are spaced by at least node_interval and all
+    NORMAL frames by 1 / max_rate; HIGH frames (e.g. stops) are never
+    delayed by either limit. """
+
+    def __init__(self, bus, node_interval=0.0, max_rate=None, name="can-tx"):
+        self.bus = bus
+        self.node_interval = node_interval
+        self.frame_interval = 1.0 / max_rate if max_rate else 0.0
+        self.running = True
+        self._condition = threading.Condition()
+        self._heap = []
+        self._pending = {}
+        self._seq = itertools.count()
+        self._node_free = {} # arbitration id -> time of the next NORMAL frame
+        self._bus_free = 0.0
+        self._reset_stats()
+        self._thread = threading.Thread(target=self._loop, name=name, daemon=True)
+        self._thread.start()
+
+    def send(self, message, key=None, priority=NORMAL):
+        """ Queue a can.Message. With key None the frame is never coalesced. """
+        now = clock()
+        with self._condition:
+            seq = next(self._seq)
+            if key is None:
+                key = ('unique', seq)
+            entry = self._pending.get(key)
+            if entry is not None:
+                # Keep the place in the queue, send the newest data
+                entry.message = message
+                self._coalesced += 1
+                if priority < entry.priority:
+                    entry.priority = priority
+                    entry.seq = seq
+                    heapq.heappush(self._heap, (priority, seq, key))
+            else:
+                self._pending[key] = _Entry(priority, seq, message, now)
+                heapq.heappush(self._heap, (priority, seq, key))
+                self._max_depth = max(self._max_depth, len(self._pending))
+            self._condition.notify()
+
+    def stop(self):
+        with self._condition:
+            self.running = False
+            self._condition.notify()
+
+    def stats(self):
+        """ Queue depth and send latency (from queueing to handing the frame
+        to the bus) since the previous call """
+        with self._condition:
+            stats = {
+                "depth": len(self._pending),
+                "max_depth": self._max_depth,
+                "sent": self._sent,
+                "coalesced": self._coalesced,
+                "errors": self._errors,
+                "latency_avg_ms": self._latency_sum / self._sent * 1000 if self._sent else 0.0,
+                "latency_max_ms": self._latency_max * 1000,
+            }
+            self._reset_stats()
+            return stats
+
+    def _reset_stats(self):
+        self._max_depth = len(self._pending)
+        self._sent = 0
+        self._coalesced = 0
+        self._errors = 0
+        self._latency_sum = 0.0
+        self._latency_max = 0.0
+
+    def _next_entry(self, now):
+        """ Remove and return the first frame allowed to go now, or None and
+        the time to wait for one """
+        deferred = []
+        found = None
+        wait = None
+        while self._heap:
+            item = heapq.heappop(self._heap)
+            priority, seq, key = item
+            entry = self._pending.get(key)
+            if entry is None or entry.seq != seq:
+                continue # superseded
+            if priority != HIGH:
+                node = entry.message.arbitration_id
+                free = max(self._node_free.get(node, 0.0), self._bus_free)
+                if free > now:
+                    deferred.append(item)
+                    wait = free - now if wait is None else min(wait, free - now)
+                    continue
+                self._node_free[node] = now + self.node_interval
+                self._bus_free = now + self.frame_interval
+            del self._pending[key]
+            found = entry
+            break
+        for item in deferred:
+            heapq.heappush(self._heap, item)
+        return found, wait
+
+    def _loop(self):
+        while True:
+            with self._condition:
+                entry = None
+                while entry is None:
+                    if not self.running:
+                        return
+                    entry, wait = self._next_entry(clock())
+                    if entry is None:
+                        self._condition.wait(wait)
+            try:
+                self.bus.send(entry.message)
+            except Exception as e:
+                print("CAN send failed: {}".format(e))
+                with self._condition:
+                    self._errors += 1
+                continue
+            latency = clock() - entry.queued
+            with self._condition:
+                self._sent += 1
+                self._latency_sum += latency
+                self._latency_max = max(self._latency_max, latency)
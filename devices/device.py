@@ -7,6 +7,7 @@ of Ultrafast MagnetoSpectroscopy at Faculty of Physics, University of Warsaw
 from enum import Enum
 from numpy import nan
 import yaml
+import zmq
 
 from src.common.settings import Settings
 
@@ -62,6 +63,63 @@ import sys,traceback
 """ Enabled devices """
 dev_launch_settings = Settings('devices')
 
+""" Keys of a device entry passed to both the worker and the front-end """
+transport_options = ('binary_arrays', 'codec', 'transport')
+
+""" Workers of devices on these hosts run in the process of the front-end,
+unless their entry says in_process: false """
+local_hosts = ('localhost', '127.0.0.1')
+
+
+def _in_process(dev_conf):
+    return dev_conf['host'] in local_hosts and dev_conf.get('in_process', True)
+
+
+def _import_class(path):
+    module_name, class_name = path.rsplit('.', 1)
+    return getattr(importlib.import_module('devices.'+module_name), class_name)
+
+
+def _worker_kwargs(dev_conf):
+    kwargs = {
+        'address': dev_conf['host'],
+        'req_port': dev_conf['req_port'],
+        'pub_port': dev_conf['pub_port'],
+    }
+    kwargs.update({k: dev_conf[k] for k in transport_options if k in dev_conf})
+    kwargs.update(dev_conf.get('params', {}))
+    return kwargs
+
+
+def start_worker_in_thread(dev_conf):
+    """ Start the worker of a device entry in a thread of this process.
+    Returns None if its channels are taken, i.e. another front-end runs
+    the worker already. If it cannot run in a thread for another reason,
+    the worker is started as a child process and None is returned too:
+    device servers leave such entries to the front-end. """
+    WorkerClass = _import_class(dev_conf['worker_class'])
+    worker = WorkerClass(**_worker_kwargs(dev_conf))
+    try:
+        worker.start_in_thread()
+    except Exception as e:
+        if isinstance(e, zmq.ZMQError) and e.errno == zmq.EADDRINUSE:
+            print("Worker of {} runs in another process: {}".format(dev_conf['name'], e))
+            return None
+        print("Worker of {} not started in process: {}".format(dev_conf['name'], e))
+        start_worker_process(dev_conf)
+        return None
+    return worker
+
+
+def start_worker_process(dev_conf):
+    """ Start the worker of a device entry as a child process, which ends
+    with this one """
+    WorkerClass = _import_class(dev_conf['worker_class'])
+    process = WorkerClass(**_worker_kwargs(dev_conf))
+    process.daemon = True
+    process.start()
+    return process
+
 
 def load_devices(use_gui=False, parent=None, file='devices.yaml'):
     with open(file, 'r') as config_file:
@@ -107,9 +165,12 @@ def load_devices(use_gui=False, parent=None, file='devices.yaml'):
                     'req_port': req,
                     'pub_port': pub,
                 }
+                kwargs.update({k: dev_conf[k] for k in transport_options if k in dev_conf})
+                if _in_process(dev_conf):
+                    # Calls and status messages bypass ZeroMQ altogether
+                    kwargs['worker'] = start_worker_in_thread(dev_conf)
 
-                module_name, class_name = dev_conf['client_class'].rsplit('.', 1)
-                DeviceClass = getattr(importlib.import_module('devices.'+module_name), class_name)
+                DeviceClass = _import_class(dev_conf['client_class'])
                 instance = DeviceClass(**kwargs)
 
                 active_devices[dev] = instance
@@ -129,20 +190,12 @@ def load_workers(file='devices.yaml', hostname='localhost'):
             if dev_conf['host'] != hostname:
                 continue
 
+            if _in_process(dev_conf):
+                continue # started by load_devices()
+
             name = dev_conf['name']
-            host = dev_conf['host']
-            req = dev_conf['req_port']
-            pub = dev_conf['pub_port']
-
-            kwargs = {
-                'address': host,
-                'req_port': req,
-                'pub_port': pub,
-            }
-            kwargs.update(dev_conf.get('params', {}))
-            
-            module_name, class_name = dev_conf['worker_class'].rsplit('.', 1)
-            DeviceClass = getattr(importlib.import_module('devices.'+module_name), class_name)
+            kwargs = _worker_kwargs(dev_conf)
+            DeviceClass = _import_class(dev_conf['worker_class'])
             
             workers.append((name, DeviceClass, kwargs))
         except Exception as e:
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Deadlines on the commands of motor axes.
+
+Every non-zero value commanded to an axis is valid for the timeout of the
+axis. If no new command arrives meanwhile, check() ramps the axis down to
+zero, so a motor does not keep running when its controller, or the link
+to it, goes silent.
+"""
+
+import threading
+from time import perf_counter as clock
+
+
+class Failsafe:
+    def __init__(self, apply, timeouts=None, default_timeout=0.5, ramp=0.2):
+        """ apply(axis, value) sets an axis without renewing its deadline.
+        timeouts maps axes to their timeout [s], None for axes which are
+        not guarded. ramp is the time [s] from the last value to zero. """
+        self.apply = apply
+        self.timeouts = dict(timeouts or {})
+        self.default_timeout = default_timeout
+        self.ramp = ramp
+        self.lock = threading.Lock()
+        self.axes = {} # axis -> [deadline, value commanded, ramping]
+        self.trips = {}
+
+    def timeout(self, axis):
+        return self.timeouts.get(axis, self.default_timeout)
+
+    def feed(self, axis, value, now=None):
+        """ Record a value commanded to an axis """
+        timeout = self.timeout(axis)
+        with self.lock:
+            if value == 0 or timeout is None:
+                self.axes.pop(axis, None)
+            else:
+                now = clock() if now is None else now
+                self.axes[axis] = [now + timeout, value, False]
+
+    def check(self, now=None):
+        """ Ramp down the axes past their deadline. Returns the axes which
+        have been stopped. """
+        now = clock() if now is None else now
+        stopped = []
+        # Applied under the lock, so a ramp never overwrites a newer command
+        with self.lock:
+            for axis, state in list(self.axes.items()):
+                deadline, commanded, ramping = state
+                if now < deadline:
+                    continue
+                if not ramping:
+                    state[2] = True
+                    self.trips[axis] = self.trips.get(axis, 0) + 1
+                scale = 1.0 - (now - deadline) / self.ramp if self.ramp > 0 else 0.0
+                if scale <= 0:
+                    del self.axes[axis]
+                    stopped.append(axis)
+                    value = 0
+                else:
+                    value = commanded * scale
+                try:
+                    self.apply(axis, value)
+                except Exception as e:
+                    print('[failsafe] {}: {}'.format(axis, e))
+        return stopped
+
+    def stats(self):
+        """ Seconds left of the axes guarded and number of timeouts of
+        every axis """
+        now = clock()
+        with self.lock:
+            return {"remaining": {axis: state[0] - now for axis, state in self.axes.items()},
+                    "trips": dict(self.trips)}
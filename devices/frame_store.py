@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Bounded storage of received CAN frames, indexed by arbitration id.
+"""
+
+import threading
+from collections import deque
+
+
+class FrameStore:
+    """ Keeps the last `capacity` frames of every arbitration id, as
+    (timestamp, data) tuples. Older frames are dropped and counted. Safe to
+    use from several threads. """
+
+    def __init__(self, capacity=256, lock=None):
+        self.capacity = capacity
+        self.lock = lock if lock is not None else threading.Lock()
+        self._frames = {}
+        self._received = {}
+        self._dropped = {}
+
+    def add(self, arbitration_id, timestamp, data):
+        with self.lock:
+            frames = self._frames.get(arbitration_id)
+            if frames is None:
+                frames = self._frames[arbitration_id] = deque(maxlen=self.capacity)
+                self._received[arbitration_id] = 0
+                self._dropped[arbitration_id] = 0
+            if len(frames) == self.capacity:
+                self._dropped[arbitration_id] += 1
+            frames.append((timestamp, bytes(data)))
+            self._received[arbitration_id] += 1
+
+    def last(self, arbitration_id, n=1):
+        """ Up to n newest frames of an id, oldest first """
+        with self.lock:
+            frames = self._frames.get(arbitration_id, ())
+            n = min(n, len(frames))
+            return [frames[i] for i in range(len(frames) - n, len(frames))]
+
+    def since(self, timestamp, arbitration_id=None):
+        """ Frames received after timestamp, of one id or of all ids as
+        (timestamp, arbitration id, data), oldest first """
+        with self.lock:
+            ids = self._frames if arbitration_id is None else [arbitration_id]
+            result = []
+            for i in ids:
+                for frame in reversed(self._frames.get(i, ())):
+                    if frame[0] <= timestamp:
+                        break
+                    result.append((frame[0], i, frame[1]))
+        result.sort(key=lambda frame: frame[0])
+        if arbitration_id is not None:
+            return [(t, data) for t, _, data in result]
+        return result
+
+    def stats(self):
+        """ {id: (frames stored, frames received, frames dropped)} """
+        with self.lock:
+            return {i: (len(frames), self._received[i], self._dropped[i])
+                    for i, frames in self._frames.items()}
+
+    def drain(self):
+        """ Remove and return all stored frames as (timestamp, arbitration
+        id, data), oldest first """
+        with self.lock:
+            result = [(t, i, data) for i, frames in self._frames.items() for t, data in frames]
+            for frames in self._frames.values():
+                frames.clear()
+        result.sort(key=lambda frame: frame[0])
+        return result
@@ -8,6 +8,7 @@ import PyQt5
 import jsonpickle
 import time
 from ..rover import Rover
+from ..rover_script import script_digest
 
 dead_zone = 0.15
 
@@ -32,6 +33,7 @@ class IKScripterWidget(QtWidgets.QWidget):
 
         self.files = []
         self.indexes = {}
+        self.rejected = {} # name -> digest of the scripts the rover rejected
         self.load_filenames()
         self.list_files.currentItemChanged.connect(self.load_file)
         self.button_save.pressed.connect(self.save_file)
@@ -95,7 +97,6 @@ class IKScripterWidget(QtWidgets.QWidget):
         self.indexes = {}
         programs = {}
         for file in file_list[2:]:
-            print(file)
             if file[-4:] != '.txt':
                 continue
             name = file[0:-4]
@@ -108,10 +109,31 @@ class IKScripterWidget(QtWidgets.QWidget):
             self.indexes[name] = len(self.files)
             self.files.append(name)
             self.list_files.addItem(name)
-        self.rover.update_script_library(programs)
+        self.sync_scripts(programs)
         if last_file != None:
             self.list_files.setCurrentIndex(self.list_files.currentIndex().sibling(self.indexes[last_file], 0))
 
+    def sync_scripts(self, programs):
+        """ Send the scripts which differ from the library of the rover """
+        if self.rover is None:
+            return
+        manifest = self.rover.script_manifest()
+        digests = {name: script_digest(text) for name, text in programs.items()}
+        # Rejected scripts are not in the manifest, they are sent again
+        # only once they have been edited
+        changed = {name: text for name, text in programs.items()
+                   if manifest.get(name) != digests[name] and self.rejected.get(name) != digests[name]}
+        removed = [name for name in manifest if name not in programs]
+        if changed:
+            errors = self.rover.upload_scripts(changed)
+            for name in changed:
+                self.rejected.pop(name, None)
+            for name, error in errors.items():
+                self.rejected[name] = digests[name]
+                print("{}: {}".format(name, error))
+        if removed:
+            self.rover.remove_scripts(removed)
+
     def load_file(self):
         name = self.files[self.list_files.currentIndex().row()]
         self.save_file()
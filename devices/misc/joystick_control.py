@@ -50,12 +50,17 @@ class Slave():
         self.description = description
         self.axis = axis
         self.step = step
-        self.method = getattr(device, method)
+        self.method_name = method
+        getattr(device, method) # fail early on unknown methods
         self.velocity = 0
         self.last_velocity = 0
         self.last_direction = 0
 
-    def execute(self):
+    def execute(self, target=None):
+        """ target is the device or a batch of its calls """
+        if target is None:
+            target = self.device
+        method = getattr(target, self.method_name)
         try:
             if self.velocity == self.last_velocity and abs(
                     self.velocity) < 0.000001:  # and not(self.axis == 190 or self.axis == 191 or self.axis == 201 or self.axis == 200):
@@ -64,10 +69,10 @@ class Slave():
             self.last_velocity = self.velocity
             if self.step == False:  # continous movement
                 if self.axis != None:
-                    self.method(self.axis, self.velocity)
+                    method(self.axis, self.velocity)
                     self.velocity = 0
                 else:
-                    self.method(self.velocity)
+                    method(self.velocity)
                     self.velocity = 0
             else:  # step movement
                 if self.velocity < 0:
@@ -79,10 +84,10 @@ class Slave():
 
                 if self.direction != 0 and self.direction != self.last_direction:
                     if self.axis != None:
-                        self.device.moveSteps(self.axis, self.direction)
+                        target.moveSteps(self.axis, self.direction)
                         self.velocity = 0
                     else:
-                        self.device.moveSteps(self.direction)
+                        target.moveSteps(self.direction)
                         self.velocity = 0
                 self.last_direction = self.direction
                 self.velocity = 0
@@ -342,7 +347,20 @@ class JoystickControlWidget(QtWidgets.QWidget):
             if slave_nr >= 0:
                 self.slaves[slave_nr].add_change(value)
 
+        # One request per device and tick, whatever the number of axes
+        slaves_of = {}
         for slave in self.slaves:
-            slave.execute()
+            slaves_of.setdefault(slave.device, []).append(slave)
+        for device, slaves in slaves_of.items():
+            if not hasattr(device, 'batch'):
+                for slave in slaves:
+                    slave.execute()
+                continue
+            try:
+                with device.batch() as batch:
+                    for slave in slaves:
+                        slave.execute(batch)
+            except Exception as e:
+                print("error sending to {}: {}".format(type(device).__name__, e))
 
         self.timer.start(40)
\ No newline at end of file
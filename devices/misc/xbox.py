@@ -52,7 +52,7 @@ class XBoxWorker(DeviceWorker):
 
         print("Pad no. " + str(self.device_number + 1) + " is now connected.")
         self.state_lock = threading.Lock()
-        self.status_thread = threading.Thread(target=self._state_loop)
+        self.status_thread = threading.Thread(target=self._state_loop, daemon=True)
         self.status_thread.start()
 
     def _state_loop(self):
@@ -146,4 +146,4 @@ class XBoxPad(DeviceOverZeroMQ):
                 self.checkbox.setCheckState(v)
             # self.textedit.setText(str(status))
 
-        self.createListenerThread(updateSlot)
+        self.createListenerThread(updateSlot, conflate=True, max_rate=10)
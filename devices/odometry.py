@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+Pose estimation from wheel odometry, compass and GPS.
+
+The pose is (x, y, heading): meters east and north of an origin given in
+degrees of latitude and longitude, and radians clockwise from north. An
+extended Kalman filter over this state is
+    - predicted with the distance travelled according to the wheels,
+    - corrected with compass headings and GPS fixes.
+Coordinates are converted with an equirectangular projection around the
+origin, whose scale factors are computed once.
+"""
+
+import math
+import threading
+from time import time
+
+import numpy as np
+
+EARTH_RADIUS = 6371000
+SET_POSITION_NOISE = 0.1 # [m] of a position given with set_position()
+SET_HEADING_NOISE = 0.01 # [rad] of a heading given with set_position()
+
+
+def wrap_angle(angle):
+    """ angle in [-pi, pi) """
+    return (angle + math.pi) % (2 * math.pi) - math.pi
+
+
+class Odometry:
+    def __init__(self, origin, distance_noise=0.1, position_drift=0.05, heading_drift=0.05,
+                 compass_noise=0.05, gps_noise=1.0, history=6000):
+        """ Noise parameters are standard deviations: distance_noise [m /
+        sqrt(m travelled)], position_drift [m / sqrt(s)], heading_drift
+        [rad / sqrt(s)], compass_noise [rad], gps_noise [m]. The variance of
+        a prediction grows linearly with the distance and the time, so it
+        does not depend on the rate of the updates. history is the number
+        of poses kept. """
+        self.origin = origin
+        self.m_per_deg_lat = math.radians(1) * EARTH_RADIUS
+        self.m_per_deg_lon = self.m_per_deg_lat * math.cos(math.radians(origin[0]))
+        self.distance_noise = distance_noise
+        self.position_drift = position_drift
+        self.heading_drift = heading_drift
+        self.compass_noise = compass_noise
+        self.gps_noise = gps_noise
+        self.lock = threading.Lock()
+        self.state = np.zeros(3)
+        self.covariance = np.diag([1e6, 1e6, 10.0]) # nothing known yet
+        self.time = None
+        self.history = np.zeros((history, 4)) # time, x, y, heading
+        self.history_size = 0
+        self.history_next = 0
+        self.pose = (0.0, 0.0, 0.0) # latest estimate, replaced as a whole
+        self.located = False # whether a position has been given or measured
+
+    def to_local(self, coordinates):
+        """ (x, y) of (latitude, longitude) """
+        return ((coordinates[1] - self.origin[1]) * self.m_per_deg_lon,
+                (coordinates[0] - self.origin[0]) * self.m_per_deg_lat)
+
+    def to_coordinates(self, x, y):
+        """ (latitude, longitude) of (x, y) """
+        return (self.origin[0] + y / self.m_per_deg_lat, self.origin[1] + x / self.m_per_deg_lon)
+
+    def set_position(self, x, y, heading=None):
+        with self.lock:
+            self.state[0:2] = x, y
+            self.covariance[0:2, :] = 0
+            self.covariance[:, 0:2] = 0
+            self.covariance[0, 0] = self.covariance[1, 1] = SET_POSITION_NOISE ** 2
+            if heading is not None:
+                self.state[2] = heading % (2 * math.pi)
+                self.covariance[2, :] = 0
+                self.covariance[:, 2] = 0
+                self.covariance[2, 2] = SET_HEADING_NOISE ** 2
+            self.located = True
+            self._record(time() if self.time is None else self.time)
+
+    def predict(self, distance, timestamp=None):
+        """ Move by distance [m] along the heading """
+        timestamp = time() if timestamp is None else timestamp
+        with self.lock:
+            dt = 0.0 if self.time is None else max(0.0, timestamp - self.time)
+            x, y, heading = self.state
+            s, c = math.sin(heading), math.cos(heading)
+            self.state[0] = x + s * distance
+            self.state[1] = y + c * distance
+            F = np.array([[1.0, 0.0, c * distance],
+                          [0.0, 1.0, -s * distance],
+                          [0.0, 0.0, 1.0]])
+            variance = self.distance_noise ** 2 * abs(distance)
+            drift = self.position_drift ** 2 * dt
+            Q = np.array([[s * s * variance + drift, s * c * variance, 0.0],
+                          [s * c * variance, c * c * variance + drift, 0.0],
+                          [0.0, 0.0, self.heading_drift ** 2 * dt]])
+            self.covariance = F @ self.covariance @ F.T + Q
+            self._record(timestamp)
+
+    def update_heading(self, heading, timestamp=None):
+        """ Correct with a compass heading [rad] """
+        with self.lock:
+            P = self.covariance
+            innovation = wrap_angle(heading - self.state[2])
+            K = P[:, 2] / (P[2, 2] + self.compass_noise ** 2)
+            self.state += K * innovation
+            self.state[2] %= 2 * math.pi
+            self.covariance = P - np.outer(K, P[2, :])
+            self._record(timestamp)
+
+    def update_gps(self, coordinates, timestamp=None):
+        """ Correct with a fix given as (latitude, longitude) """
+        z = np.array(self.to_local(coordinates))
+        with self.lock:
+            P = self.covariance
+            S = P[0:2, 0:2] + np.eye(2) * self.gps_noise ** 2
+            K = P[:, 0:2] @ np.linalg.inv(S)
+            self.state += K @ (z - self.state[0:2])
+            self.state[2] %= 2 * math.pi
+            self.covariance = P - K @ P[0:2, :]
+            self.located = True
+            self._record(timestamp)
+
+    def _record(self, timestamp):
+        if timestamp is None:
+            timestamp = time() if self.time is None else self.time
+        self.time = timestamp
+        x, y, heading = (float(v) for v in self.state)
+        self.history[self.history_next] = timestamp, x, y, heading
+        self.history_next = (self.history_next + 1) % len(self.history)
+        self.history_size = min(self.history_size + 1, len(self.history))
+        self.pose = (x, y, heading)
+
+    def position(self):
+        """ (x, y) of the latest estimate """
+        x, y, _ = self.pose
+        return (x, y)
+
+    def coordinates(self):
+        """ (latitude, longitude) of the latest estimate """
+        x, y, _ = self.pose
+        return self.to_coordinates(x, y)
+
+    def poses(self, since=None):
+        """ Array of the poses kept, one (time, x, y, heading) per row,
+        oldest first, optionally only the ones after time since """
+        with self.lock:
+            poses = np.roll(self.history, -self.history_next, axis=0)[len(self.history) - self.history_size:]
+        if since is not None:
+            poses = poses[np.searchsorted(poses[:, 0], since, side='right'):]
+        return poses
+
+    def pose_at(self, timestamp):
+        """ (x, y, heading) interpolated at a time within the history """
+        poses = self.poses()
+        if not len(poses):
+            return self.pose
+        x = np.interp(timestamp, poses[:, 0], poses[:, 1])
+        y = np.interp(timestamp, poses[:, 0], poses[:, 2])
+        heading = np.interp(timestamp, poses[:, 0], np.unwrap(poses[:, 3])) % (2 * math.pi)
+        return (float(x), float(y), float(heading))
+
+    def batch(self, events):
+        """ Run the filter over recorded events, (time, kind, value) sorted
+        by time, where kind is "distance", "heading" or "gps" (value is
+        (latitude, longitude)). Returns an array of (time, x, y, heading)
+        after each event. """
+        update = {"distance": self.predict, "heading": self.update_heading, "gps": self.update_gps}
+        poses = np.empty((len(events), 4))
+        for i, (timestamp, kind, value) in enumerate(events):
+            update[kind](value, timestamp)
+            poses[i] = (timestamp,) + self.pose
+        return poses
+
+
+def dead_reckoning(tacho, heading, start=(0.0, 0.0)):
+    """ Positions (x, y) integrated from arrays of cumulative distance
+    travelled [m] and of heading [rad] at the same instants, without any
+    correction. An array of shape (len(tacho), 2). """
+    distance = np.diff(np.asarray(tacho, dtype=float), prepend=tacho[0])
+    heading = np.asarray(heading, dtype=float)
+    steps = np.column_stack((np.sin(heading) * distance, np.cos(heading) * distance))
+    return np.cumsum(steps, axis=0) + start
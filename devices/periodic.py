@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Periodic execution of functions at absolute deadlines.
+"""
+
+import threading
+from time import perf_counter as clock
+
+
+class PeriodicTask:
+    def __init__(self, name, period, func, delay=0.0):
+        self.name = name
+        self.period = period
+        self.func = func
+        self.deadline = clock() + delay
+        self.reset_stats()
+
+    def advance(self, now):
+        """ Move to the next deadline. Periods which have already passed
+        are skipped rather than executed in a burst. """
+        self.deadline += self.period
+        if self.deadline <= now:
+            missed = int((now - self.deadline) / self.period) + 1
+            self.deadline += missed * self.period
+            self.overruns += missed
+
+    def record(self, lateness, duration):
+        self.runs += 1
+        self.jitter_sum += lateness
+        self.jitter_max = max(self.jitter_max, lateness)
+        self.duration_sum += duration
+        self.duration_max = max(self.duration_max, duration)
+
+    def reset_stats(self):
+        self.runs = 0
+        self.overruns = 0
+        self.jitter_sum = 0.0
+        self.jitter_max = 0.0
+        self.duration_sum = 0.0
+        self.duration_max = 0.0
+
+    def stats(self):
+        """ Lateness of the start against the deadline (jitter), execution
+        time and number of skipped periods (overruns) """
+        runs = self.runs or 1
+        return {
+            "period_ms": self.period * 1000,
+            "runs": self.runs,
+            "overruns": self.overruns,
+            "jitter_avg_us": self.jitter_sum / runs * 1e6,
+            "jitter_max_us": self.jitter_max * 1e6,
+            "duration_avg_us": self.duration_sum / runs * 1e6,
+            "duration_max_us": self.duration_max * 1e6,
+        }
+
+
+class Scheduler:
+    """ Runs any number of periodic tasks on a single thread. Deadlines are
+    absolute, so the period does not drift with the execution time.
+
+    The thread sleeps until `spin` seconds before a deadline and then
+    polls the clock, trading some CPU time for a start closer to the
+    deadline than the sleep granularity of the OS allows. """
+
+    def __init__(self, name="scheduler", spin=0.0):
+        self.tasks = {}
+        self.spin = spin
+        self.running = True
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._loop, name=name, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self.running = False
+            self._condition.notify()
+
+    def add(self, name, period, func, delay=0.0):
+        """ Call func() every period seconds, starting after delay.
+        Replaces the task of the same name, if any. """
+        with self._condition:
+            self.tasks[name] = PeriodicTask(name, period, func, delay)
+            self._condition.notify()
+
+    def remove(self, name):
+        with self._condition:
+            self.tasks.pop(name, None)
+
+    def stats(self, reset=True):
+        """ Statistics of each task, see PeriodicTask.stats(), since the
+        previous reset """
+        with self._condition:
+            stats = {name: task.stats() for name, task in self.tasks.items()}
+            if reset:
+                for task in self.tasks.values():
+                    task.reset_stats()
+            return stats
+
+    def _loop(self):
+        while self.running:
+            with self._condition:
+                if not self.running:
+                    break
+                if not self.tasks:
+                    self._condition.wait()
+                    continue
+                task = min(self.tasks.values(), key=lambda t: t.deadline)
+                deadline = task.deadline
+                delay = deadline - clock()
+                if delay > self.spin:
+                    self._condition.wait(delay - self.spin)
+                    continue
+            while clock() < deadline:
+                pass
+            start = clock()
+            with self._condition:
+                task.advance(start)
+            try:
+                task.func()
+            except Exception as e:
+                print("{}: {}".format(task.name, e))
+            with self._condition:
+                task.record(start - deadline, clock() - start)
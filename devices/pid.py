@@ -1,29 +1,114 @@
+"""
+PID controllers stepped at a fixed rate.
 
-from collections import deque
+The integral term is the mean of the last HISTORY errors times dt and the
+derivative is taken over DERIVATIVE_SPAN steps. Both are read from a ring
+buffer of past errors with a running sum, so a step costs the same
+whatever the length of the history.
+"""
+
+import numpy as np
+
+HISTORY = 101 # errors averaged into the integral term
+DERIVATIVE_SPAN = 10 # steps over which the derivative is taken
 
-import itertools
 
 class PID():
-    def __init__(self, params=[0.004, 10, 0]):
+    def __init__(self, params=[0.004, 10, 0], limit=0.35, derivative_filter=None, anti_windup=False):
+        """ params are [Ap, Fi, Td]. derivative_filter is N of a first-order
+        filter with time constant Td / N on the derivative of the error,
+        used instead of the difference over DERIVATIVE_SPAN steps.
+        anti_windup bounds the integral term to the output limit. """
         self.set_params(params)
-        self.integral = 0
-        self.lastvals = deque([0 for i in range(1001)])
+        self.limit = limit
+        self.derivative_filter = derivative_filter
+        self.anti_windup = anti_windup
+        self.reset()
 
     def set_params(self, params):
         self.Ap = params[0]
         self.Fi = params[1]
         self.Td = params[2]
 
+    def reset(self):
+        self.integral = 0
+        self.deriv = 0.0
+        self.lastvals = [0.0] * HISTORY
+        self.head = 0 # position of the newest error
+        self.total = 0.0
+        self.steps = 0
+
     def step(self, dt, error):
-        N = 20
-        deriv = (error - self.lastvals[9]) / (10 * dt)
-        self.integral = sum(list(itertools.islice(self.lastvals, 0, 100 + 1))) / (100 + 1) * dt
-        self.lastvals.rotate(1)
-        self.lastvals[0] = error
-        power = self.Ap * (error + deriv * self.Td + self.integral * self.Fi)
-
-        if power > 0.35:
-            power = 0.35
-        if power < -0.35:
-            power = -0.35
-        return power
\ No newline at end of file
+        lastvals = self.lastvals
+        head = self.head
+        if self.derivative_filter:
+            alpha = dt / (self.Td / self.derivative_filter + dt)
+            self.deriv += alpha * ((error - lastvals[head]) / dt - self.deriv)
+        else:
+            self.deriv = (error - lastvals[(head - DERIVATIVE_SPAN + 1) % HISTORY]) / (DERIVATIVE_SPAN * dt)
+        self.integral = self.total / HISTORY * dt
+        if self.anti_windup and self.Ap * self.Fi:
+            bound = abs(self.limit / (self.Ap * self.Fi))
+            self.integral = min(max(self.integral, -bound), bound)
+
+        head = self.head = (head + 1) % HISTORY
+        self.total += error - lastvals[head]
+        lastvals[head] = error
+        self.steps += 1
+        if self.steps % HISTORY == 0:
+            self.total = sum(lastvals) # drop the rounding errors of the running sum
+
+        power = self.Ap * (error + self.deriv * self.Td + self.integral * self.Fi)
+        return min(max(power, -self.limit), self.limit)
+
+
+class MultiPID():
+    """ Independent PID controllers for a number of channels, stepped
+    together. Parameters may be given per channel. A step costs about as
+    much as seven PID steps, so it pays off for more channels than that. """
+
+    def __init__(self, channels, params=[0.004, 10, 0], limit=0.35, derivative_filter=None, anti_windup=False):
+        self.channels = channels
+        self.set_params(params)
+        self.limit = limit
+        self.derivative_filter = derivative_filter
+        self.anti_windup = anti_windup
+        self.reset()
+
+    def set_params(self, params):
+        self.Ap, self.Fi, self.Td = (np.broadcast_to(np.asarray(p, dtype=float), (self.channels,)).copy()
+                                     for p in params[:3])
+
+    def reset(self):
+        self.integral = np.zeros(self.channels)
+        self.deriv = np.zeros(self.channels)
+        self.lastvals = np.zeros((HISTORY, self.channels))
+        self.head = 0
+        self.total = np.zeros(self.channels)
+        self.steps = 0
+
+    def step(self, dt, errors):
+        """ Array of the outputs for the errors of all channels """
+        errors = np.asarray(errors, dtype=float)
+        lastvals = self.lastvals
+        head = self.head
+        if self.derivative_filter:
+            alpha = dt / (self.Td / self.derivative_filter + dt)
+            self.deriv += alpha * ((errors - lastvals[head]) / dt - self.deriv)
+        else:
+            self.deriv = (errors - lastvals[(head - DERIVATIVE_SPAN + 1) % HISTORY]) / (DERIVATIVE_SPAN * dt)
+        self.integral = self.total / HISTORY * dt
+        if self.anti_windup:
+            gain = np.abs(self.Ap * self.Fi)
+            bound = np.divide(self.limit, gain, out=np.full(self.channels, np.inf), where=gain > 0)
+            np.clip(self.integral, -bound, bound, out=self.integral)
+
+        head = self.head = (head + 1) % HISTORY
+        self.total += errors - lastvals[head]
+        lastvals[head] = errors
+        self.steps += 1
+        if self.steps % HISTORY == 0:
+            self.total = lastvals.sum(axis=0)
+
+        power = self.Ap * (errors + self.deriv * self.Td + self.integral * self.Fi)
+        return np.clip(power, -self.limit, self.limit)
@@ -22,14 +22,25 @@ class Reach():
         self.socket.connect((host, port))
         self.streamreader = pynmea2.NMEAStreamReader()
         self.status = {}
+        self.fixes = 0 # sentences with a position received
         self.tcp_lock = threading.Lock()
-        self.tcp_thread = threading.Thread(target=self.loop_tcp)
-        self.tcp_thread.start()
+        self.tcp_thread = threading.Thread(target=self.loop_tcp, name="reach-tcp", daemon=True)
         self.lastok = (0, 0)
+        self.tcp_thread.start()
 
     def get_status(self):
         with self.tcp_lock:
-            status = self.status
+            status = dict(self.status)
+        return self._coordinates(status)
+
+    def get_fix(self):
+        """ (number of fixes received, (latitude, longitude) of the last one) """
+        with self.tcp_lock:
+            fixes = self.fixes
+            status = dict(self.status)
+        return fixes, self._coordinates(status)
+
+    def _coordinates(self, status):
         try:
             lon = to_degrees(float(status["Longitude"]), status["Longitude Direction"])
             lat = to_degrees(float(status["Latitude"]), status["Latitude Direction"])
@@ -50,6 +61,8 @@ class Reach():
                             self.status[msg.fields[i][0]] = msg.data[i]
                     except IndexError:
                         pass
+                    if getattr(msg, "lat", ""):
+                        self.fixes += 1
 
 
 if __name__ == "__main__":
@@ -5,6 +5,13 @@ from time import perf_counter as clock
 from time import sleep, time
 from collections import deque
 from devices.pid import PID
+from devices.periodic import Scheduler
+from devices.failsafe import Failsafe
+from devices.profiling import Profiler, Histogram
+from devices.can_decoder import CanDecoder, Telemetry
+from devices.frame_store import FrameStore
+from devices.odometry import Odometry
+from devices import can_transmit, can_log, rover_sim, rover_script
 #from devices.temphum import DHT22
 from devices.ik import axes_to_arm, axes_to_rover, arm_to_axes, arm_to_rover, rover_to_arm, rover_to_axes
 from devices.autonomy import Autonomy, Command, Task, AutoInput
@@ -55,17 +62,82 @@ arm_upper = 190
 arm_rot = 196
 grip_lat = 195
 
+ARM_MOTORS = (arm_lower, arm_upper, arm_rot, grip_lat)
+WHEEL_MODULES = (140, 141, 142, 143)
+
+""" Values decoded from the bus, see RoverWorker.create_decoder(). Written
+only by loop_read(); other threads read telemetry.snapshot() or the
+attributes defined with _telemetry_field() """
+telemetry_fields = [
+    ("wheels", 4, 0),
+    ("battery_v", 4, 0),
+    ("encoders", len(ARM_MOTORS), 0),
+    ("index_pulses", len(ARM_MOTORS), 500.0),
+    ("compass_pitch", 1, 0.0),
+    ("compass_roll", 1, 0.0),
+    ("compass_heading", 1, 0.0),
+    ("compass_terrain_direction", 1, 0.0),
+    ("compass_terrain_slope", 1, 0.0),
+    ("soil_humidity", 1, 0),
+    ("air_co2", 1, 0),
+]
+
 pid_settings = {arm_lower: [5, 0, 0.005], arm_upper: [-5, 0, -0.005], arm_rot: [-0.5, 0, -5], grip_lat: [1, 0, 1]}
 relative_position_default_origin = (51.470876, -112.752628)#(52.211415, 20.983336)
 
 def list_to_int(bytes):
     return int.from_bytes(bytearray(bytes), byteorder='big', signed=True)
 
+def _telemetry_field(name, convert=None):
+    """ Read-only attribute backed by a snapshot of the telemetry record """
+    def get(self):
+        value = self.telemetry.snapshot()[name]
+        return convert(value) if convert is not None else value
+    return property(get)
+
+def _ints(values):
+    return [int(v) for v in values]
+
+def _arm_dict(values):
+    return dict(zip(ARM_MOTORS, values))
+
 lipo_characteristics = [0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,2,2,2,2,2,2,2,2,2,2,2,2,2,2,2,2,2,2,3,3,3,3,3,3,3,3,3,3,3,3,3,3,3,3,3,3,3,4,4,4,4,4,4,4,4,4,4,5,5,5,5,5,5,5,5,5,5,6,6,6,6,6,6,6,6,6,7,7,7,7,8,8,8,8,8,9,9,9,10,10,10,11,11,12,12,12,13,13,13,14,14,14,15,16,16,17,17,18,19,19,20,20,21,22,22,24,25,26,27,28,29,31,33,34,36,37,39,41,43,45,46,47,49,50,52,53,54,55,56,56,57,58,59,59,60,62,63,64,64,65,66,66,67,68,68,69,69,70,71,71,72,72,73,73,74,74,75,75,76,77,77,78,78,79,79,80,80,81,81,82,82,83,83,84,84,85,85,86,86,87,87,87,88,88,89,89,90,90,90,91,91,92,92,92,93,93,94,94,94,95,95,95,96,96,96,97,97,97,97,98,98,98,99,99,99,99,99,99,99,100,100,100,100,100,100,100,100,100,100,100,100,100,100,100,100,100,100,100,100,100,100,100,100,100,100,100,100,100,100,100,100,100,100,100,100,100,100,100,100]
 
 
 COMMAND_STREAM_PORT = 17293
+
+POSITION_FPS = 100
+COMPASS_UPDATE_TICKS = 10 # position updates per compass correction of the odometry
+IK_PERIOD = 0.030
+BLINK_PERIOD = 0.5
+AUTO_PERIOD = 0.05
+FAILSAFE_PERIOD = 0.02
+DRIVE_AXES = ("throttle", "turning") # axes of drive(), as named in failsafe_timeouts
+LOOP_SPIN = 0.0005 # [s] before a deadline, see Scheduler
 COMMAND_ID_HISTORY = 100
+COMMAND_PACKET_MAX = 4096
+
+""" Packets of the command stream are a header followed by commands """
+COMMAND_HEADER = struct.Struct('Id') # packet id, time.time() of sending
+COMMAND_ID = struct.Struct('I') # header of older clients
+COMMAND = struct.Struct('Bhf') # MoveCommand, axis, value
+""" Reports sent to the client every COMMAND_REPORT_PERIOD, also while no
+packets arrive, so that it can tell a quiet link from a broken one """
+COMMAND_REPORT = struct.Struct('Iddd') # newest packet id, its time of sending, loss, jitter [s]
+COMMAND_REPORT_PERIOD = 0.2
+
+
+def _command_header(data):
+    """ Packet id, time of sending (None from older clients) and offset of
+    the commands of a command stream packet, or None if its length does
+    not fit either header followed by whole commands """
+    if len(data) >= COMMAND_HEADER.size and (len(data) - COMMAND_HEADER.size) % COMMAND.size == 0:
+        packet_id, sent = COMMAND_HEADER.unpack_from(data)
+        return packet_id, sent, COMMAND_HEADER.size
+    if len(data) >= COMMAND_ID.size and (len(data) - COMMAND_ID.size) % COMMAND.size == 0:
+        packet_id, = COMMAND_ID.unpack_from(data)
+        return packet_id, None, COMMAND_ID.size
+    return None
 
 
 class MoveCommand(IntEnum):
@@ -76,66 +148,132 @@ class MoveCommand(IntEnum):
 
 
 class RoverWorker(DeviceWorker):
-    def __init__(self, req_port=default_req_port, pub_port=default_pub_port, **kwargs):
+    wheels = _telemetry_field("wheels", _ints)
+    battery_v = _telemetry_field("battery_v", _ints)
+    arm_encoders = _telemetry_field("encoders", _arm_dict)
+    arm_index_pulses = _telemetry_field("index_pulses", _arm_dict)
+    compass_pitch = _telemetry_field("compass_pitch")
+    compass_roll = _telemetry_field("compass_roll")
+    compass_heading = _telemetry_field("compass_heading")
+    compass_terrain_direction = _telemetry_field("compass_terrain_direction")
+    compass_terrain_slope = _telemetry_field("compass_terrain_slope")
+    soil_humidity = _telemetry_field("soil_humidity")
+    air_co2 = _telemetry_field("air_co2")
+
+    @property
+    def encoders(self):
+        """ Of the arm and of any other module which reports them """
+        return {**self.arm_encoders, **self.other_encoders}
+
+    @property
+    def index_pulses(self):
+        return {**self.arm_index_pulses, **self.other_index_pulses}
+
+    def __init__(self, req_port=default_req_port, pub_port=default_pub_port, can_node_interval=0.002,
+                 can_max_rate=None, can_record=None, can_replay=None, can_replay_speed=1.0, simulate=None,
+                 profile_period=None, can_store_capacity=256, failsafe_timeouts=None, failsafe_ramp=0.2,
+                 script_rate=10.0, **kwargs):
         super().__init__(req_port=req_port, pub_port=pub_port, **kwargs)
-        self.messages = []
-        self.wheels = [0, 0, 0, 0]
+        self.can_record = can_record # record all CAN traffic to this file
+        self.can_replay = can_replay # read CAN frames from this log instead of can0
+        self.can_replay_speed = can_replay_speed # None or 0 for as fast as possible
+        self.simulate = simulate # True or options of rover_sim.Simulator to run without the hardware
+        self.simulator = None
+        self.profile_period = profile_period # [s] of the b"profile" topic, None to not publish it
+        self.profiler = Profiler()
+        self.can_node_interval = can_node_interval # min. spacing of frames to one node [s]
+        self.can_max_rate = can_max_rate # max. frames per second on the bus
+        self.can_store_capacity = can_store_capacity # frames kept per id, see FrameStore
+        # Axes are ramped to zero when not commanded for their timeout [s]:
+        # "default", ids of power() and "throttle" and "turning" of drive()
+        timeouts = dict(failsafe_timeouts or {})
+        self.failsafe = Failsafe(self.failsafe_apply, timeouts, timeouts.pop("default", 0.5), failsafe_ramp)
+        self.script_rate = script_rate # [Hz] of the powers and IK targets of a script
+        self.telemetry = Telemetry(telemetry_fields)
+        # Encoders of modules outside the arm, written by loop_read() only
+        self.other_encoders = {}
+        self.other_index_pulses = {}
+        self.decoder = self.create_decoder()
         self.wheels_target = [0, 0, 0, 0]
         self.wheels_pid = False
         self.wheels_manual = False
         self.wheels_last_time_manual = clock()
         self.wheels_pid_controllers = [PID() for k in range(4)]
-        self.battery_v = [0, 0, 0, 0]
-        self.compass_pitch = 0.0
-        self.compass_roll = 0.0
-        self.compass_heading = 0.0
-        self.compass_terrain_direction = 0.0
-        self.compass_terrain_slope = 0.0
         self.throttle = 0.0
         self.turning = 0.0
-        self.position = (24.3, 4.3)
+        self.odometry = Odometry(relative_position_default_origin)
+        self.odometry_ticks = 0
+        self.gps_fixes = 0 # of the Reach, fed to the odometry
         self.is_ik = False
         self.ikpositions = [0.85 * PI, 0.65 *PI, PI, PI]
-        self.encoders = {arm_lower:0, arm_upper:0, arm_rot:0, grip_lat:0}
-        self.index_pulses = {arm_lower:500.0, arm_upper:500.0, arm_rot:500.0, grip_lat:500.0}
         self.ik_position = [150 * deg, 90 * deg, 240 * deg, 180 * deg]
         self.ik_speed = [0, 0, 0, 0]
         self.ik_update_timestamp = clock()
         self.ik_watchdog_timestamp = clock() - 1
         self.air_humidity = 0
         self.air_temperature = 0
-        self.air_co2 = 0
         self.soil_temperature = 0
-        self.soil_humidity = 0
         self.logfile = open("vlog.txt", "a");
         self.logc = 0
-        self.script_library = {}
+        self.scripts = rover_script.ScriptStore() # library of named scripts, see upload_scripts()
         self.script_is_running = False
         self.autonomy = Autonomy()
         self.available_devices = {}
         self.rover_reversed = False
         self.cmd_socket = None
+        self.cmd_stream_lock = threading.Lock()
+        self.cmd_client = None # address reports are sent to, of the newest packet
         self.last_packet_id = None
-        self.packet_history = deque()
+        self.last_packet_sent = None # time of sending of the newest packet
+        self.packet_window = bytearray(COMMAND_ID_HISTORY) # 1 for the ids received of the last ones
+        self.packets_in_window = 0
+        self.window_span = 0
+        self.cmd_stream_packets = 0
+        self.cmd_stream_superseded = 0
+        self.cmd_stream_malformed = 0
+        self.cmd_stream_min_delay = float('inf')
+        self.cmd_stream_last_delay = None
+        self.cmd_stream_jitter = 0.0
+        self.cmd_stream_delay = Histogram()
+        self.cmd_stream_link = {"received": 0.0, "loss": 1.0, "jitter_ms": 0.0, "delay": None, "time": None}
 
     def init_device(self):
-        self._bus = can.interface.Bus(bustype="socketcan", channel="can0", bitrate=250000)
-
-        self.data_lock = threading.Lock()
-        self.msg_lock = threading.Lock()
+        if self.can_replay:
+            self._bus = can_log.ReplayBus(self.can_replay, speed=self.can_replay_speed)
+        elif self.simulate:
+            options = dict(self.simulate) if isinstance(self.simulate, dict) else {}
+            # devices.yaml may override the values of the real rover
+            origin = options.pop("origin", relative_position_default_origin)
+            scale = options.pop("erpm_per_meter", erpm_per_meter)
+            self.simulator = rover_sim.Simulator(origin=origin, erpm_per_meter=scale, **options)
+            self._bus = self.simulator.bus
+        else:
+            self._bus = can.interface.Bus(bustype="socketcan", channel="can0", bitrate=250000)
+        if self.can_record:
+            self._bus = can_log.RecordingBus(self._bus, self.can_record)
+        # All frames leave through one thread, whichever thread commands them
+        self.transmitter = can_transmit.CanTransmitter(self._bus, self.can_node_interval, self.can_max_rate)
+
+        self.data_lock = self.profiler.lock("data_lock")
+        self.msg_lock = self.profiler.lock("msg_lock")
+        self.messages = FrameStore(self.can_store_capacity, self.msg_lock)
         self.position_lock = threading.Lock()
         self.auto_lock = threading.Lock()
         self.ik_lock = threading.Lock()
 
-        self.msg_thread = threading.Thread(target=self.loop_read)
+        self.msg_thread = threading.Thread(target=self.loop_read, name="can-read", daemon=True)
         self.msg_thread.start()
 
         self.wheels_lock = threading.Lock()
-        self.position_thread = threading.Thread(target=self.loop_position)
-        self.position_thread.start()
-
-        self.ik_thread = threading.Thread(target=self.loop_ik)
-        self.ik_thread.start()
+        # Control loops share one thread, each at its own absolute deadlines.
+        # The loops which may take long run on another one, so that they do
+        # not delay the position and the failsafe.
+        self.loops = Scheduler("rover-loops", spin=LOOP_SPIN)
+        self.slow_loops = Scheduler("rover-slow-loops")
+        self.last_tacho = None # read once the wheels have reported
+        timed = self.profiler.timed
+        self.loops.add("position", 1.0 / POSITION_FPS, timed("position", self.update_position), delay=1.0)
+        self.slow_loops.add("ik", IK_PERIOD, timed("ik", self.update_ik))
 
         #self.serial_dht22 = serial.Serial('/dev/ttyAMA0', 115200, timeout=5)
         #self.lock_dht22 = threading.Lock()
@@ -143,21 +281,27 @@ class RoverWorker(DeviceWorker):
         #self.thread_dht22.start()
 
         self.set_blink()
-        self.blink_thread = threading.Thread(target=self.loop_blink)
-        self.blink_thread.start()
+        self.blink_state = 0
+        self.slow_loops.add("blink", BLINK_PERIOD, timed("blink", self.update_blink))
 
         try:
-            self.reach = Reach()
+            if self.simulator is not None:
+                self.reach = Reach(*self.simulator.nmea_address)
+            else:
+                self.reach = Reach()
         except:
             self.reach = None
             print("No connection with reach.")
-        self.auto_thread = threading.Thread(target=self.loop_auto)
-        self.auto_thread.start()
-
-        self.script_lock = threading.Lock()
-        self.script_stop = 0
-        self.script_code = ""
-        self.script_thread = threading.Thread(target=self.loop_script)
+        self.slow_loops.add("auto", AUTO_PERIOD, timed("auto", self.update_auto))
+        self.loops.add("failsafe", FAILSAFE_PERIOD, timed("failsafe", self.failsafe.check))
+        self.loops.start()
+        self.slow_loops.start()
+
+        self.script_lock = self.profiler.lock("script_lock")
+        self.script_abort = threading.Event()
+        self.script_ready = threading.Event()
+        self.script_next = None # code or Program to run next
+        self.script_thread = threading.Thread(target=self.loop_script, name="script", daemon=True)
         self.script_thread.start()
 
         self.send(128, [20,10])
@@ -171,8 +315,10 @@ class RoverWorker(DeviceWorker):
         self.cmd_stream_port = COMMAND_STREAM_PORT
         sock_addr = (self.address, self.cmd_stream_port)
         self.cmd_socket.bind(sock_addr)
-        self.cmd_stream_loop = threading.Thread(target=self.loop_cmd_stream)
+        self.cmd_stream_loop = threading.Thread(target=self.loop_cmd_stream, name="cmd-stream", daemon=True)
         self.cmd_stream_loop.start()
+        self.slow_loops.add("cmd-report", COMMAND_REPORT_PERIOD,
+                            self.profiler.timed("cmd-report", self.send_cmd_report))
 
         #self.tag_reader = TagReader()
 
@@ -186,6 +332,9 @@ class RoverWorker(DeviceWorker):
             self.send(id, [36] + list(reversed(bytearray(struct.pack("i", int(10000 * pid[1]))))))
             self.send(id, [37] + list(reversed(bytearray(struct.pack("i", int(10000 * pid[2]))))))
 
+        if self.profile_period:
+            self.add_publisher(b"profile", lambda: self.get_profile(reset=True), period=self.profile_period)
+
         print("Rover initialized")
 
 
@@ -202,35 +351,37 @@ class RoverWorker(DeviceWorker):
         d["connected"] = True
         d["position"] = self.get_position()
         d["coordinates"] = self.get_coordinates()
-        with self.data_lock:
-            d["heading"] = self.compass_heading
-            d["terrain_direction"] = self.compass_terrain_direction
-            d["terrain_slope"] = self.compass_terrain_slope
-            d["voltage"] = sum(self.battery_v) / 40.0
-            d["encoders"] = self.encoders
-            d["index_pulses"] = self.index_pulses
-            d["wheels"] = self.wheels
-            d["air_temperature"] = 0 #self.get_air_temperature()
-            d["air_humidity"] = 0 #self.get_air_humidity()
-            d["air_co2"] = self.air_co2
-            d["soil_temperature"] = self.soil_temperature
-            d["soil_humidity"] = self.soil_humidity
-
-            s = sum(self.battery_v) - 4 * 2 # 0.2V fix
-            if s < 4 * 180:
-                i = 0
-            elif s >= 4 * 252:
-                i = 4 * 72 - 1
-            else:
-                i = s - 180 * 4
+        # A consistent copy, taken without blocking loop_read()
+        t = self.telemetry.snapshot()
+        battery_v = _ints(t["battery_v"])
+        d["heading"] = t["compass_heading"]
+        d["terrain_direction"] = t["compass_terrain_direction"]
+        d["terrain_slope"] = t["compass_terrain_slope"]
+        d["voltage"] = sum(battery_v) / 40.0
+        d["encoders"] = {**_arm_dict(t["encoders"]), **self.other_encoders}
+        d["index_pulses"] = {**_arm_dict(t["index_pulses"]), **self.other_index_pulses}
+        d["wheels"] = _ints(t["wheels"])
+        d["air_temperature"] = 0 #self.get_air_temperature()
+        d["air_humidity"] = 0 #self.get_air_humidity()
+        d["air_co2"] = t["air_co2"]
+        d["soil_temperature"] = self.soil_temperature
+        d["soil_humidity"] = t["soil_humidity"]
+
+        s = sum(battery_v) - 4 * 2 # 0.2V fix
+        if s < 4 * 180:
+            i = 0
+        elif s >= 4 * 252:
+            i = 4 * 72 - 1
+        else:
+            i = s - 180 * 4
 
-            d['battery'] = lipo_characteristics[i]
+        d['battery'] = lipo_characteristics[i]
 
         d['autonomy'] = self.autonomy.get_status()
 
-        d['cmd_stream_quality'] = len(self.packet_history) / COMMAND_ID_HISTORY
+        d['cmd_stream_quality'] = self.cmd_stream_link
 
-        self.logfile.write("%f\t%f\n" % (time(), sum(self.battery_v) / 40.0))
+        self.logfile.write("%f\t%f\n" % (time(), d["voltage"]))
         self.logc += 1
         if self.logc % 100 == 0:
             self.logfile.flush()
@@ -240,75 +391,122 @@ class RoverWorker(DeviceWorker):
 
     @remote
     def read(self):
-        with self.msg_lock:
-            for msg in self.messages:
-                print((msg.arbitration_id - 1024, list(msg.data)))
-            self.messages = []
+        for timestamp, arbitration_id, data in self.messages.drain():
+            print((arbitration_id - 1024, list(data)))
 
-    def loop_ik(self): # function for constant speed pad arm movement with use of ik
-        while True:
-            with self.data_lock:
-                speed = self.ik_speed
-            if speed != [0, 0, 0, 0]:
-                self.ik_watchdog_timestamp = clock()
-            if self.ik_watchdog_timestamp + 0.5 < clock():
-                self.ik_update_timestamp = clock()
-                with self.data_lock:
-                    self.ik_position = (self.encoders[arm_lower] * deg, self.encoders[arm_upper] * deg, self.encoders[grip_lat] * deg, self.encoders[arm_rot] * deg)
-            else:
-                #print("ok" + str(speed))
-                position = self.ik_position
-                position_arm = axes_to_arm(position)
-                dt = clock() - self.ik_update_timestamp
-                self.ik_update_timestamp = clock()
-                position_arm_new = [position_arm[i] + speed[i] * dt for i in range(4)]
-                try:
-                    position_new = arm_to_axes(position_arm_new)
-                    self.ik_position = position_new
-                    self.ik(position_new[0:3])
-                except Exception as e:
-                    print(e)
-            sleep(0.030)
+    @remote
+    def can_frames(self, arbitration_id, n=1, since=None):
+        """ Frames kept of a module (arbitration id - 1024) as (timestamp,
+        data) tuples: the last n, or all received after timestamp since """
+        if since is not None:
+            frames = self.messages.since(since, arbitration_id + 1024)
+        else:
+            frames = self.messages.last(arbitration_id + 1024, n)
+        return [(t, list(data)) for t, data in frames]
+
+    @remote
+    def can_frame_stats(self):
+        """ {module: (frames kept, frames received, frames dropped)} """
+        return {i - 1024: stats for i, stats in self.messages.stats().items()}
+
+    def update_ik(self): # constant speed pad arm movement with use of ik
+        with self.data_lock:
+            speed = self.ik_speed
+        if speed != [0, 0, 0, 0]:
+            self.ik_watchdog_timestamp = clock()
+        if self.ik_watchdog_timestamp + 0.5 < clock():
+            self.ik_update_timestamp = clock()
+            encoders = self.encoders
+            self.ik_position = (encoders[arm_lower] * deg, encoders[arm_upper] * deg, encoders[grip_lat] * deg, encoders[arm_rot] * deg)
+        else:
+            #print("ok" + str(speed))
+            position = self.ik_position
+            position_arm = axes_to_arm(position)
+            dt = clock() - self.ik_update_timestamp
+            self.ik_update_timestamp = clock()
+            position_arm_new = [position_arm[i] + speed[i] * dt for i in range(4)]
+            try:
+                position_new = arm_to_axes(position_arm_new)
+                self.ik_position = position_new
+                self.ik(position_new[0:3])
+            except Exception as e:
+                print(e)
+
+    def create_decoder(self):
+        """ Layouts of the frames sent by the rover modules """
+        t = self.telemetry
+        values = t.values
+        decoder = CanDecoder()
+
+        for i, module in enumerate(WHEEL_MODULES): # wheel encoders
+            decoder.add(1024 + module, 30, '>ih', [(t.position("wheels", i), 1, 0),
+                                                   (t.position("battery_v", i), 1, 0)],
+                        values, keep=True)
+
+        uint16 = struct.Struct('>H')
+        def arm_encoder(i): # readings from arm encoders
+            encoder = t.position("encoders", i)
+            index_pulse = t.position("index_pulses", i)
+            def handler(arbitration_id, data):
+                values[encoder] = uint16.unpack_from(data, 1)[0] / 10
+                if len(data) >= 5:
+                    values[index_pulse] = uint16.unpack_from(data, 3)[0] / 10
+            return handler
+        for i, motor in enumerate(ARM_MOTORS):
+            decoder.register(1024 + motor, 28, arm_encoder(i))
+        def other_encoder(arbitration_id, data):
+            motor = arbitration_id - 1024
+            self.other_encoders[motor] = uint16.unpack_from(data, 1)[0] / 10
+            if len(data) >= 5:
+                self.other_index_pulses[motor] = uint16.unpack_from(data, 3)[0] / 10
+        decoder.register(None, 28, other_encoder)
+
+        compass = struct.Struct('>hhh')
+        raw_to_rad = 3.14159 / 180 / 10
+        heading = t.position("compass_heading")
+        pitch = t.position("compass_pitch")
+        roll = t.position("compass_roll")
+        terrain_direction = t.position("compass_terrain_direction")
+        terrain_slope = t.position("compass_terrain_slope")
+        def compass_handler(arbitration_id, data):
+            p, r, h = compass.unpack_from(data, 1)
+            reversed_offset = PI if self.rover_reversed else 0
+            values[heading] = (h * raw_to_rad + reversed_offset) % (2 * PI)
+            values[pitch] = p = p * raw_to_rad
+            values[roll] = r = r * raw_to_rad
+            values[terrain_direction] = (values[heading] - math.atan2(r, p) + reversed_offset) % (2 * PI)
+            values[terrain_slope] = math.asin((math.sin(p) ** 2 + math.cos(p) ** 2 * math.sin(r) ** 2) ** 0.5)
+        decoder.register(None, 106, compass_handler)
+
+        adc_to_v = 528 / 624 / 1000
+        decoder.add(None, 80, '>h', [(t.position("soil_humidity"), -adc_to_v / (2.56 - 1.35) * 100,
+                                      2.56 / (2.56 - 1.35) * 100)], values)
+        decoder.add(None, 83, '>h', [(t.position("air_co2"), adc_to_v / 1.6 * 5000,
+                                      -0.4 / 1.6 * 5000)], values)
+        return decoder
 
     def loop_read(self):
+        decode = self.decoder.decode
+        telemetry = self.telemetry
+        stats = self.profiler.loop("can-read")
+        count = self.profiler.count
         for msg in self._bus:
-            if msg.arbitration_id > 1024:
-                with self.data_lock:
-                    self.available_devices[msg.arbitration_id - 1024] = True
-            if msg.arbitration_id < 1024:
-                continue
-            elif msg.arbitration_id >= 1024 + 140 and msg.arbitration_id <= 1024 + 143 and msg.data[0] == 30: # wheels encoder
-                motor = msg.arbitration_id - 1024 - 140
-                with self.msg_lock:
-                    self.messages.append(msg)
-                with self.data_lock:
-                    self.wheels[motor] = int.from_bytes(msg.data[1:5], byteorder='big', signed=True)
-                    self.battery_v[motor] = int.from_bytes(msg.data[5:7], byteorder='big', signed=True)
-            elif msg.data[0] == 28: # readings from arm encoders
-                motor = msg.arbitration_id - 1024
-                with self.data_lock:
-                    try:
-                        self.index_pulses[motor] = (msg.data[3] * 256 + msg.data[4]) / 10
-                    except Exception as e:
-                        pass
-                    self.encoders[motor] = (msg.data[1] * 256 + msg.data[2]) / 10
-            elif msg.data[0] == 106:
-                reversed_offset = 0
-                if self.rover_reversed:
-                    reversed_offset = PI
-                self.compass_heading = (list_to_int(msg.data[5:7]) * 3.14159 / 180 / 10 + reversed_offset) % (2 * PI)
-                self.compass_pitch = list_to_int(msg.data[1:3])  * 3.14159 / 180 / 10
-                self.compass_roll = list_to_int(msg.data[3:5])  * 3.14159 / 180 / 10
-                self.compass_terrain_direction = (self.compass_heading - math.atan2(self.compass_roll, self.compass_pitch) + reversed_offset) % (2 * PI)
-                self.compass_terrain_slope = math.asin((math.sin(self.compass_pitch) ** 2 + math.cos(self.compass_pitch) ** 2 * math.sin(self.compass_roll) ** 2) ** 0.5)
-            elif msg.data[0] == 80:
-                self.soil_humidity = (2.56 - list_to_int(msg.data[1:3]) * 528 / 624 / 1000) / (2.56 - 1.35) * 100
-                print(self.soil_humidity)
-            elif msg.data[0] == 83:
-                self.air_co2 =((list_to_int(msg.data[1:3]) * 528 / 624 / 1000) - 0.4) / 1.6 * 5000 #* 100 / 13.7
-            else:
-                with self.msg_lock:
-                    self.messages.append(msg)
+            with stats:
+                count("can_rx")
+                arbitration_id = msg.arbitration_id
+                if arbitration_id < 1024:
+                    continue
+                if arbitration_id > 1024 and arbitration_id - 1024 not in self.available_devices:
+                    with self.data_lock:
+                        self.available_devices[arbitration_id - 1024] = True
+                # Single writer of the telemetry record, see Telemetry
+                telemetry.begin_update()
+                try:
+                    keep = decode(arbitration_id, msg.data)
+                finally:
+                    telemetry.end_update()
+                if keep:
+                    self.messages.add(arbitration_id, msg.timestamp or time(), msg.data)
 
     @remote
     def set_pid_wheels(self, on=True, params = None):
@@ -319,38 +517,38 @@ class RoverWorker(DeviceWorker):
         self.wheels_pid = on
 
 
-    def loop_position(self):
-        sleep(1)
-        self.last_tacho = self.tacho()
-        FPS = 100
-        dt = 1.0 / FPS
-        last_clock = clock()
-        while True:
+    def update_position(self):
+        dt = 1.0 / POSITION_FPS
+        position = self.wheels
+        with self.data_lock:
+            pid = self.wheels_pid
+            target = self.wheels_target
+        with self.wheels_lock:
+            pid = pid and clock() > self.wheels_last_time_manual + 0.5
+        if pid:
+            for i in range(4):
+                error = target[i] - position[i]
+                power = self.wheels_pid_controllers[i].step(dt, error)
+                self.power(140 + i, power)
+        else:
             with self.data_lock:
-                pid = self.wheels_pid
-                position = self.wheels
-                target = self.wheels_target
-            with self.wheels_lock:
-                pid = pid and clock() > self.wheels_last_time_manual + 0.5
-            if pid:
-                for i in range(4):
-                    error = target[i] - position[i]
-                    power = self.wheels_pid_controllers[i].step(dt, error)
-                    self.power(140 + i, power)
-            else:
-                with self.data_lock:
-                    self.wheels_target = [v for v in position]
+                self.wheels_target = [v for v in position]
 
-            tacho = self.tacho()
-            dx = tacho - self.last_tacho
+        tacho = self.tacho()
+        if self.last_tacho is None:
             self.last_tacho = tacho
-            with self.data_lock:
-                heading = self.compass_heading
-                self.position = (self.position[0] + math.sin(heading) * dx, self.position[1] + math.cos(heading) * dx)
-
-            while clock() < last_clock + dt:
-                pass
-            last_clock = clock() + dt
+        dx = tacho - self.last_tacho
+        self.last_tacho = tacho
+        now = time()
+        self.odometry.predict(dx, now)
+        self.odometry_ticks += 1
+        if self.odometry_ticks % COMPASS_UPDATE_TICKS == 0:
+            self.odometry.update_heading(self.compass_heading, now)
+        if self.reach is not None:
+            fixes, fix = self.reach.get_fix()
+            if fixes != self.gps_fixes and fix != (0, 0):
+                self.gps_fixes = fixes
+                self.odometry.update_gps(fix, now)
 
     def loop_dht22(self):
         while 1:
@@ -371,48 +569,57 @@ class RoverWorker(DeviceWorker):
             except Exception as e:
                 print(e)
 
-    def loop_blink(self):
-        while True:
-            sleep(0.5)
+    def update_blink(self):
+        self.blink_state ^= 1
+        if self.blink_state:
             if self.blink == 1:
-                self.power(210, -1)
-            sleep(0.5)
-            self.power(210, 0)
+                self.set_power(210, -1)
+        else:
+            self.set_power(210, 0)
 
     @remote
     def set_blink(self, on = 1):
         self.blink = on
 
-    def loop_auto(self):
-        while True:
-            try:
-                while True:
-                    if not self.autonomy.is_running():
-                        sleep(0.5)
-                        continue
-
-                    auto_input = AutoInput(
-                        position=self.get_coordinates(),
-                        heading=self.get_orientation(),
-                        script_running=self.is_script_running()
-                    )
-
-                    with self.auto_lock:
-                        cmd_type, args = self.autonomy.get_command(auto_input)
-
-                        print(cmd_type, args)
-
-                        if cmd_type == Command.NOP:
-                            self.drive_both_axes(0.0, 0.0)
-                        elif cmd_type == Command.SET_THROTTLE_TURNING:
-                            throttle, turning = args
-                            self.drive_both_axes(throttle, turning)
-                        elif cmd_type == Command.RUN_SCRIPT:
-                            name, = args[0]
-                            self.run_script(self.script_library[name])
-                            pass
-            except Exception as e:
-                print('loop_auto(): {}'.format(str(e)))
+    def update_auto(self):
+        if not self.autonomy.is_running():
+            return
+        try:
+            auto_input = AutoInput(
+                position=self.get_coordinates(),
+                heading=self.get_orientation(),
+                script_running=self.is_script_running()
+            )
+
+            with self.auto_lock:
+                cmd_type, args = self.autonomy.get_command(auto_input)
+
+                if cmd_type == Command.NOP:
+                    self.drive_both_axes(0.0, 0.0)
+                elif cmd_type == Command.SET_THROTTLE_TURNING:
+                    throttle, turning = args
+                    self.drive_both_axes(throttle, turning)
+                elif cmd_type == Command.RUN_SCRIPT:
+                    name, = args[0]
+                    self.run_stored_script(name)
+        except Exception as e:
+            print('update_auto(): {}'.format(str(e)))
+
+    @remote
+    def get_profile(self, reset=False):
+        """ CPU usage of the threads, timing of the loops, waits for the
+        locks and CAN frames queued (can_tx) and received (can_rx), since
+        the previous reset. Each message of the b"profile" topic resets,
+        so it covers one period. See devices.profiling. """
+        profile = self.profiler.snapshot(reset)
+        profile["schedule"] = dict(self.loops.stats(reset=False), **self.slow_loops.stats(reset=False))
+        return profile
+
+    @remote
+    def loop_stats(self):
+        """ Jitter, execution time and overruns of the control loops since
+        the last call """
+        return dict(self.loops.stats(), **self.slow_loops.stats())
 
     @remote
     def auto_set_tasks(self, tasks):
@@ -450,22 +657,24 @@ class RoverWorker(DeviceWorker):
 
     @remote
     def get_coordinates(self):
-        if self.reach is not None:
-            return self.reach.get_status()
-        else:
+        """ Latitude and longitude of the estimate of update_position(),
+        (0, 0) until there is a GPS fix or a position set with fix_pos() """
+        if not self.odometry.located:
             return (0, 0)
+        return self.odometry.coordinates()
 
     @remote
     def get_orientation(self):
-        with self.data_lock:
-            o = self.compass_heading
-        return o
+        return self.compass_heading
 
     @remote
     def get_position(self, origin=relative_position_default_origin, axis=-1):
-        coords = self.get_coordinates()
-        x = (coords[1] - origin[1]) * deg * 6371000 * math.cos(coords[0] * deg)
-        y = (coords[0] - origin[0]) * deg * 6371000
+        if tuple(origin) == relative_position_default_origin:
+            x, y = self.odometry.position()
+        else:
+            coords = self.get_coordinates()
+            x = (coords[1] - origin[1]) * deg * 6371000 * math.cos(coords[0] * deg)
+            y = (coords[0] - origin[0]) * deg * 6371000
         if axis == 0:
             return x
         elif axis == 1:
@@ -476,14 +685,24 @@ class RoverWorker(DeviceWorker):
     @remote
     def abort_script(self):
         with self.script_lock:
-            self.script_stop = 1
-            self.script_code = ""
+            self.script_abort.set()
+            self.script_next = None
 
     @remote
     def run_script(self, code):
         with self.script_lock:
-            self.script_stop = 0
-            self.script_code = code
+            self.script_abort.clear()
+            self.script_next = code or None
+            self.script_ready.set()
+
+    @remote
+    def run_stored_script(self, name):
+        """ Run a script of the library, see upload_scripts() """
+        program = self.scripts.get(name)
+        with self.script_lock:
+            self.script_abort.clear()
+            self.script_next = program
+            self.script_ready.set()
 
     @remote
     def is_script_running(self):
@@ -491,127 +710,169 @@ class RoverWorker(DeviceWorker):
 
     def loop_script(self):
         while True:
-            def is_number(s):
-                try:
-                    float(s)
-                    return True
-                except ValueError:
-                    return False
-
             self.script_is_running = False
-            while True:
-                sleep(0.1)
-                with self.script_lock:
-                    code = self.script_code
-                    self.script_code = ""
-                if code != "":
-                    break
+            self.script_ready.wait()
+            with self.script_lock:
+                program = self.script_next
+                self.script_next = None
+                self.script_ready.clear()
+            if program is None:
+                continue
             self.script_is_running = True
-            lines = [line.split() for line in code.split("\n")]
-            print(lines)
-            var_dict = {}
-            functions = {}
-            code_time = 0
-            abort = False
-            start = clock()
-            for line in lines:
-                if line == []:
-                    continue
-                line_err = str(line)
-                try:
-                    first = line.pop(0)
-                    if is_number(first):
-                        code_time += float(first)
-                        while line != []:
-                            command = line.pop(0)
-                            if command == "x":
-                                args = (float(line.pop(0)) * deg, float(line.pop(0)) * deg, float(line.pop(0)) * deg, float(line.pop(0)) * deg)
-                                functions["__ik__"] = lambda args=args : self.ik(args)
-                            elif command == "a":
-                                args = (float(line.pop(0)), float(line.pop(0)), float(line.pop(0)) * deg, float(line.pop(0)) * deg)
-                                functions["__ik__"] = lambda args=args: self.ik(arm_to_axes(args))
-                            elif command == "r":
-                                args = (float(line.pop(0)), float(line.pop(0)), float(line.pop(0)), float(line.pop(0)) * deg)
-                                functions["__ik__"] = lambda args=args: self.ik(rover_to_axes(args))
-                            elif command == "apply_index":
-                                self.apply_index()
-                            else:
-                                if is_number(command):
-                                    motor = int(command)
-                                else:
-                                    motor = var_dict[command]
-                                power = float(line.pop(0))
-                                if abs(power) < 0.000001:
-                                    self.power(motor, 0)
-                                    functions[motor] = lambda: None
-                                else:
-                                    functions[motor] = lambda motor=motor, power=power: self.power(motor, power)
-
-                    else:
-                        var_dict[first] = int(line.pop(0))
-
-                    while clock() < start + code_time:  # sync with code_time
-                        for key in functions:
-                            functions[key]()
-                        towait = max(0, min(0.1, start + code_time - clock()))
-                        sleep(towait)
-                        with self.script_lock:
-                            if self.script_stop == 1:
-                                self.script_stop = 0
-                                abort = True
-                        if abort:
-                            print("abort")
-                            break
-                except Exception as e:
-                    print(str(e) + " while processing line " + line_err)
-                    break
-                if abort:
-                    break
-            abort = True
+            try:
+                if not isinstance(program, rover_script.Program):
+                    program = rover_script.compile_script(program)
+                if rover_script.run(program, self, self.script_abort, self.script_rate) is None:
+                    print("abort")
+            except Exception as e:
+                print('[rover] loop_script(): {}'.format(e))
 
     def loop_cmd_stream(self):
+        stats = self.profiler.loop("cmd-stream")
+        dispatch = {
+            MoveCommand.POWER: self.power,
+            MoveCommand.DRIVE: self.drive,
+        }
+        sock = self.cmd_socket
+        applied = {} # (command, axis) -> last value of absolute setpoints
         while True:
             try:
-                data, addr = self.cmd_socket.recvfrom(4096)
-                packet_id = struct.unpack('I', data[:4])[0]
-
-                def preceed(first, second):
-                    return ((first + 2**32 - second) % (2**32) > (2**31))
-
-                if self.last_packet_id is None:
-                    self.last_packet_id = packet_id
-                    self.packet_history.append(packet_id)
-                else:
-                    if not preceed(self.last_packet_id, packet_id):
-                        # old packet, drop
-                        continue
-                    else:
-                        self.last_packet_id = packet_id
-                        self.packet_history.append(packet_id)
-                        while (packet_id + 2**32 - self.packet_history[0]) % (2**32) >= COMMAND_ID_HISTORY:
-                            self.packet_history.popleft()
-
-                for cmd, axis, power in struct.iter_unpack('Bhf', data[4:]):
-                    cmd = MoveCommand(cmd)
-              
-                    # print('[rover] execute {}({}, {})'.format(cmd, axis, power))
-
-                    if cmd == MoveCommand.POWER:
-                        self.power(axis, power)
-                    elif cmd == MoveCommand.SERVO:
-                        self.servo(self, axis, power)
-                    elif cmd == MoveCommand.DRIVE:
-                        self.drive(axis, power)
+                packets = [sock.recvfrom(COMMAND_PACKET_MAX)]
+                # Packets queued meanwhile are executed together, see below
+                while True:
+                    try:
+                        packets.append(sock.recvfrom(COMMAND_PACKET_MAX, socket.MSG_DONTWAIT))
+                    except BlockingIOError:
+                        break
+                with stats:
+                    now = time()
+                    setpoints = {} # (command, axis) -> newest value
+                    received = 0
+                    for data, addr in packets:
+                        header = _command_header(data)
+                        if header is None:
+                            # Skipped alone, the other packets still apply
+                            self.cmd_stream_malformed += 1
+                            continue
+                        packet_id, sent, offset = header
+                        with self.cmd_stream_lock:
+                            if not self.command_received(packet_id, sent, now):
+                                continue # old packet, drop
+                            self.last_packet_sent = sent
+                            self.cmd_client = addr
+                        received += 1
+                        # Servo values are increments, all of them are applied.
+                        # Power and drive are setpoints, of which the newest
+                        # value of every axis in the packets received is the
+                        # same as executing them in order.
+                        for cmd, axis, value in COMMAND.iter_unpack(memoryview(data)[offset:]):
+                            if cmd == MoveCommand.SERVO:
+                                self.servo(axis, value)
+                            elif cmd in dispatch:
+                                setpoints[(cmd, axis)] = value
+                    if received > 1:
+                        self.cmd_stream_superseded += received - 1
+                    for key, value in setpoints.items():
+                        # Packets may repeat all setpoints, only changes and
+                        # non-zero values (as before) reach the bus
+                        if value == 0 and applied.get(key) == 0:
+                            continue
+                        applied[key] = value
+                        dispatch[key[0]](key[1], value)
             except Exception as e:
                 print('[rover] loop_cmd_stream(): {}'.format(e))
 
+    def command_received(self, packet_id, sent, now):
+        """ Account for a packet of the command stream. Returns False for
+        a packet older than the newest one received. """
+        window = self.packet_window
+        if self.last_packet_id is not None:
+            advance = (packet_id - self.last_packet_id) % 2**32
+            if advance == 0 or advance > 2**31:
+                return False
+            # Forget the ids skipped on the way to this one
+            for i in range(1, min(advance, COMMAND_ID_HISTORY)):
+                slot = (self.last_packet_id + i) % COMMAND_ID_HISTORY
+                self.packets_in_window -= window[slot]
+                window[slot] = 0
+            self.window_span = min(COMMAND_ID_HISTORY, self.window_span + advance)
+        else:
+            self.window_span = 1
+        slot = packet_id % COMMAND_ID_HISTORY
+        self.packets_in_window += 1 - window[slot]
+        window[slot] = 1
+        self.last_packet_id = packet_id
+        self.cmd_stream_packets += 1
+        if sent is not None:
+            # One-way delay including the offset of the clocks, which the
+            # minimum so far estimates, and interarrival jitter (RFC 3550)
+            delay = now - sent
+            self.cmd_stream_min_delay = min(self.cmd_stream_min_delay, delay)
+            self.cmd_stream_delay.add(delay - self.cmd_stream_min_delay)
+            if self.cmd_stream_last_delay is not None:
+                self.cmd_stream_jitter += (abs(delay - self.cmd_stream_last_delay) - self.cmd_stream_jitter) / 16
+            self.cmd_stream_last_delay = delay
+        return True
+
+    def send_cmd_report(self):
+        """ Send the newest packet id received, its time of sending and the
+        quality of the link to the client of the command stream """
+        with self.cmd_stream_lock:
+            if self.cmd_client is None:
+                return
+            report = COMMAND_REPORT.pack(self.last_packet_id, self.last_packet_sent or 0.0,
+                                         *self.cmd_stream_report(time()))
+            addr = self.cmd_client
+        self.cmd_socket.sendto(report, addr)
+
+    def cmd_stream_report(self, now):
+        """ Loss over the last COMMAND_ID_HISTORY packet ids and jitter [s],
+        also kept for status() with the histogram of the delays since the
+        previous report """
+        loss = 1 - self.packets_in_window / self.window_span if self.window_span else 0.0
+        self.cmd_stream_link = {
+            "received": self.packets_in_window / COMMAND_ID_HISTORY,
+            "loss": loss,
+            "jitter_ms": self.cmd_stream_jitter * 1000,
+            "delay": self.cmd_stream_delay.summary(sum(self.cmd_stream_delay.counts)),
+            "time": now,
+        }
+        self.cmd_stream_delay = Histogram()
+        return loss, self.cmd_stream_jitter
+
+    @remote
+    def cmd_stream_stats(self):
+        """ Packets of the command stream received, merged with newer ones
+        queued with them (superseded) and dropped for their length
+        (malformed), loss, jitter and delays above the smallest one, since
+        the last call. The delays end when the commands are handed to the
+        CAN transmitter; the time they wait there is in can_tx_stats(),
+        and both together make the delay from the client to the bus. """
+        stats = dict(self.cmd_stream_link, packets=self.cmd_stream_packets,
+                     superseded=self.cmd_stream_superseded, malformed=self.cmd_stream_malformed)
+        self.cmd_stream_packets = 0
+        self.cmd_stream_superseded = 0
+        self.cmd_stream_malformed = 0
+        return stats
+
     @remote
     def get_cmd_stream_port(self):
         return self.cmd_stream_port
 
     @remote
     def fix_pos(self, x, y):
-        self.position = (x, y)
+        """ Set the position estimate, in meters from the default origin """
+        self.odometry.set_position(x, y)
+
+    @remote
+    def get_pose(self):
+        """ (x, y, heading) of the latest estimate """
+        return self.odometry.pose
+
+    @remote
+    def get_pose_history(self, since=None):
+        """ (time, x, y, heading) of the estimates kept, after time since """
+        return self.odometry.poses(since).tolist()
 
     @remote
     def servo(self, id, move):
@@ -621,38 +882,38 @@ class RoverWorker(DeviceWorker):
         if self.servopos[id] < 500:
             self.servopos[id] = 500
         if id // 8 == 0:
-            self.send(306, [5, id % 8, int(self.servopos[id]) >> 8, int(self.servopos[id]) & 0xff])
+            self.send_setpoint(306, [5, id % 8, int(self.servopos[id]) >> 8, int(self.servopos[id]) & 0xff])
         if id // 8 == 1:
-            self.send(305, [5, id % 8, int(self.servopos[id]) >> 8, int(self.servopos[id]) & 0xff])
+            self.send_setpoint(305, [5, id % 8, int(self.servopos[id]) >> 8, int(self.servopos[id]) & 0xff])
         if id // 8 == 2:
-            self.send(307, [5, id % 8, int(self.servopos[id]) >> 8, int(self.servopos[id]) & 0xff])
+            self.send_setpoint(307, [5, id % 8, int(self.servopos[id]) >> 8, int(self.servopos[id]) & 0xff])
         if id == 101:
-            self.send(305, [5, 0, int(self.servopos[id]) >> 8, int(self.servopos[id]) & 0xff])
-            self.send(305, [5, 1, int(self.servopos[id]) >> 8, int(self.servopos[id]) & 0xff])
-            self.send(305, [5, 2, int(3000-self.servopos[id]) >> 8, int(3000-self.servopos[id]) & 0xff])
-            self.send(305, [5, 3, int(3000-self.servopos[id]) >> 8, int(3000-self.servopos[id]) & 0xff])
+            self.send_setpoint(305, [5, 0, int(self.servopos[id]) >> 8, int(self.servopos[id]) & 0xff])
+            self.send_setpoint(305, [5, 1, int(self.servopos[id]) >> 8, int(self.servopos[id]) & 0xff])
+            self.send_setpoint(305, [5, 2, int(3000-self.servopos[id]) >> 8, int(3000-self.servopos[id]) & 0xff])
+            self.send_setpoint(305, [5, 3, int(3000-self.servopos[id]) >> 8, int(3000-self.servopos[id]) & 0xff])
         if id == 100:
-            self.send(305, [5, 4, int(self.servopos[id]) >> 8, int(self.servopos[id]) & 0xff])
-            self.send(305, [5, 5, int(self.servopos[id]) >> 8, int(self.servopos[id]) & 0xff])
+            self.send_setpoint(305, [5, 4, int(self.servopos[id]) >> 8, int(self.servopos[id]) & 0xff])
+            self.send_setpoint(305, [5, 5, int(self.servopos[id]) >> 8, int(self.servopos[id]) & 0xff])
 
 
 
     @remote
     def servo_pos(self, id, pos):
         if id // 8 == 0:
-            self.send(306, [5, id % 8, int(pos) >> 8, int(pos) & 0xff])
+            self.send_setpoint(306, [5, id % 8, int(pos) >> 8, int(pos) & 0xff])
         if id // 8 == 1:
-            self.send(305, [5, id % 8, int(pos) >> 8, int(pos) & 0xff])
+            self.send_setpoint(305, [5, id % 8, int(pos) >> 8, int(pos) & 0xff])
         if id // 8 == 2:
-            self.send(307, [5, id % 8, int(pos) >> 8, int(pos) & 0xff])
+            self.send_setpoint(307, [5, id % 8, int(pos) >> 8, int(pos) & 0xff])
         if id == 101:
-            self.send(305, [5, 0, int(pos) >> 8, int(pos) & 0xff])
-            self.send(305, [5, 1, int(pos) >> 8, int(pos) & 0xff])
-            self.send(305, [5, 2, int(3000 - pos) >> 8, int(3000 - pos) & 0xff])
-            self.send(305, [5, 3, int(3000 - pos) >> 8, int(3000 - pos) & 0xff])
+            self.send_setpoint(305, [5, 0, int(pos) >> 8, int(pos) & 0xff])
+            self.send_setpoint(305, [5, 1, int(pos) >> 8, int(pos) & 0xff])
+            self.send_setpoint(305, [5, 2, int(3000 - pos) >> 8, int(3000 - pos) & 0xff])
+            self.send_setpoint(305, [5, 3, int(3000 - pos) >> 8, int(3000 - pos) & 0xff])
         if id == 100:
-            self.send(305, [5, 4, int(pos) >> 8, int(pos) & 0xff])
-            self.send(305, [5, 5, int(pos) >> 8, int(pos) & 0xff])
+            self.send_setpoint(305, [5, 4, int(pos) >> 8, int(pos) & 0xff])
+            self.send_setpoint(305, [5, 5, int(pos) >> 8, int(pos) & 0xff])
 
     @remote
     def servos(self):
@@ -669,8 +930,7 @@ class RoverWorker(DeviceWorker):
             print(i, data)
             d0 = float(data[0])
             d2 = float(data[2])
-            with self.data_lock:
-                a = (math.atan2(d0, d2) + self.compass_heading) % (2 * PI)
+            a = (math.atan2(d0, d2) + self.compass_heading) % (2 * PI)
             r = (d0 ** 2 + d2 ** 2) ** 0.5
             print(a, r, i)
             list[int(i)] = (a, r)
@@ -678,9 +938,9 @@ class RoverWorker(DeviceWorker):
 
     @remote
     def slope_points(self):
-        with self.data_lock:
-            slope = self.compass_terrain_slope
-            direction = self.compass_terrain_direction
+        t = self.telemetry.snapshot()
+        slope = t["compass_terrain_slope"]
+        direction = t["compass_terrain_direction"]
         if slope > 12 / 180 * PI:
             return([(t[0], t[1]) for t in slopepoints if abs((t[2] - direction + PI) % (2 * PI) - PI) < PI / 6])
         else:
@@ -688,12 +948,25 @@ class RoverWorker(DeviceWorker):
 
     @remote
     def tacho(self):
-        with self.data_lock:
-            return 0.5 * (self.wheels[1] - self.wheels[3]) / erpm_per_meter
+        wheels = self.telemetry.snapshot()["wheels"]
+        return 0.5 * (wheels[1] - wheels[3]) / erpm_per_meter
 
     @remote
     def send(self, id, data):
-        self._bus.send(can.Message(arbitration_id=id, data = data, extended_id = False))
+        self.profiler.count("can_tx")
+        self.transmitter.send(can.Message(arbitration_id=id, data = data, is_extended_id = False))
+
+    def send_setpoint(self, id, data, priority=can_transmit.NORMAL):
+        """ Like send(), but a frame still waiting for the bus is replaced
+        by a newer one for the same node, opcode and channel (data[1]) """
+        self.profiler.count("can_tx")
+        self.transmitter.send(can.Message(arbitration_id=id, data = data, is_extended_id = False),
+                              key=(id, data[0], data[1] if data[0] == 5 else None), priority=priority)
+
+    @remote
+    def can_tx_stats(self):
+        """ Depth of the transmit queue and send latency since the last call """
+        return self.transmitter.stats()
 
     @remote
     def start_ik(self):
@@ -713,10 +986,13 @@ class RoverWorker(DeviceWorker):
             if a >= 3600:
                 a = 3599
             self.send(motor, [38, a >> 8, a & 0xff])
-        set(arm_lower, self.encoders[arm_lower] + 153.8 + 7.3 - self.index_pulses[arm_lower])
-        set(arm_upper, self.encoders[arm_upper] + 117.7 - 2.4 - self.index_pulses[arm_upper])
-        set(grip_lat, self.encoders[grip_lat] + 152.0 - 3.2 - self.index_pulses[grip_lat])
-        set(arm_rot, self.encoders[arm_rot] + 300 - self.index_pulses[arm_rot])
+        t = self.telemetry.snapshot()
+        encoders = _arm_dict(t["encoders"])
+        index_pulses = _arm_dict(t["index_pulses"])
+        set(arm_lower, encoders[arm_lower] + 153.8 + 7.3 - index_pulses[arm_lower])
+        set(arm_upper, encoders[arm_upper] + 117.7 - 2.4 - index_pulses[arm_upper])
+        set(grip_lat, encoders[grip_lat] + 152.0 - 3.2 - index_pulses[grip_lat])
+        set(arm_rot, encoders[arm_rot] + 300 - index_pulses[arm_rot])
 
     @remote
     def get_encoders(self):
@@ -738,22 +1014,15 @@ class RoverWorker(DeviceWorker):
     def ik(self, params): # execute given goal angles - send to motor drivers
         if len(params) == 4:
             outa, outb, outc, outd = [int((v % (2 * PI)) * 1800 / PI) for v in params]
-            self._bus.send(can.Message(arbitration_id=int(arm_lower),
-                                         data=[8, (outa >> 8) & 0xff, outa & 0xff], extended_id=False))
-            self._bus.send(can.Message(arbitration_id=int(arm_upper),
-                                         data=[8, (outb >> 8) & 0xff, outb & 0xff], extended_id=False))
-            self._bus.send(can.Message(arbitration_id=int(grip_lat),
-                                         data=[8, (outc >> 8) & 0xff, outc & 0xff], extended_id=False))
-            self._bus.send(can.Message(arbitration_id=int(arm_rot),
-                                         data=[8, (outd >> 8) & 0xff, outd & 0xff], extended_id=False))
+            self.send_setpoint(int(arm_lower), [8, (outa >> 8) & 0xff, outa & 0xff])
+            self.send_setpoint(int(arm_upper), [8, (outb >> 8) & 0xff, outb & 0xff])
+            self.send_setpoint(int(grip_lat), [8, (outc >> 8) & 0xff, outc & 0xff])
+            self.send_setpoint(int(arm_rot), [8, (outd >> 8) & 0xff, outd & 0xff])
         else: # without arm rotation
             outa, outb, outc = [int((v % (2 * PI)) * 1800 / PI) for v in params]
-            self._bus.send(can.Message(arbitration_id=int(arm_lower),
-                                         data=[8, (outa >> 8) & 0xff, outa & 0xff], extended_id=False))
-            self._bus.send(can.Message(arbitration_id=int(arm_upper),
-                                         data=[8, (outb >> 8) & 0xff, outb & 0xff], extended_id=False))
-            self._bus.send(can.Message(arbitration_id=int(grip_lat),
-                                         data=[8, (outc >> 8) & 0xff, outc & 0xff], extended_id=False))
+            self.send_setpoint(int(arm_lower), [8, (outa >> 8) & 0xff, outa & 0xff])
+            self.send_setpoint(int(arm_upper), [8, (outb >> 8) & 0xff, outb & 0xff])
+            self.send_setpoint(int(grip_lat), [8, (outc >> 8) & 0xff, outc & 0xff])
     @remote
     def ik_arm(self, params):
         print(params)
@@ -767,6 +1036,10 @@ class RoverWorker(DeviceWorker):
     @remote
     def power(self, id, power):
         power = float(power)
+        self.failsafe.feed(id, power)
+        self.set_power(id, power)
+
+    def set_power(self, id, power):
         if id >= 2000 and id <= 2001:
             self.ik_speed[id - 2000] = power
         elif id >= 2002 and id <= 2003:
@@ -779,14 +1052,47 @@ class RoverWorker(DeviceWorker):
             out = round((2 ** 15 - 1) * power)
             if out < 0:
                    out += 2 ** 16
-            self._bus.send(can.Message(arbitration_id=int(id), data=[7, out >> 8, out & 0xff], extended_id=False))
+            # Stops overtake setpoints waiting in the queue
+            priority = can_transmit.HIGH if out == 0 else can_transmit.NORMAL
+            self.send_setpoint(int(id), [7, out >> 8, out & 0xff], priority)
 
     @remote
     def update_script_library(self, library):
-        self.script_library = library
+        """ Replace the library with {name: code} """
+        errors = self.upload_scripts(library)
+        self.remove_scripts([name for name in self.scripts.manifest() if name not in library])
+        for name, error in errors.items():
+            print('[rover] script {}: {}'.format(name, error))
+
+    @remote
+    def script_manifest(self):
+        """ {name: digest} of the library, see rover_script.script_digest() """
+        return self.scripts.manifest()
+
+    @remote
+    def upload_scripts(self, scripts):
+        """ Compile and store {name: code} in the library. Returns the
+        errors {name: message} of the scripts rejected, which are removed. """
+        errors = {}
+        for name, code in scripts.items():
+            try:
+                self.scripts.put(name, code)
+            except rover_script.ScriptError as e:
+                errors[name] = str(e)
+        return errors
+
+    @remote
+    def remove_scripts(self, names):
+        for name in names:
+            self.scripts.remove(name)
 
     @remote
     def drive(self, axis, power):
+        if axis in (0, 1):
+            self.failsafe.feed(DRIVE_AXES[axis], power)
+        self.set_drive(axis, power)
+
+    def set_drive(self, axis, power):
         # print("drive")
         if axis == 0:  # throttle
             self.throttle = power
@@ -800,12 +1106,24 @@ class RoverWorker(DeviceWorker):
         right = -self.throttle + self.turning
 
         if not self.rover_reversed:
-            self.power(129, left)
-            self.power(130, right)
+            self.set_power(129, left)
+            self.set_power(130, right)
+        else:
+            self.set_power(130, left)
+            self.set_power(129, right)
+
+
+    def failsafe_apply(self, axis, value):
+        if axis in DRIVE_AXES:
+            self.set_drive(DRIVE_AXES.index(axis), value)
         else:
-            self.power(130, left)
-            self.power(129, right)
+            self.set_power(axis, value)
 
+    @remote
+    def failsafe_stats(self):
+        """ Seconds left before each axis commanded is ramped down and
+        number of times each axis has timed out """
+        return self.failsafe.stats()
 
     @remote
     def drive_both_axes(self, throttle, turning):
@@ -971,7 +1289,8 @@ class Rover(DeviceOverZeroMQ):
             
         # Following lines "turn on" the widget operation
         #self.increaseVoltageButton.clicked.connect(lambda pressed: self.incVoltage())
-        self.createListenerThread(self.updateSlot)
+        # Only the newest status is worth rendering
+        self.createListenerThread(self.updateSlot, conflate=True, max_rate=20)
 
     def lock_pid(self):
         if self.pid_locked:
@@ -1001,7 +1320,9 @@ class Rover(DeviceOverZeroMQ):
         self.edit_position_y.setText(str(round(status["position"][1], 2)))
         self.edit_position_lon.setText(str(round(status["coordinates"][0], 6)))
         self.edit_position_lat.setText(str(round(status["coordinates"][1], 6)))
-        self.cmd_stream_quality.setText(str(status['cmd_stream_quality']))
+        quality = status['cmd_stream_quality']
+        self.cmd_stream_quality.setText("received {:.0%}, loss {:.0%}, jitter {:.1f} ms".format(
+            quality["received"], quality["loss"], quality["jitter_ms"]))
 
         for i in range(4):
             self.editswheels[i].setText(str(status["wheels"][i]))
@@ -1016,7 +1337,9 @@ class Rover(DeviceOverZeroMQ):
         #print(status["encoders"][str(arm_upper)])
         #print(status["encoders"][str(grip_lat)])
         try:
-            self.arm_widget.set_angles([status["encoders"][str(arm_lower)] * deg, status["encoders"][str(arm_upper)] * deg, status["encoders"][str(grip_lat)] * deg])
+            # keys are strings with JSON codecs and integers with msgpack
+            encoders = {str(k): v for k, v in status["encoders"].items()}
+            self.arm_widget.set_angles([encoders[str(arm_lower)] * deg, encoders[str(arm_upper)] * deg, encoders[str(grip_lat)] * deg])
         except Exception as e:
             print(str(e))
 
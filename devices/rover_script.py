@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+Scripts of timed arm and motor commands, see IKScripterWidget:
+
+    clamp 193                   name motor 193
+    2 a 600 200 90 180 clamp -1 commands, then wait 2 s
+
+A line starting with a time [s] gives commands, which take effect at once,
+and then waits that time. Commands are
+    <motor> <power>             power of a motor, by number or name,
+    x <lower> <upper> <lat> <rot>   IK target of the arm axes [deg],
+    a <h> <v> <lat> <rot>       IK target in arm coordinates [mm, deg],
+    r <x> <y> <z> <lat>         IK target in rover coordinates [mm, deg],
+    apply_index                 calibrate the encoders with the index pulses.
+Non-zero powers and the IK target are emitted repeatedly while waiting,
+until they are replaced. A power of zero is sent once.
+
+compile_script() turns a script into a Program: a tuple of instructions
+with the names resolved, numbers parsed and IK targets converted to axes.
+Programs are cached by the hash of the text. run() executes a program
+against absolute deadlines from its start.
+
+A ScriptStore keeps a library of named scripts, each compiled once when
+stored. Its manifest maps names to the hashes of their text, so a client
+can send only the scripts which have changed.
+"""
+
+import hashlib
+import math
+import threading
+from collections import OrderedDict
+from time import perf_counter as clock
+
+from devices.ik import arm_to_axes, rover_to_axes
+
+# Instructions are tuples (opcode, argument)
+WAIT = 0 # time of the end of the wait since the start [s]
+POWER = 1 # (motor, power)
+STOP = 2 # motor
+IK = 3 # target (lower, upper, lat, rot) [rad]
+APPLY_INDEX = 4 # None
+
+CACHE_SIZE = 64
+ZERO_POWER = 0.000001
+
+
+class ScriptError(Exception):
+    def __init__(self, line, message):
+        super().__init__("line {}: {}".format(line, message))
+        self.line = line
+
+
+class Program:
+    __slots__ = ('digest', 'instructions', 'duration')
+
+    def __init__(self, digest, instructions, duration):
+        self.digest = digest
+        self.instructions = instructions
+        self.duration = duration
+
+
+def _is_number(token):
+    try:
+        float(token)
+        return True
+    except ValueError:
+        return False
+
+
+def _ik_target(command, args):
+    rad = math.radians
+    if command == "x":
+        return tuple(rad(v) for v in args)
+    if command == "a":
+        return arm_to_axes((args[0], args[1], rad(args[2]), rad(args[3])))
+    return rover_to_axes((args[0], args[1], args[2], rad(args[3])))
+
+
+def _compile(code, digest):
+    instructions = []
+    names = {}
+    elapsed = 0.0
+    for number, line in enumerate(code.split("\n"), 1):
+        tokens = line.split()
+        if not tokens:
+            continue
+        try:
+            if not _is_number(tokens[0]):
+                names[tokens[0]] = int(tokens[1])
+                continue
+            elapsed += float(tokens[0])
+            i = 1
+            while i < len(tokens):
+                command = tokens[i]
+                if command in ("x", "a", "r"):
+                    args = [float(v) for v in tokens[i + 1:i + 5]]
+                    if len(args) < 4:
+                        raise IndexError("4 values expected")
+                    instructions.append((IK, _ik_target(command, args)))
+                    i += 5
+                elif command == "apply_index":
+                    instructions.append((APPLY_INDEX, None))
+                    i += 1
+                else:
+                    motor = int(command) if _is_number(command) else names[command]
+                    power = float(tokens[i + 1])
+                    if abs(power) < ZERO_POWER:
+                        instructions.append((STOP, motor))
+                    else:
+                        instructions.append((POWER, (motor, power)))
+                    i += 2
+            instructions.append((WAIT, elapsed))
+        except KeyError as e:
+            raise ScriptError(number, "unknown motor {}".format(e)) from None
+        except (IndexError, ValueError, ZeroDivisionError) as e:
+            raise ScriptError(number, "{} in {!r}".format(str(e) or "missing value", line.strip())) from None
+    return Program(digest, tuple(instructions), elapsed)
+
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def script_digest(code):
+    """ Hash of a script text, as a hex string """
+    return hashlib.blake2b(code.encode(), digest_size=16).hexdigest()
+
+
+def compile_script(code):
+    """ Program of a script text. Raises ScriptError for a line which
+    cannot be parsed or an IK target out of reach. """
+    digest = script_digest(code)
+    with _cache_lock:
+        program = _cache.get(digest)
+        if program is not None:
+            _cache.move_to_end(digest)
+            return program
+    program = _compile(code, digest)
+    with _cache_lock:
+        _cache[digest] = program
+        if len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return program
+
+
+def run(program, target, abort, rate=10.0):
+    """ Execute a program with target.power(motor, power), target.ik(axes)
+    and target.apply_index(). Powers and the IK target in effect are
+    emitted rate times per second while waiting. Stops early when the
+    threading.Event abort is set. Returns the largest lateness [s] of a
+    deadline, or None if aborted. """
+    period = 1.0 / rate
+    active = OrderedDict() # motor or "ik" -> value, emitted in the order set
+    start = clock()
+    late = 0.0
+    for opcode, arg in program.instructions:
+        if opcode == WAIT:
+            deadline = start + arg
+            now = clock()
+            if now > deadline:
+                late = max(late, now - deadline)
+                continue
+            emit = now
+            while True:
+                if now >= emit:
+                    for key, value in active.items():
+                        if key == "ik":
+                            target.ik(value)
+                        else:
+                            target.power(key, value)
+                    emit += period
+                    if emit <= now: # emitting took longer than a period
+                        emit = now + period
+                if abort.wait(min(emit, deadline) - now):
+                    return None
+                now = clock()
+                if now >= deadline:
+                    late = max(late, now - deadline)
+                    break
+        elif opcode == POWER:
+            motor, power = arg
+            active[motor] = power
+        elif opcode == STOP:
+            active.pop(arg, None)
+            target.power(arg, 0)
+        elif opcode == IK:
+            active["ik"] = arg
+        elif opcode == APPLY_INDEX:
+            target.apply_index()
+    return late
+
+
+class ScriptStore:
+    """ Compiled scripts by name. A text shared by several names is
+    stored and compiled once. Safe to use from several threads. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.names = {} # name -> digest
+        self.programs = {} # digest -> (code, Program)
+
+    def manifest(self):
+        """ {name: digest} of the scripts stored """
+        with self.lock:
+            return dict(self.names)
+
+    def put(self, name, code):
+        """ Compile and store a script, returns its digest. Raises
+        ScriptError, after removing the script of that name. """
+        digest = script_digest(code)
+        with self.lock:
+            stored = self.programs.get(digest)
+        if stored is None:
+            try:
+                stored = (code, compile_script(code))
+            except ScriptError:
+                self.remove(name)
+                raise
+        with self.lock:
+            self.programs.setdefault(digest, stored)
+            previous = self.names.get(name)
+            self.names[name] = digest
+            self._release(previous)
+        return digest
+
+    def remove(self, name):
+        with self.lock:
+            self._release(self.names.pop(name, None))
+
+    def _release(self, digest):
+        if digest is not None and digest not in self.names.values():
+            del self.programs[digest]
+
+    def get(self, name):
+        """ Program of a script, raises KeyError if there is none """
+        with self.lock:
+            return self.programs[self.names[name]][1]
+
+    def code(self, name):
+        """ Text of a script, raises KeyError if there is none """
+        with self.lock:
+            return self.programs[self.names[name]][0]
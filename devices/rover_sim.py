@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+"""
+Simulation of the rover hardware, for running RoverWorker without it.
+
+RoverModel holds the state of the modules on the bus and integrates simple
+kinematics: the wheels follow their power setpoints with a first-order lag
+and move the rover as a differential drive, the arm joints move towards
+their position setpoints at a constant speed. SimulatedBus is a can.BusABC
+which applies the frames sent to it to the model and produces the frames
+of the real modules at the configured rates:
+    - wheels: opcode 30 from modules 140-143 (tacho and battery voltage),
+    - arm: opcode 28 from motors 188, 190, 195, 196 (encoders),
+    - compass: opcode 106 (pitch, roll, heading),
+    - sensors: opcodes 80 and 83 (soil humidity, CO2).
+NmeaServer streams the position of the model as NMEA GGA sentences over
+TCP, like the Reach GPS receiver.
+
+Enabled with the `simulate` parameter of the rover in devices.yaml:
+    params:
+      simulate:
+        max_speed: 1.5
+        rates: {wheels: 100, compass: 50}
+"""
+
+import math
+import random
+import socket
+import threading
+import time
+from collections import deque
+
+try:
+    import can
+    _BusABC = can.BusABC
+except ImportError:
+    can = None
+    _BusABC = object
+
+
+LEFT_SIDE = 129
+RIGHT_SIDE = 130
+WHEEL_MODULES = (140, 141, 142, 143) # 140, 141 on the left
+ARM_MOTORS = (188, 190, 195, 196)
+COMPASS_NODE = 150 # ids of the simulated compass and sensor boards, any id is decoded
+SENSOR_NODE = 151
+
+default_rates = {"wheels": 100.0, "arm": 20.0, "compass": 20.0, "sensors": 1.0}
+
+EARTH_RADIUS = 6371000
+
+
+class RoverModel:
+    """ State of the simulated rover. Positions are in meters east (x) and
+    north (y) of the start, the heading in radians clockwise from north. """
+
+    def __init__(self, max_speed=1.0, track=0.9, wheel_lag=0.2, arm_speed=30.0,
+                 erpm_per_meter=600 / 1.568, battery_voltage=24.0, battery_drain=0.001,
+                 heading=0.0, pitch=0.0, roll=0.0, compass_noise=0.0,
+                 soil_raw=1800, co2_raw=900):
+        self.max_speed = max_speed # [m/s] at full power
+        self.track = track # [m] between left and right wheels
+        self.wheel_lag = wheel_lag # [s] time constant of the wheel speed
+        self.arm_speed = arm_speed # [deg/s] of the arm joints
+        self.erpm_per_meter = erpm_per_meter
+        self.battery_drain = battery_drain # [V/s] at full power of all wheels
+        self.pitch = pitch # [rad]
+        self.roll = roll # [rad]
+        self.compass_noise = compass_noise # [rad] standard deviation
+        self.soil_raw = soil_raw
+        self.co2_raw = co2_raw
+        self.lock = threading.Lock()
+        self.time = time.monotonic()
+        self.x = 0.0
+        self.y = 0.0
+        self.heading = heading
+        self.battery = battery_voltage
+        self.wheel_power = dict.fromkeys(WHEEL_MODULES, 0.0)
+        self.wheel_speed = dict.fromkeys(WHEEL_MODULES, 0.0) # [m/s] forward for the motor
+        self.tacho = dict.fromkeys(WHEEL_MODULES, 0.0) # [erpm revolutions]
+        self.arm_angle = dict.fromkeys(ARM_MOTORS, 180.0) # [deg]
+        self.arm_target = dict.fromkeys(ARM_MOTORS, None)
+        self.arm_power = dict.fromkeys(ARM_MOTORS, 0.0)
+        self.servos = {}
+        self.received = 0
+
+    def advance(self, now):
+        """ Integrate the state up to time now (time.monotonic()) """
+        dt = now - self.time
+        if dt <= 0:
+            return
+        self.time = now
+        alpha = 1 - math.exp(-dt / self.wheel_lag) if self.wheel_lag > 0 else 1.0
+        for module in WHEEL_MODULES:
+            target = self.wheel_power[module] * self.max_speed
+            self.wheel_speed[module] += (target - self.wheel_speed[module]) * alpha
+            self.tacho[module] += self.wheel_speed[module] * dt * self.erpm_per_meter
+        # Motors on the right are mounted the other way round
+        left = (self.wheel_speed[140] + self.wheel_speed[141]) / 2
+        right = -(self.wheel_speed[142] + self.wheel_speed[143]) / 2
+        speed = (left + right) / 2
+        heading = self.heading + dt * (left - right) / self.track
+        self.x += math.sin(heading) * speed * dt
+        self.y += math.cos(heading) * speed * dt
+        self.heading = heading % (2 * math.pi)
+        load = sum(abs(p) for p in self.wheel_power.values()) / len(self.wheel_power)
+        self.battery -= load * self.battery_drain * dt
+
+        step = self.arm_speed * dt
+        for motor in ARM_MOTORS:
+            target = self.arm_target[motor]
+            if target is None:
+                angle = self.arm_angle[motor] + self.arm_power[motor] * step
+            else:
+                delta = (target - self.arm_angle[motor] + 180) % 360 - 180
+                angle = self.arm_angle[motor] + max(-step, min(step, delta))
+            self.arm_angle[motor] = angle % 360
+
+    def command(self, arbitration_id, data):
+        """ Apply a frame sent to the modules """
+        self.received += 1
+        if not data:
+            return
+        opcode = data[0]
+        if opcode == 7 and len(data) >= 3: # power
+            power = int.from_bytes(bytes(data[1:3]), 'big', signed=True) / (2 ** 15 - 1)
+            if arbitration_id == LEFT_SIDE:
+                self.wheel_power[140] = self.wheel_power[141] = power
+            elif arbitration_id == RIGHT_SIDE:
+                self.wheel_power[142] = self.wheel_power[143] = power
+            elif arbitration_id in self.wheel_power:
+                self.wheel_power[arbitration_id] = power
+            elif arbitration_id in self.arm_power:
+                self.arm_power[arbitration_id] = power
+                self.arm_target[arbitration_id] = None
+        elif opcode == 8 and len(data) >= 3 and arbitration_id in self.arm_target: # position
+            self.arm_target[arbitration_id] = ((data[1] << 8) | data[2]) / 10
+        elif opcode == 38 and len(data) >= 3 and arbitration_id in self.arm_angle: # set encoder
+            self.arm_angle[arbitration_id] = ((data[1] << 8) | data[2]) / 10
+            self.arm_target[arbitration_id] = None
+            self.arm_power[arbitration_id] = 0.0
+        elif opcode == 5 and len(data) >= 4: # servo
+            self.servos[(arbitration_id, data[1])] = (data[2] << 8) | data[3]
+
+    def frames(self, stream):
+        """ (arbitration id, data) of the frames of a stream """
+        if stream == "wheels":
+            battery = max(0, min(32767, round(self.battery * 10)))
+            return [(1024 + m, b'\x1e' + (int(self.tacho[m]) & 0xffffffff).to_bytes(4, 'big')
+                     + battery.to_bytes(2, 'big')) for m in WHEEL_MODULES]
+        if stream == "arm":
+            return [(1024 + m, bytes([28]) + int(self.arm_angle[m] * 10).to_bytes(2, 'big')
+                     + (0).to_bytes(2, 'big')) for m in ARM_MOTORS]
+        if stream == "compass":
+            heading = self.heading + random.gauss(0, self.compass_noise) if self.compass_noise else self.heading
+            raw = [round(math.degrees(v) * 10) for v in (self.pitch, self.roll)]
+            raw.append(round(math.degrees(heading % (2 * math.pi)) * 10) % 3600)
+            return [(1024 + COMPASS_NODE, bytes([106]) + b''.join(
+                v.to_bytes(2, 'big', signed=True) for v in raw))]
+        if stream == "sensors":
+            return [(1024 + SENSOR_NODE, bytes([80]) + self.soil_raw.to_bytes(2, 'big', signed=True)),
+                    (1024 + SENSOR_NODE, bytes([83]) + self.co2_raw.to_bytes(2, 'big', signed=True))]
+        raise KeyError(stream)
+
+    def coordinates(self, origin):
+        """ (latitude, longitude) in degrees of the position """
+        latitude = origin[0] + math.degrees(self.y / EARTH_RADIUS)
+        longitude = origin[1] + math.degrees(self.x / (EARTH_RADIUS * math.cos(math.radians(origin[0]))))
+        return latitude, longitude
+
+
+class SimulatedBus(_BusABC):
+    """ A bus connected to a RoverModel only. recv() waits for the next frame
+    due from the model, send() applies the frame to it. """
+
+    def __init__(self, channel="sim", model=None, rates=None, **kwargs):
+        super().__init__(channel=channel, **kwargs)
+        self.channel_info = "simulated rover"
+        self.model = model if model is not None else RoverModel()
+        self.periods = {stream: 1.0 / rate for stream, rate in dict(default_rates, **(rates or {})).items() if rate}
+        now = time.monotonic()
+        self._due = dict.fromkeys(self.periods, now)
+        self._queue = deque()
+
+    def _recv_internal(self, timeout):
+        if not self._queue:
+            stream = min(self._due, key=self._due.get)
+            due = self._due[stream]
+            now = time.monotonic()
+            if due > now:
+                if timeout is not None and due - now > timeout:
+                    time.sleep(timeout)
+                    return None, False
+                time.sleep(due - now)
+            # Periods missed while nobody was reading are skipped
+            self._due[stream] = max(due + self.periods[stream], now)
+            with self.model.lock:
+                self.model.advance(max(due, now))
+                frames = self.model.frames(stream)
+            timestamp = time.time()
+            for arbitration_id, data in frames:
+                self._queue.append(can.Message(timestamp=timestamp, arbitration_id=arbitration_id,
+                                               is_extended_id=False, data=data))
+        return self._queue.popleft(), False
+
+    def send(self, msg, timeout=None):
+        with self.model.lock:
+            self.model.advance(time.monotonic())
+            self.model.command(msg.arbitration_id, msg.data)
+
+
+def _nmea(sentence):
+    checksum = 0
+    for c in sentence.encode('ascii'):
+        checksum ^= c
+    return "${}*{:02X}\r\n".format(sentence, checksum)
+
+
+def _nmea_angle(value, digits):
+    minutes = abs(value) % 1 * 60
+    return "{:0{}d}{:09.6f}".format(int(abs(value)), digits, minutes)
+
+
+class NmeaServer:
+    """ Sends GGA sentences with the position of `model` to every client
+    connected to (host, port), `rate` times per second. Port 0 picks a free
+    port, see `address`. """
+
+    def __init__(self, model, origin, host="127.0.0.1", port=0, rate=5.0):
+        self.model = model
+        self.origin = origin
+        self.period = 1.0 / rate
+        self.running = True
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind((host, port))
+        self._server.listen()
+        self.address = self._server.getsockname()
+        self._clients = []
+        self._thread = threading.Thread(target=self._loop, name="nmea-sim", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def sentence(self):
+        with self.model.lock:
+            self.model.advance(time.monotonic())
+            latitude, longitude = self.model.coordinates(self.origin)
+        return _nmea("GPGGA,{},{},{},{},{},4,12,0.8,100.0,M,0.0,M,,".format(
+            time.strftime("%H%M%S.00", time.gmtime()),
+            _nmea_angle(latitude, 2), "N" if latitude >= 0 else "S",
+            _nmea_angle(longitude, 3), "E" if longitude >= 0 else "W"))
+
+    def _loop(self):
+        deadline = time.monotonic()
+        while self.running:
+            self._server.settimeout(max(0.001, deadline - time.monotonic()))
+            try:
+                client, _ = self._server.accept()
+                self._clients.append(client)
+                continue
+            except socket.timeout:
+                pass
+            deadline += self.period
+            data = self.sentence().encode('ascii')
+            for client in list(self._clients):
+                try:
+                    client.sendall(data)
+                except OSError:
+                    self._clients.remove(client)
+                    client.close()
+        self._server.close()
+        for client in self._clients:
+            client.close()
+
+
+class Simulator:
+    """ A RoverModel with its bus and GPS stream. Keyword arguments other
+    than the ones below set the physics, see RoverModel. """
+
+    def __init__(self, rates=None, origin=(0.0, 0.0), nmea_port=0, nmea_rate=5.0, **physics):
+        self.model = RoverModel(**physics)
+        self.bus = SimulatedBus(model=self.model, rates=rates)
+        self.nmea = NmeaServer(self.model, origin, port=nmea_port, rate=nmea_rate)
+
+    @property
+    def nmea_address(self):
+        return self.nmea.address
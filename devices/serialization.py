@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+Serialization of messages exchanged between workers and front-ends.
+
+A message is a list of ZeroMQ frames: a header followed by one raw frame per
+numpy array contained in the object. The header is JSON unless the first
+frame is a codec tag (e.g. b'msgpack'), so a message without arrays encoded
+with a JSON codec is identical to the legacy single-frame format.
+
+Published messages of a tagged codec go out on a topic of their own, see
+codec_topic(), so subscribers which cannot decode it keep receiving JSON.
+
+Available codecs:
+    json    - standard library, always present
+    orjson  - faster JSON encoder/decoder, same bytes on the wire as json
+    msgpack - compact binary format, tagged on the wire
+"""
+
+import base64
+import json
+
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class ArrayEncoder(json.JSONEncoder):
+    """ JSON encoder aware of numpy arrays.
+
+    By default arrays are embedded in the text as base64 strings (the legacy
+    format). If a list is passed as `frames`, raw arrays are appended to it
+    instead and only their dtype, shape and frame number are left in the
+    text. """
+    def __init__(self, *args, frames=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.frames = frames
+
+    def default(self, obj):
+        if isinstance(obj, np.ndarray):
+            if self.frames is None:
+                return {"dtype": obj.dtype.str,
+                        "shape": obj.shape,
+                        "data": base64.b64encode(obj.tobytes()).decode('ascii')}
+            return _array_reference(obj, self.frames)
+        if isinstance(obj, np.generic):
+            return obj.item()
+        # Let the base class default method raise the TypeError
+        return json.JSONEncoder.default(self, obj)
+
+def array_object_hook(d, frames=()):
+    if "dtype" not in d or "shape" not in d:
+        return d
+    try:
+        if "frame" in d:
+            a = _array_from_frame(frames[d["frame"]], d["dtype"])
+        else:
+            a = np.frombuffer(base64.standard_b64decode(d["data"]),
+                              dtype=d["dtype"])
+        return a.reshape(d["shape"])
+    except:
+        return d
+
+def _array_reference(a, frames):
+    frames.append(np.ascontiguousarray(a))
+    # Frame 0 is the header
+    return {"dtype": a.dtype.str, "shape": a.shape, "frame": len(frames)}
+
+def _array_from_frame(frame, dtype):
+    # np.frombuffer shares memory with the received zmq.Frame,
+    # so the resulting array is read-only
+    return np.frombuffer(getattr(frame, 'buffer', frame), dtype=dtype)
+
+def _restore_arrays(obj, frames):
+    """ object_hook applied after the fact, for decoders which lack one """
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            if isinstance(value, (dict, list)):
+                obj[key] = _restore_arrays(value, frames)
+        return array_object_hook(obj, frames)
+    if isinstance(obj, list):
+        for i, value in enumerate(obj):
+            if isinstance(value, (dict, list)):
+                obj[i] = _restore_arrays(value, frames)
+    return obj
+
+
+class JsonCodec:
+    name = 'json'
+    tag = None
+
+    def encode(self, obj, frames):
+        return json.dumps(obj, cls=ArrayEncoder, frames=frames).encode('ascii')
+
+    def decode(self, data, frames):
+        # Walking the decoded object costs more than parsing it, so skip
+        # that when the text cannot contain any array
+        has_arrays = b'"dtype"' in data
+        if orjson is not None:
+            try:
+                obj = orjson.loads(data)
+                return _restore_arrays(obj, frames) if has_arrays else obj
+            except orjson.JSONDecodeError:
+                pass # e.g. NaN, which orjson does not accept
+        hook = (lambda d: array_object_hook(d, frames)) if has_arrays else None
+        return json.loads(bytes(data).decode('ascii'), object_hook=hook)
+
+
+class OrjsonCodec(JsonCodec):
+    name = 'orjson'
+    options = orjson.OPT_NON_STR_KEYS if orjson is not None else 0
+
+    def encode(self, obj, frames):
+        def default(o):
+            if isinstance(o, np.ndarray):
+                return _array_reference(o, frames)
+            if isinstance(o, np.generic):
+                return o.item()
+            raise TypeError
+        return orjson.dumps(obj, default=default, option=self.options)
+
+
+EXT_NDARRAY = 1
+
+class MsgpackCodec:
+    """ Arrays are msgpack extension types holding a reference to a raw
+    frame. Unlike JSON, integer dictionary keys are preserved. """
+    name = 'msgpack'
+    tag = b'msgpack'
+
+    def encode(self, obj, frames):
+        def default(o):
+            if isinstance(o, np.ndarray):
+                ref = _array_reference(o, frames)
+                return msgpack.ExtType(EXT_NDARRAY,
+                    msgpack.packb((ref["dtype"], ref["shape"], ref["frame"])))
+            if isinstance(o, np.generic):
+                return o.item()
+            raise TypeError("Cannot serialize %r" % (o,))
+        return msgpack.packb(obj, default=default, use_bin_type=True)
+
+    def decode(self, data, frames):
+        def ext_hook(code, payload):
+            if code != EXT_NDARRAY:
+                return msgpack.ExtType(code, payload)
+            dtype, shape, frame = msgpack.unpackb(payload)
+            return _array_from_frame(frames[frame], dtype).reshape(shape)
+        return msgpack.unpackb(data, ext_hook=ext_hook, strict_map_key=False)
+
+
+codecs = {'json': JsonCodec()}
+if orjson is not None:
+    codecs['orjson'] = OrjsonCodec()
+if msgpack is not None:
+    codecs['msgpack'] = MsgpackCodec()
+
+_tagged_codecs = {codec.tag: codec for codec in codecs.values() if codec.tag}
+
+
+def available_codecs():
+    return list(codecs)
+
+def choose_codec(preferred, offered):
+    """ Returns preferred if it is supported on both sides, json otherwise """
+    if preferred in codecs and preferred in offered:
+        return preferred
+    return 'json'
+
+def encode_message(obj, binary_arrays=True, codec='json'):
+    """ Serialize obj into a list of frames for send_multipart().
+
+    With binary_arrays, every numpy array follows the header as a separate
+    raw frame, which can be sent with copy=False. Otherwise the message is a
+    single frame of JSON with base64-encoded arrays, as understood by peers
+    which predate the multipart format. """
+    if not binary_arrays:
+        return [json.dumps(obj, cls=ArrayEncoder).encode('ascii')]
+    codec = codecs.get(codec, codecs['json'])
+    frames = []
+    header = codec.encode(obj, frames)
+    if codec.tag:
+        return [codec.tag, header] + frames
+    return [header] + frames
+
+def codec_topic(codec, topic):
+    """ PUB topic of the messages of topic encoded with codec. JSON-compatible
+    codecs use the topic itself, tagged codecs the topic prefixed with their
+    tag, which a subscriber of the plain topic does not match. """
+    tag = codecs[codec].tag if codec in codecs else None
+    return tag + b':' + topic if tag else topic
+
+def message_codec(frames):
+    """ Name of the codec on the wire: 'json' or the tag of a binary codec """
+    tag = getattr(frames[0], 'bytes', frames[0])
+    if tag in _tagged_codecs:
+        return _tagged_codecs[tag].name
+    return 'json'
+
+def decode_message(frames):
+    """ Inverse of encode_message(). Accepts both zmq.Frame objects
+    (from recv_multipart(copy=False)) and bytes, in either format. """
+    first = getattr(frames[0], 'bytes', frames[0])
+    if first in _tagged_codecs:
+        header = getattr(frames[1], 'bytes', frames[1])
+        # Frame numbers are relative to the header
+        return _tagged_codecs[first].decode(header, frames[1:])
+    return codecs['json'].decode(first, frames)
@@ -7,10 +7,21 @@ of Ultrafast MagnetoSpectroscopy at Faculty of Physics, University of Warsaw
 
 from PyQt5 import QtCore
 import zmq
-import json
 from . import device
+import asyncio
+import contextlib
+import copy
+import itertools
+import queue
+import hashlib
+import os
+import struct
+import tempfile
+from concurrent.futures import Future, ThreadPoolExecutor
+from .periodic import Scheduler
 import numpy as np
-import base64
+from .serialization import ArrayEncoder, array_object_hook, encode_message, decode_message, \
+    message_codec, available_codecs, choose_codec, codec_topic, codecs
 
 
 def remote(func):
@@ -21,24 +32,8 @@ def remote(func):
 
 def _makeFun(method_name):
     def fun(self, *args, **kwargs):
-        obj = (method_name, args, kwargs)
-        msg = json.dumps(obj, cls=ArrayEncoder).encode('ascii')
-        self.client.send(msg)
-        
-        socks = dict(self.poll.poll(self.request_timeout))
-        if socks.get(self.client) == zmq.POLLIN:
-            # print('REMOTE {}()'.format(method_name))
-            return self.client.recv_json(object_hook=array_object_hook)
-        else:
-            # Timeout. 
-            # Socket is confused. Close and reopen to reset its state.
-            self.client.setsockopt(zmq.LINGER, 0)
-            self.client.close()
-            self.poll.unregister(self.client)
-            self.client = context.socket(zmq.REQ)
-            self.client.connect(self.channel)
-            self.poll.register(self.client, zmq.POLLIN)
-            raise ConnectionError
+        # print('REMOTE {}()'.format(method_name))
+        return self.call_async(method_name, args, kwargs).result()
     return fun
 
 def include_remote_methods(worker_class):
@@ -58,26 +53,6 @@ def include_remote_methods(worker_class):
 
 context = zmq.Context()
 
-
-class ArrayEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, np.ndarray):
-            return {"dtype": obj.dtype.str,
-                    "shape": obj.shape,
-                    "data": base64.b64encode(obj.tostring()).decode('ascii')}
-        # Let the base class default method raise the TypeError
-        return json.JSONEncoder.default(self, obj)
-
-def array_object_hook(d):
-    try:
-        a = np.frombuffer(base64.standard_b64decode(d["data"]),
-                          dtype=d["dtype"])
-        a.reshape(d["shape"])
-        return a
-    except:
-        return d
-
-
         
 from multiprocessing import Process
 
@@ -87,19 +62,343 @@ from random import randint
 import time
 import threading
 
-def reminderFunc(context,req_channel,rate=0.1):
-    reminder = context.socket(zmq.REQ)
-    reminder.connect(req_channel)
-    try:
+
+CALL_ID = struct.Struct('!Q')
+
+
+class IOLoop:
+    """ A single thread serving the sockets of all front-ends in a process,
+    RPC clients and subscriptions alike, with one zmq.Poller. The number of
+    threads does not grow with the number of devices.
+
+    Sockets are only touched from the loop thread. They belong to endpoints
+    with the following methods, all called in the loop thread:
+        open()         - create and return the socket
+        prepare(now)   - before every poll; returns the poll flags and the
+                         earliest deadline (or None) of the endpoint
+        handle(events) - the socket is ready
+        release()      - close the socket """
+
+    def __init__(self, name="zmq-io"):
+        self._commands = queue.SimpleQueue()
+        self._endpoints = {}
+        self._flags = {}
+        wake_channel = "inproc://io-loop-%x" % id(self)
+        self._wake_recv = context.socket(zmq.PAIR)
+        self._wake_recv.bind(wake_channel)
+        self._wake_send = context.socket(zmq.PAIR)
+        self._wake_send.connect(wake_channel)
+        self._wake_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._loop, name=name, daemon=True)
+        self._thread.start()
+
+    def call_soon(self, func):
+        """ Run func() in the loop thread """
+        self._commands.put(func)
+        self.wake()
+
+    def wake(self):
+        """ Make the loop prepare() its endpoints again """
+        with self._wake_lock:
+            try:
+                self._wake_send.send(b'', zmq.NOBLOCK)
+            except zmq.Again:
+                pass # the loop has plenty of wake-ups pending already
+
+    def add(self, endpoint):
+        self.call_soon(lambda: self._add(endpoint))
+
+    def remove(self, endpoint):
+        self.call_soon(lambda: self._remove(endpoint))
+
+    def _add(self, endpoint):
+        socket = endpoint.open()
+        self._endpoints[socket] = endpoint
+        self._flags[socket] = 0 # registered by the next prepare()
+
+    def _remove(self, endpoint):
+        for socket, e in list(self._endpoints.items()):
+            if e is endpoint:
+                del self._endpoints[socket]
+                del self._flags[socket]
+                self._poller.register(socket, 0)
+                endpoint.release()
+
+    def _loop(self):
+        self._poller = poller = zmq.Poller()
+        poller.register(self._wake_recv, zmq.POLLIN)
         while True:
-            reminder.send_json( ("status", None, None))
-            reminder.recv_json()
-            time.sleep(rate)
-    except:
-        reminder.close()
-        raise
+            while True:
+                try:
+                    command = self._commands.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    command()
+                except Exception as e:
+                    print("IOLoop: {}".format(e))
+
+            now = time.monotonic()
+            deadline = None
+            for socket, endpoint in list(self._endpoints.items()):
+                try:
+                    flags, next_deadline = endpoint.prepare(now)
+                except Exception as e:
+                    print("IOLoop: {}".format(e))
+                    continue
+                if flags != self._flags[socket]:
+                    poller.register(socket, flags)
+                    self._flags[socket] = flags
+                if next_deadline is not None and (deadline is None or next_deadline < deadline):
+                    deadline = next_deadline
+            timeout = None if deadline is None else max(0, deadline - time.monotonic()) * 1000
+
+            for socket, events in poller.poll(timeout):
+                if socket is self._wake_recv:
+                    while socket.poll(0):
+                        socket.recv()
+                elif socket in self._endpoints:
+                    try:
+                        self._endpoints[socket].handle(events)
+                    except Exception as e:
+                        print("IOLoop: {}".format(e))
+
+
+_io_loop = None
+_io_loop_lock = threading.Lock()
+
+def io_loop():
+    """ The IOLoop shared by all front-ends of this process, started on
+    first use """
+    global _io_loop
+    with _io_loop_lock:
+        if _io_loop is None:
+            _io_loop = IOLoop()
+        return _io_loop
+
+
+class RpcClient:
+    """ Pipelined client for the ROUTER socket of a DeviceWorker.
+
+    Requests go out through a DEALER socket served by the shared IOLoop.
+    Each request carries a call id in its envelope, so any number of calls
+    may be in flight and replies are matched to the futures returned by
+    call(). A request which cannot be handed to a live connection before
+    its deadline is dropped instead of being delivered late. """
+
+    def __init__(self, channel, loop=None):
+        self.channel = channel
+        self.loop = loop or io_loop()
+        self._ids = itertools.count(1)
+        self._requests = queue.SimpleQueue()
+        self._unsent = []
+        self._pending = {}
+        self.socket = None
+        self.loop.add(self)
+
+    def call(self, frames, timeout):
+        """ Send a request; timeout in milliseconds. Returns a Future which
+        raises ConnectionError if the reply does not arrive in time. """
+        future = Future()
+        deadline = time.monotonic() + timeout / 1000
+        self._requests.put((next(self._ids), frames, future, deadline))
+        self.loop.wake()
+        return future
+
+    def close(self):
+        self.loop.remove(self)
+
+    def open(self):
+        self.socket = context.socket(zmq.DEALER)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.setsockopt(zmq.IMMEDIATE, 1) # do not queue for absent peers
+        self.socket.connect(self.channel)
+        return self.socket
+
+    def prepare(self, now):
+        while True:
+            try:
+                self._unsent.append(self._requests.get_nowait())
+            except queue.Empty:
+                break
 
+        while self._unsent:
+            call_id, frames, future, deadline = self._unsent[0]
+            try:
+                self.socket.send_multipart([CALL_ID.pack(call_id), b''] + frames,
+                                           zmq.NOBLOCK, copy=False)
+            except zmq.Again:
+                break # no connection yet, retry until the deadline
+            self._unsent.pop(0)
+            self._pending[call_id] = (future, deadline)
+
+        for request in [r for r in self._unsent if r[3] <= now]:
+            self._unsent.remove(request)
+            request[2].set_exception(ConnectionError("Request not sent to " + self.channel))
+        for call_id in [k for k, p in self._pending.items() if p[1] <= now]:
+            future, _ = self._pending.pop(call_id)
+            future.set_exception(ConnectionError("No reply from " + self.channel))
+
+        deadlines = [r[3] for r in self._unsent] + [p[1] for p in self._pending.values()]
+        flags = zmq.POLLIN | (zmq.POLLOUT if self._unsent else 0)
+        return flags, min(deadlines) if deadlines else None
+
+    def handle(self, events):
+        # Requests are sent by prepare(), which follows every poll
+        if not events & zmq.POLLIN:
+            return
+        while True:
+            try:
+                frames = self.socket.recv_multipart(zmq.NOBLOCK, copy=False)
+            except zmq.Again:
+                return
+            call_id, = CALL_ID.unpack(frames[0].bytes)
+            if call_id not in self._pending:
+                continue # timed out already
+            future, _ = self._pending.pop(call_id)
+            try:
+                result = decode_message(frames[2:])
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def release(self):
+        self.prepare(time.monotonic()) # collect requests still queued
+        for request in self._unsent:
+            request[2].set_exception(ConnectionError("Client closed"))
+        for future, _ in self._pending.values():
+            future.set_exception(ConnectionError("Client closed"))
+        self._unsent = []
+        self._pending = {}
+        self.socket.close()
+
+
+class Subscription:
+    """ SUB socket served by the shared IOLoop. callback(frames) is called
+    in the loop thread for every message, with zmq.Frame objects. """
+
+    def __init__(self, channel, topics, callback, loop=None):
+        self.channel = channel
+        self.topics = topics
+        self.callback = callback
+        self.loop = loop or io_loop()
+        self.socket = None
+        self.loop.add(self)
+
+    def close(self):
+        self.loop.remove(self)
+
+    def open(self):
+        self.socket = context.socket(zmq.SUB)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.connect(self.channel)
+        for topic in self.topics:
+            self.socket.setsockopt(zmq.SUBSCRIBE, topic)
+        return self.socket
 
+    def prepare(self, now):
+        return zmq.POLLIN, None
+
+    def handle(self, events):
+        while True:
+            try:
+                frames = self.socket.recv_multipart(zmq.NOBLOCK, copy=False)
+            except zmq.Again:
+                return
+            self.callback(frames)
+
+    def release(self):
+        self.socket.close()
+
+def _equal(a, b):
+    if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+        return isinstance(a, np.ndarray) and isinstance(b, np.ndarray) \
+            and a.dtype == b.dtype and np.array_equal(a, b)
+    try:
+        return type(a) == type(b) and bool(a == b)
+    except Exception:
+        return False # e.g. lists holding arrays
+
+
+class DeltaEncoder:
+    """ Turns consecutive dictionaries published on one topic into messages
+    carrying only the top-level keys which changed, with a full keyframe
+    every keyframe_interval seconds. Decoded by DeltaMerger. """
+
+    def __init__(self, keyframe_interval=2.0):
+        self.keyframe_interval = keyframe_interval
+        self.state = None
+        self.seq = 0
+        self.last_keyframe = 0
+        self.lock = threading.Lock()
+
+    def message(self, obj):
+        """ Returns the message to publish, or None if nothing changed """
+        if not isinstance(obj, dict):
+            return obj
+        with self.lock:
+            now = time.monotonic()
+            if self.state is None or now - self.last_keyframe >= self.keyframe_interval:
+                self.seq += 1
+                # Snapshot, as status() may return references to live data
+                self.state = copy.deepcopy(obj)
+                self.last_keyframe = now
+                return {"__keyframe__": self.seq, "state": obj}
+            changed = {k: v for k, v in obj.items()
+                       if k not in self.state or not _equal(v, self.state[k])}
+            removed = [k for k in self.state if k not in obj]
+            if not changed and not removed:
+                return None
+            self.seq += 1
+            for k in removed:
+                del self.state[k]
+            self.state.update(copy.deepcopy(changed))
+            return {"__delta__": self.seq, "set": changed, "del": removed}
+
+
+class DeltaMerger:
+    """ Rebuilds the full dictionaries from the output of DeltaEncoder """
+
+    def __init__(self):
+        self.state = None
+        self.seq = None
+
+    def merge(self, msg):
+        """ Returns the full state, or None while waiting for a keyframe
+        (at start or after a lost message) """
+        if not isinstance(msg, dict):
+            return msg
+        if "__keyframe__" in msg:
+            self.state = msg["state"]
+            self.seq = msg["__keyframe__"]
+        elif "__delta__" in msg:
+            if self.state is None or msg["__delta__"] != self.seq + 1:
+                self.state = None
+                return None
+            self.seq = msg["__delta__"]
+            for k in msg["del"]:
+                self.state.pop(k, None)
+            self.state.update(msg["set"])
+        else:
+            return msg # publisher without delta mode
+        # The cached state is updated in place, hand out a copy
+        return dict(self.state)
+
+
+def channels(transport, host, req_port, pub_port=None):
+    """ Endpoints of the REQ and PUB channels of a device. ipc and inproc
+    endpoints are named after the port numbers, so that a device entry
+    only needs its transport changed. Workers bind to host '*'. """
+    if transport == 'tcp':
+        prefix = "tcp://" + host + ":"
+    elif transport == 'ipc':
+        prefix = "ipc://" + os.path.join(tempfile.gettempdir(), "pyteros-")
+    elif transport == 'inproc':
+        prefix = "inproc://device-"
+    else:
+        raise ValueError("Unknown transport: " + str(transport))
+    return prefix + str(req_port), prefix + str(pub_port) if pub_port else None
 
 
 class Logger():
@@ -119,125 +418,556 @@ class Logger():
 
 
 class DeviceWorker(Process):
-    def __init__(self, req_port=0, pub_port=0, refresh_rate=0.1, address='localhost'):
+    def __init__(self, req_port=0, pub_port=0, refresh_rate=0.1, address='localhost', binary_arrays=True,
+                 codec='json', rpc_threads=1, status_keepalive=1.0, status_delta=False,
+                 keyframe_interval=2.0, transport='tcp'):
         if not req_port or not pub_port:
             raise Exception("Ports not specified for class: %s" % self.__name__)
-        self.REQchannel = "tcp://*:" + str(req_port)
-        self.PUBchannel = "tcp://*:" + str(pub_port)
-        self.rep_channel = "tcp://localhost:"+str(req_port)
+        self.REQchannel, self.PUBchannel = channels(transport, '*', req_port, pub_port)
         self.address = address
         self.refresh_rate = refresh_rate
+        self.status_keepalive = status_keepalive # max. interval between identical messages
+        self.status_delta = status_delta # publish only changed keys of status()
+        self.keyframe_interval = keyframe_interval # full status every ... s in delta mode
+        self._delta_encoders = {}
+        self.binary_arrays = binary_arrays # False keeps replies readable by old clients
+        self.codec = codec if codec in available_codecs() else 'json'
+        # Published messages of a tagged codec (msgpack) go out on a topic
+        # of their own, and JSON on the plain topic for everyone else
+        self.pub_codecs = [self.codec] if codecs[self.codec].tag is None else ['json', self.codec]
+        self.rpc_threads = rpc_threads # >1 lets slow calls run concurrently
+        self.in_thread = False
+        self._local_subscribers = {}
+        self._subscriptions = set()
         super().__init__()
 
     @remote
     def status(self):
         return {}
 
+    @remote
+    def call_many(self, calls):
+        """ Execute a list of (method_name, args, kwargs) in order and return
+        the list of their results. See DeviceOverZeroMQ.batch(). """
+        results = []
+        for method_name, args, kwargs in calls:
+            try:
+                results.append(getattr(self, method_name)(*args, **kwargs))
+            except Exception as e:
+                print("Exception: ", str(e))
+                results.append("ERROR processing request")
+        return results
+
+    @remote
+    def available_codecs(self):
+        return available_codecs()
+
+    @remote
+    def select_codec(self, offered):
+        """ Called by front-ends with the list of codecs they can decode.
+        Returns the codec to use for requests, and for the messages of
+        published topics, see codec_topic(). """
+        return choose_codec(self.codec, offered)
+
+    def _reply_codec(self, request_frames):
+        """ Replies are encoded in the same wire format as the request """
+        codec = message_codec(request_frames)
+        if codec == 'json' and self.codec == 'orjson':
+            return self.codec
+        return codec
+
     def init_device(self):
         pass
 
-    def send_via_pubchannel(self, topic, obj):
-        msg = json.dumps(obj, cls=ArrayEncoder).encode('ascii')
+    def send_via_pubchannel(self, topic, obj, delta=False):
+        """ With delta, only the keys of obj which differ from the previous
+        message on this topic are sent (nothing if none does), plus a full
+        keyframe every keyframe_interval seconds. """
+        self._publish_locally(topic, obj)
+        for wire_topic, codec in self._remote_topics(topic):
+            message = obj
+            if delta:
+                if wire_topic not in self._delta_encoders:
+                    self._delta_encoders[wire_topic] = DeltaEncoder(self.keyframe_interval)
+                message = self._delta_encoders[wire_topic].message(obj)
+                if message is None:
+                    continue
+            self._publish_frames(wire_topic, encode_message(message, self.binary_arrays, codec))
+
+    def _publish_frames(self, topic, frames):
         self.mutex_for_pubchannel.lock()
-        self.notifier.send_multipart([topic, msg])
+        self.notifier.send_multipart([topic] + frames, copy=False)
         self.mutex_for_pubchannel.unlock()
 
+    def _publish_locally(self, topic, obj):
+        for callback in self._local_subscribers.get(topic, ()):
+            try:
+                callback(obj)
+            except Exception as e:
+                print("Exception: ", str(e))
+
+    def _remote_topics(self, topic):
+        """ (wire topic, codec) of the encodings of topic which any peer of
+        the PUB socket subscribes to. The socket is an XPUB, which receives
+        the first subscription and the last unsubscription of every topic
+        prefix. """
+        self.mutex_for_pubchannel.lock()
+        try:
+            while True:
+                try:
+                    message = self.notifier.recv(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                if message[:1] == b'\x01':
+                    self._subscriptions.add(message[1:])
+                elif message[:1] == b'\x00':
+                    self._subscriptions.discard(message[1:])
+        finally:
+            self.mutex_for_pubchannel.unlock()
+        subscribed = []
+        for codec in self.pub_codecs:
+            wire_topic = codec_topic(codec, topic)
+            if any(wire_topic.startswith(prefix) for prefix in self._subscriptions):
+                subscribed.append((wire_topic, codec))
+            else:
+                self._delta_encoders.pop(wire_topic, None) # start with a keyframe
+        return subscribed
+
+    def add_local_subscriber(self, topic, callback):
+        """ Call callback(obj) with every object published on topic, in the
+        publishing thread. For front-ends in the same process as a worker
+        started with start_in_thread(): objects are neither serialized nor
+        copied, and delta encoding does not apply. """
+        self._local_subscribers.setdefault(topic, []).append(callback)
+
+    def add_publisher(self, topic, func, period=None, delta=False):
+        """ Publish the result of func() on the PUB channel every period
+        seconds (refresh_rate by default). A result identical to the
+        previous one is not sent again until status_keepalive elapses.
+        See send_via_pubchannel() for delta. Should be called from
+        init_device(). """
+        last = {} # wire topic -> (digest, time) of the last message sent
+
+        def publish():
+            if delta:
+                self.send_via_pubchannel(topic, func(), delta=True)
+                return
+            obj = func()
+            self._publish_locally(topic, obj)
+            subscribed = self._remote_topics(topic)
+            for wire_topic in set(last) - {t for t, _ in subscribed}:
+                del last[wire_topic] # a new subscriber gets the next message
+            now = time.monotonic()
+            for wire_topic, codec in subscribed:
+                frames = encode_message(obj, self.binary_arrays, codec)
+                digest = hashlib.blake2b(digest_size=16)
+                for frame in frames:
+                    digest.update(frame)
+                digest = digest.digest()
+                previous = last.get(wire_topic)
+                if previous and digest == previous[0] and now - previous[1] < self.status_keepalive:
+                    continue
+                self._publish_frames(wire_topic, frames)
+                last[wire_topic] = (digest, now)
+
+        self.scheduler.add(topic, period or self.refresh_rate, publish)
+
+    def submit(self, method_name, args=(), kwargs=None):
+        """ Call a method of a worker started with start_in_thread() from
+        another thread of the same process. The call is executed by the
+        request loop like a remote one, but arguments and result are passed
+        as they are, without serialization. Returns a Future. """
+        future = Future()
+        self._local_calls.put((method_name, args, kwargs or {}, future))
+        with self._local_wake_lock:
+            try:
+                self._local_wake_send.send(b'', zmq.NOBLOCK)
+            except zmq.Again:
+                pass # the loop has plenty of wake-ups pending already
+        return future
+
+    def _run_local(self, method_name, args, kwargs, future):
+        try:
+            result = getattr(self, method_name)(*args, **kwargs)
+        except Exception as e:
+            print("Exception: ", str(e))
+            result = "ERROR processing request"
+        future.set_result(result)
+
+    def start_in_thread(self):
+        """ Run the worker in a thread of the calling process instead of a
+        separate process, e.g. next to its front-end. Returns once the
+        channels are bound; raises zmq.ZMQError if they cannot be (e.g.
+        when another process serves the device already). """
+        self.in_thread = True
+        self._local_calls = queue.SimpleQueue()
+        wake_channel = "inproc://local-calls-%x" % id(self)
+        self._local_wake_recv = context.socket(zmq.PAIR)
+        self._local_wake_recv.bind(wake_channel)
+        self._local_wake_send = context.socket(zmq.PAIR)
+        self._local_wake_send.connect(wake_channel)
+        self._local_wake_lock = threading.Lock()
+        self._bound = threading.Event()
+        self._bind_error = None
+        self._thread = threading.Thread(target=self.run, name=type(self).__name__, daemon=True)
+        self._thread.start()
+        self._bound.wait()
+        if self._bind_error is not None:
+            self._local_wake_send.close()
+            self._local_wake_recv.close()
+            raise self._bind_error
+
+    def _handle_request(self, request_frames, request):
+        """ Execute a request, decoded from request_frames (or the
+        exception raised decoding it), and return the frames of the reply """
+        codec = self._reply_codec(request_frames)
+        try:
+            if isinstance(request, Exception):
+                raise request
+            f = getattr(self, request[0])
+            args = request[1]
+            kwargs = request[2]
+            result = f(*args, **kwargs)
+        except Exception as e:
+            print("Exception: ", str(e))
+            result = "ERROR processing request"
+        return encode_message(result, self.binary_arrays, codec)
+
+    def _handle_request_in_pool(self, envelope, request_frames, request):
+        if not hasattr(self._pool_sockets, 'socket'):
+            self._pool_sockets.socket = self._context.socket(zmq.PUSH)
+            self._pool_sockets.socket.connect(self._replies_channel)
+        reply = self._handle_request(request_frames, request)
+        self._pool_sockets.socket.send_multipart(envelope + reply, copy=False)
+
     def run(self):
         print("starting process")
         self.mutex_for_pubchannel = QtCore.QMutex()
-        context = zmq.Context(1)
-        server = context.socket(zmq.REP)
-        server.bind(self.REQchannel)
-        
-        self.notifier = context.socket(zmq.PUB)
-        self.notifier.bind(self.PUBchannel)
+        if self.in_thread:
+            # inproc endpoints are only reachable within one context
+            self._context = context
+        else:
+            self._context = zmq.Context(1)
+        # ROUTER serves both REQ peers and pipelining DEALER clients:
+        # everything up to the first empty frame is the routing envelope
+        server = self._context.socket(zmq.ROUTER)
+        # XPUB tells which topics have subscribers, see _remote_topics()
+        self.notifier = self._context.socket(zmq.XPUB)
+        try:
+            server.bind(self.REQchannel)
+            self.notifier.bind(self.PUBchannel)
+        except zmq.ZMQError as e:
+            if not self.in_thread:
+                raise
+            server.close(linger=0)
+            self.notifier.close(linger=0)
+            self._bind_error = e
+            self._bound.set()
+            return
         
         import sys
-        sys.stdout = Logger(self.notifier, self.mutex_for_pubchannel, "stdout")
-        sys.stderr = Logger(self.notifier, self.mutex_for_pubchannel, "stderr")
-        time.sleep(0.5)
-        
-        reminderThread = threading.Thread(target=reminderFunc,
-                                          args=(context,self.rep_channel,self.refresh_rate))
-        reminderThread.start()
+        if self.in_thread:
+            self._bound.set()
+        else:
+            sys.stdout = Logger(self.notifier, self.mutex_for_pubchannel, "stdout")
+            sys.stderr = Logger(self.notifier, self.mutex_for_pubchannel, "stderr")
+            time.sleep(0.5)
         
+        # Status is published from its own thread, so a slow status() never
+        # delays requests and vice versa
+        self.scheduler = Scheduler("publisher")
+        self.add_publisher(b"status", self.status, delta=self.status_delta)
         self.init_device()
-
-        while True:
-            request = server.recv_json()
-            if request[0] == 'quit':
-                break
-            if request[0] == "status":
-                msg = json.dumps(self.status(), cls=ArrayEncoder).encode('ascii')
-                server.send(msg)
-                self.mutex_for_pubchannel.lock()
-                self.notifier.send_multipart([b"status", msg])
-                self.mutex_for_pubchannel.unlock()
+        self.scheduler.start()
+
+        poller = zmq.Poller()
+        poller.register(server, zmq.POLLIN)
+        if self.in_thread:
+            poller.register(self._local_wake_recv, zmq.POLLIN)
+        pool = None
+        if self.rpc_threads > 1:
+            pool = ThreadPoolExecutor(self.rpc_threads)
+            self._pool_sockets = threading.local()
+            self._replies_channel = "inproc://replies-%x" % id(self)
+            replies = self._context.socket(zmq.PULL)
+            replies.bind(self._replies_channel)
+            poller.register(replies, zmq.POLLIN)
+
+        running = True
+        while running:
+            events = dict(poller.poll())
+            if pool is not None and replies in events:
+                server.send_multipart(replies.recv_multipart(copy=False), copy=False)
+            if self.in_thread and self._local_wake_recv in events:
+                while self._local_wake_recv.poll(0):
+                    self._local_wake_recv.recv()
+                while running:
+                    try:
+                        call = self._local_calls.get_nowait()
+                    except queue.Empty:
+                        break
+                    if call[0] == 'quit':
+                        call[3].set_result(None)
+                        running = False
+                    elif pool is not None:
+                        pool.submit(self._run_local, *call)
+                    else:
+                        self._run_local(*call)
+            if not running or server not in events:
                 continue
-            
+            frames = server.recv_multipart(copy=False)
+            delimiter = next((i for i, f in enumerate(frames) if len(f) == 0), None)
+            if delimiter is None:
+                continue # not a request
+            envelope = frames[:delimiter + 1]
+            request_frames = frames[delimiter + 1:]
             try:
-                f = getattr(self, request[0])
-                args = request[1]
-                kwargs = request[2]
-                result = f(*args, **kwargs)
-                msg = json.dumps(result, cls=ArrayEncoder).encode('ascii')
-                server.send(msg)
+                request = decode_message(request_frames)
             except Exception as e:
-                print("Exception: ", str(e))
-                server.send_json("ERROR processing request")
-        reminderThread.join()
+                request = e # reported by _handle_request()
+            else:
+                if request[0] == 'quit':
+                    break
+            if pool is not None:
+                pool.submit(self._handle_request_in_pool, envelope, request_frames, request)
+            else:
+                server.send_multipart(envelope + self._handle_request(request_frames, request), copy=False)
                 
         print("quitting process")
-        server.close()
-        reminderThread.join()
-        context.term()
+        self.scheduler.stop()
+        if pool is not None:
+            pool.shutdown()
+        if self.in_thread:
+            for socket in (server, self.notifier, self._local_wake_recv):
+                socket.close(linger=0)
+            if pool is not None:
+                replies.close(linger=0)
+            return
+        sys.stdout = sys.__stdout__
+        sys.stderr = sys.__stderr__
+        self._context.destroy(linger=0)
         print("finally the whole process quits")
 
 
+class Batch:
+    """ Remote calls collected by DeviceOverZeroMQ.batch(). Calling a
+    method records it and returns a Future of its result. """
+
+    def __init__(self, device):
+        self.device = device
+        self.calls = []
+        self.futures = []
+
+    def __getattr__(self, method_name):
+        if not callable(getattr(self.device, method_name, None)):
+            raise AttributeError(method_name)
+        def record(*args, **kwargs):
+            future = Future()
+            self.calls.append((method_name, args, kwargs))
+            self.futures.append(future)
+            return future
+        return record
+
+    def send(self, timeout=None):
+        """ Send the recorded calls as one call_many() request. Returns a
+        Future of the list of results. """
+        if not self.calls:
+            future = Future()
+            future.set_result([])
+            return future
+        future = self.device.call_async('call_many', (self.calls,), timeout=timeout)
+        future.add_done_callback(self._resolve)
+        return future
+
+    def _resolve(self, future):
+        error = future.exception()
+        if error is None and len(future.result()) != len(self.futures):
+            error = ConnectionError("Unexpected reply to call_many()")
+        for i, f in enumerate(self.futures):
+            if error is not None:
+                f.set_exception(error)
+            else:
+                f.set_result(future.result()[i])
+
+
 @include_remote_methods(DeviceWorker)
 class DeviceOverZeroMQ(device.Device):
-    def __init__(self, req_port, pub_port=None, host="localhost"):        
-        self.thread = {}
+    def __init__(self, req_port, pub_port=None, host="localhost", binary_arrays=True, codec='json',
+                 transport='tcp', worker=None):
+        self.listeners = {}
+        self.rate_limiters = []
+        self.binary_arrays = binary_arrays # False for workers predating multipart messages
+        self.preferred_codec = codec
+        self.codec = 'json' if codec == 'json' else None # None until negotiated
         self.host = host
-        self.channel = "tcp://"+host+":"+str(req_port)
-        self.client = context.socket(zmq.REQ)
-        self.client.connect(self.channel)
-        self.poll = zmq.Poller()
-        self.poll.register(self.client, zmq.POLLIN)
+        self.channel, self.pub_channel = channels(transport, host, req_port, pub_port)
+        # A worker running in this process (see DeviceWorker.start_in_thread)
+        # is called directly, without serialization
+        self.worker = worker
+        self.rpc = RpcClient(self.channel) if worker is None else None
         self.request_timeout = 2000 # 2s in milliseconds
-        if pub_port:
-            self.pub_channel = "tcp://"+host+":"+str(pub_port)
-        else:
-            self.pub_channel = None
+
+    def call_async(self, method_name, args=(), kwargs=None, timeout=None):
+        """ Invoke a remote method without waiting for the reply. Returns
+        a concurrent.futures.Future whose result() raises ConnectionError
+        if there is no reply within timeout (milliseconds, defaults to
+        request_timeout). """
+        if self.worker is not None:
+            return self.worker.submit(method_name, args, kwargs)
+        codec = self.codec if self.codec is not None else self.negotiate_codec()
+        request = (method_name, args, kwargs or {})
+        frames = encode_message(request, self.binary_arrays, codec)
+        if timeout is None:
+            timeout = self.request_timeout
+        return self.rpc.call(frames, timeout)
+
+    @contextlib.contextmanager
+    def batch(self, wait=True, timeout=None):
+        """ Send all calls made in the block in a single request:
+
+            with rover.batch() as b:
+                b.power(axis, v)
+                b.servo(servo, v)
+
+        The worker executes them in order when the block is left, which
+        then waits for the results unless wait is False. """
+        batch = Batch(self)
+        yield batch
+        future = batch.send(timeout)
+        if wait:
+            future.result()
+
+    def call_aio(self, method_name, args=(), kwargs=None, timeout=None):
+        """ Same as call_async(), but returns an asyncio future to be
+        awaited in the running event loop """
+        return asyncio.wrap_future(self.call_async(method_name, args, kwargs, timeout))
+
+    def negotiate_codec(self):
+        """ Agree with the worker on the codec used for requests. Falls back
+        to JSON if the preferred codec is not installed on either side. """
+        self.codec = 'json' # the negotiation itself is done in JSON
+        try:
+            codec = self.select_codec(available_codecs())
+        except ConnectionError:
+            self.codec = None # retry with the next request
+            return 'json'
+        self.codec = codec if codec in available_codecs() else 'json'
+        return self.codec
     
     class ZeroMQ_Listener(QtCore.QObject):
+        """ Decodes the messages of one topic received by the shared IOLoop,
+        or takes them as they are from a worker running in this process.
+        Slots are called in their own thread, usually the GUI thread. """
         message = QtCore.pyqtSignal(object)
+        ready = QtCore.pyqtSignal() # conflating mode: take() the newest message
         
-        def __init__(self,channel, topic):
+        def __init__(self,channel, topic, conflate=False, worker=None, codec='json'):
             QtCore.QObject.__init__(self)
-            
-            self.socket = context.socket(zmq.SUB)
             print(channel)
-            self.socket.connect (channel)
-            self.socket.setsockopt(zmq.SUBSCRIBE, topic)
-             
-            self.running = True
-         
-        def loop(self):
-            while self.running:
-                msg = self.socket.recv_multipart()[1].decode('ascii')
-                status = json.loads(msg, object_hook=array_object_hook)
+            # Full state rebuilt from delta-encoded messages
+            self.merger = DeltaMerger()
+            # ZMQ_CONFLATE does not support multipart messages and would
+            # break delta sequences, so conflation is done on decoded
+            # messages in a last-value slot instead
+            self.conflate = conflate
+            self._lock = threading.Lock()
+            self._latest = None
+            self._pending = False
+            if conflate:
+                self.ready.connect(self.dispatch, QtCore.Qt.QueuedConnection)
+            self.subscription = None
+            if worker is not None:
+                worker.add_local_subscriber(topic, self.deliver)
+            else:
+                self.subscription = Subscription(channel, [codec_topic(codec, topic)], self.receive)
+
+        def receive(self, frames):
+            """ Called in the IOLoop thread """
+            try:
+                status = self.merger.merge(decode_message(frames[1:]))
+            except Exception as e:
+                print("Cannot decode message: {}".format(e))
+                return
+            if status is not None:
+                self.deliver(status)
+
+        def deliver(self, status):
+            if not self.conflate:
                 self.message.emit(status)
-            
-    def createListenerThread(self, updateSlot, topic=b'status'):
+                return
+            with self._lock:
+                self._latest = status
+                notify = not self._pending
+                self._pending = True
+            # At most one notification is queued in the thread of the
+            # listener, however slow it is
+            if notify:
+                self.ready.emit()
+
+        def take(self):
+            """ Newest message received in conflating mode """
+            with self._lock:
+                self._pending = False
+                return self._latest
+
+        def dispatch(self):
+            self.message.emit(self.take())
+
+        def close(self):
+            if self.subscription is not None:
+                self.subscription.close()
+
+    class RateLimitedSlot(QtCore.QObject):
+        """ Calls slot with the newest value at most max_rate times per
+        second. Values arriving in between replace each other. """
+
+        def __init__(self, slot, max_rate):
+            QtCore.QObject.__init__(self)
+            self.slot = slot
+            self.interval = 1. / max_rate
+            self.last_call = -self.interval
+            self.value = None
+            self.timer = QtCore.QTimer(self)
+            self.timer.setSingleShot(True)
+            self.timer.timeout.connect(self.fire)
+
+        def receive(self, value):
+            self.value = value
+            if self.timer.isActive():
+                return
+            wait = self.last_call + self.interval - time.monotonic()
+            if wait <= 0:
+                self.fire()
+            else:
+                self.timer.start(int(wait * 1000) + 1)
+
+        def fire(self):
+            self.last_call = time.monotonic()
+            value, self.value = self.value, None
+            self.slot(value)
+
+    def createListenerThread(self, updateSlot, topic=b'status', conflate=False, max_rate=None):
+        """ Connect updateSlot to messages published on topic. Messages of
+        all devices are received by a single thread, the shared IOLoop.
+
+        With conflate, messages which arrive while the receiving thread is
+        busy are dropped in favour of the newest one. With max_rate,
+        updateSlot is called at most that many times per second, always
+        with the newest message. """
         if not self.pub_channel:
             print("Error: no PUB port given")
             return
-        if topic not in self.thread:
-            thread = QtCore.QThread()
-            zeromq_listener = DeviceOverZeroMQ.ZeroMQ_Listener(self.pub_channel, topic)
-            zeromq_listener.moveToThread(thread)
-            thread.started.connect(zeromq_listener.loop)
-            QtCore.QTimer.singleShot(0, thread.start)
-            self.thread[topic] = (thread, zeromq_listener)
-        self.thread[topic][1].message.connect(updateSlot)
\ No newline at end of file
+        key = (topic, conflate)
+        if key not in self.listeners:
+            codec = 'json'
+            if self.worker is None:
+                # Messages of the negotiated codec, JSON if the worker
+                # cannot be reached now
+                codec = self.codec if self.codec is not None else self.negotiate_codec()
+            self.listeners[key] = DeviceOverZeroMQ.ZeroMQ_Listener(self.pub_channel, topic, conflate,
+                                                                   self.worker, codec)
+        if max_rate:
+            limiter = DeviceOverZeroMQ.RateLimitedSlot(updateSlot, max_rate)
+            self.rate_limiters.append(limiter)
+            updateSlot = limiter.receive
+        self.listeners[key].message.connect(updateSlot)
\ No newline at end of file
@@ -4,7 +4,7 @@ from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 
 from devices.misc.xbox import XBoxPad
-from devices.rover import Rover, MoveCommand
+from devices.rover import Rover, MoveCommand, COMMAND_HEADER, COMMAND, COMMAND_REPORT
 
 from collections import deque
 import itertools
@@ -12,7 +12,6 @@ import jsonpickle
 import os
 import random
 import socket
-import struct
 import time
 
 
@@ -24,6 +23,11 @@ class NoRequiredDevicesError(Exception):
 epsilon = 0.00000001
 dead_zone = 0.17
 
+# Period of the command packets [s], adapted to the reports of the rover
+send_period_nominal = 0.040
+send_period_min = 0.020
+send_period_max = 0.100
+
 
 class Master():
 	def __init__(self, axis_id, combo, checkInverted, editSpeedMax, editSpeedMin, editSpeedSmooth):
@@ -61,13 +65,14 @@ class Slave():
 		self.last_direction = 0
 
 	def execute(self):
+		""" The command for this tick. Power and drive are setpoints, sent
+		in every packet so that a lost one (e.g. a stop) is repeated by the
+		next. Servo values are increments, sent only when non-zero. """
 		try:
-			if self.velocity == self.last_velocity and abs(
-					self.velocity) < 0.000001:  # and not(self.axis == 190 or self.axis == 191 or self.axis == 201 or self.axis == 200):
-				self.velocity = 0
-				return (MoveCommand.NOP, None, 0)
 			self.last_velocity = self.velocity
 			self.velocity = 0
+			if self.method == MoveCommand.SERVO and abs(self.last_velocity) < 0.000001:
+				return (MoveCommand.NOP, None, 0)
 			return (self.method, self.axis, self.last_velocity)
 		except Exception as e:
 			print("[control] error sending: {}".format(e))
@@ -97,6 +102,10 @@ class JoystickControlWidget(QtWidgets.QWidget):
 		self._open_command_socket()
 
 		self.next_packet_id = random.randint(0, 2**31)
+		self.send_period = send_period_nominal
+		self.link = {"rtt": None, "loss": None, "jitter": None, "time": None}
+		self.last_report_id = None
+		self.controlled = set() # slaves whose setpoints the packets carry
 
 		self.timer = QtCore.QTimer()
 		self.timer.setSingleShot(5000)
@@ -156,6 +165,7 @@ class JoystickControlWidget(QtWidgets.QWidget):
 		port = rover.get_cmd_stream_port()
 
 		self.cmd_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.cmd_socket.setblocking(False)
 		self.cmd_server_addr = (host, port)
 
 	def refreshCombos(self):
@@ -259,10 +269,9 @@ class JoystickControlWidget(QtWidgets.QWidget):
 		else:
 			self.startButton.setText("Start control")
 			self.startButton.setChecked(False)
-			for master in self.masters:
-				slave_nr = master.combo.currentIndex() - 1
-				if slave_nr >= 0:
-					self.slaves[slave_nr].execute()  # set zero value
+			for slave in self.slaves:
+				slave.velocity = 0
+			self.send_commands()  # set zero values
 
 	def timeout(self):
 		if not self.active:
@@ -276,7 +285,8 @@ class JoystickControlWidget(QtWidgets.QWidget):
 			boost *= (1 - state_raw["left_trigger"])
 			boost *= (1 + state_raw["right_trigger"])
 		else:
-			self.timer.start(40)
+			self.send_commands()  # zero values
+			self.timer.start(round(self.send_period * 1000))
 			return state_raw
 
 
@@ -347,21 +357,68 @@ class JoystickControlWidget(QtWidgets.QWidget):
 			if slave_nr >= 0:
 				self.slaves[slave_nr].add_change(value)
 
-		commands = struct.pack('I', self.next_packet_id)
-		for slave in self.slaves:
+		self.send_commands()
+		self.timer.start(round(self.send_period * 1000))
+
+	def send_commands(self):
+		""" Send the commands of all the slaves controlled by a master, and
+		a zero once to those which are no longer """
+		if self.cmd_socket is None:
+			return
+		self.read_reports()
+		controlled = {master.combo.currentIndex() - 1 for master in self.masters}
+		released = self.controlled - controlled
+		self.controlled = controlled
+		commands = COMMAND_HEADER.pack(self.next_packet_id, time.time())
+		for slave_nr, slave in enumerate(self.slaves):
+			if slave_nr in released and slave.method != MoveCommand.SERVO:
+				slave.velocity = 0
+				commands += COMMAND.pack(slave.method, slave.axis or 0, 0)
+				continue
+			if slave_nr not in controlled:
+				continue
 			cmd, axis, val = slave.execute()
 			if cmd == MoveCommand.NOP:
 				continue
 
 			if axis is None:
 				axis = 0
-			commands += struct.pack('Bhf', cmd, axis, val)
+			commands += COMMAND.pack(cmd, axis, val)
 
 			# print(cmd, axis, val)
 
-		if len(commands) > 4:
+		if len(commands) > COMMAND_HEADER.size:
 			# print('commands: {}'.format(commands))
-			self.cmd_socket.sendto(commands, self.cmd_server_addr)
-			self.next_packet_id += 1
-	
-		self.timer.start(40)
\ No newline at end of file
+			try:
+				self.cmd_socket.sendto(commands, self.cmd_server_addr)
+			except OSError as e:
+				print('[control] sending commands: {}'.format(e))
+			self.next_packet_id = (self.next_packet_id + 1) % 2**32
+
+	def read_reports(self):
+		""" Adapt the send period to the reports of the rover: back off when
+		the round trip grows, send more often (each packet repeats all the
+		setpoints) when packets are lost, otherwise return to nominal.
+		The rover reports periodically even when no packet arrives; a
+		report of the same packet as the previous one only renews the
+		time of the link, as its round trip would include the silence. """
+		while True:
+			try:
+				data = self.cmd_socket.recv(COMMAND_REPORT.size)
+			except (BlockingIOError, OSError):
+				break
+			if len(data) != COMMAND_REPORT.size:
+				continue
+			packet_id, sent, loss, jitter = COMMAND_REPORT.unpack(data)
+			if packet_id == self.last_report_id:
+				self.link["time"] = time.monotonic()
+				continue
+			self.last_report_id = packet_id
+			rtt = time.time() - sent if sent else None
+			self.link = {"rtt": rtt, "loss": loss, "jitter": jitter, "time": time.monotonic()}
+			if rtt is not None and (rtt > 0.2 or jitter > self.send_period):
+				self.send_period = min(send_period_max, self.send_period * 1.25)
+			elif loss > 0.05:
+				self.send_period = max(send_period_min, self.send_period * 0.8)
+			else:
+				self.send_period += (send_period_nominal - self.send_period) * 0.2
\ No newline at end of file
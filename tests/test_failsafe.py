@@ -0,0 +1,46 @@
+from devices.failsafe import Failsafe
+
+
+class Axes:
+    def __init__(self):
+        self.values = {}
+
+    def apply(self, axis, value):
+        self.values[axis] = value
+
+
+def test_ramps_to_zero_after_timeout():
+    axes = Axes()
+    failsafe = Failsafe(axes.apply, default_timeout=0.5, ramp=0.2)
+    failsafe.feed(129, 0.8, now=0.0)
+    assert failsafe.check(now=0.49) == []
+    assert axes.values == {}
+    failsafe.check(now=0.6)
+    assert abs(axes.values[129] - 0.4) < 1e-9
+    assert failsafe.check(now=0.71) == [129]
+    assert axes.values[129] == 0
+    assert failsafe.stats() == {"remaining": {}, "trips": {129: 1}}
+
+
+def test_new_command_renews_deadline_and_cancels_ramp():
+    axes = Axes()
+    failsafe = Failsafe(axes.apply, default_timeout=0.5, ramp=0.2)
+    failsafe.feed(129, 0.8, now=0.0)
+    failsafe.check(now=0.55)
+    failsafe.feed(129, -0.5, now=0.56)
+    assert failsafe.check(now=1.0) == []
+    failsafe.check(now=1.16)
+    assert abs(axes.values[129] + 0.25) < 1e-9
+    assert failsafe.stats()["trips"] == {129: 2}
+
+
+def test_zero_and_unguarded_axes_are_not_ramped():
+    axes = Axes()
+    failsafe = Failsafe(axes.apply, timeouts={190: None, "throttle": 0.1}, default_timeout=0.5, ramp=0.0)
+    failsafe.feed(190, 1.0, now=0.0)
+    failsafe.feed(129, 1.0, now=0.0)
+    failsafe.feed(129, 0, now=0.0)
+    failsafe.feed("throttle", 0.3, now=0.0)
+    assert failsafe.check(now=0.2) == ["throttle"]
+    assert axes.values == {"throttle": 0}
+    assert failsafe.check(now=10.0) == []
@@ -0,0 +1,47 @@
+import threading
+
+from devices.frame_store import FrameStore
+
+
+def test_keeps_last_frames_per_id_and_counts_drops():
+    store = FrameStore(capacity=3)
+    for t in range(5):
+        store.add(1, float(t), bytes([t]))
+    store.add(2, 10.0, b"x")
+    assert store.last(1, 2) == [(3.0, b"\x03"), (4.0, b"\x04")]
+    assert store.last(1, 10) == [(2.0, b"\x02"), (3.0, b"\x03"), (4.0, b"\x04")]
+    assert store.last(3) == []
+    assert store.stats() == {1: (3, 5, 2), 2: (1, 1, 0)}
+
+
+def test_since_merges_ids_in_time_order():
+    store = FrameStore()
+    store.add(1, 1.0, b"a")
+    store.add(2, 2.0, b"b")
+    store.add(1, 3.0, b"c")
+    assert store.since(1.0) == [(2.0, 2, b"b"), (3.0, 1, b"c")]
+    assert store.since(0.0, arbitration_id=1) == [(1.0, b"a"), (3.0, b"c")]
+
+
+def test_drain_empties_the_store():
+    store = FrameStore()
+    store.add(2, 2.0, b"b")
+    store.add(1, 1.0, bytearray(b"a"))
+    assert store.drain() == [(1.0, 1, b"a"), (2.0, 2, b"b")]
+    assert store.drain() == []
+    assert store.stats() == {1: (0, 1, 0), 2: (0, 1, 0)}
+
+
+def test_concurrent_writers():
+    store = FrameStore(capacity=10)
+
+    def write(i):
+        for t in range(1000):
+            store.add(i, float(t), b"")
+
+    threads = [threading.Thread(target=write, args=(i % 2,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert store.stats() == {0: (10, 2000, 1990), 1: (10, 2000, 1990)}
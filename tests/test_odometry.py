@@ -0,0 +1,82 @@
+import math
+
+import numpy as np
+
+from devices.odometry import Odometry, dead_reckoning
+
+ORIGIN = (52.0, 21.0)
+
+
+def drive(odometry, seconds, scale=1.0, speed=1.0, turn_rate=0.0, rate=100, gps_every=20, gps_noise=1.0,
+          seed=0):
+    """ Drive with wheel distances off by scale and noisy GPS. Returns the
+    position errors [m] after each step. """
+    rng = np.random.default_rng(seed)
+    x = y = heading = t = 0.0
+    errors = []
+    for k in range(int(seconds * rate)):
+        t += 1.0 / rate
+        heading = (heading + turn_rate / rate) % (2 * math.pi)
+        d = speed / rate
+        x += math.sin(heading) * d
+        y += math.cos(heading) * d
+        odometry.predict(d * scale, t)
+        if k % 10 == 0:
+            odometry.update_heading(heading + rng.normal(0, 0.03), t)
+        if gps_every and k % gps_every == 0:
+            fix = (x + rng.normal(0, gps_noise), y + rng.normal(0, gps_noise))
+            odometry.update_gps(odometry.to_coordinates(*fix), t)
+        errors.append(math.hypot(odometry.pose[0] - x, odometry.pose[1] - y))
+    return np.array(errors)
+
+
+def test_converges_to_gps_with_biased_odometry():
+    odometry = Odometry(ORIGIN)
+    odometry.set_position(0, 0, 0)
+    errors = drive(odometry, 300, scale=1.1)
+    # Better than the raw fixes (1.4 m rms) over the last minutes
+    assert np.sqrt(np.mean(errors[-12000:] ** 2)) < 1.0
+    assert odometry.covariance[0, 0] > 1e-3
+
+
+def test_tracks_gps_while_turning():
+    odometry = Odometry(ORIGIN)
+    odometry.set_position(0, 0, 0)
+    errors = drive(odometry, 120, scale=0.9, turn_rate=0.2)
+    assert np.sqrt(np.mean(errors[-6000:] ** 2)) < 1.0
+
+
+def test_gps_corrects_a_wrong_set_position():
+    odometry = Odometry(ORIGIN)
+    odometry.set_position(50, -30, 0)
+    errors = drive(odometry, 60, speed=0.0)
+    assert errors[-1] < 1.0
+
+
+def test_located_after_first_fix():
+    odometry = Odometry(ORIGIN)
+    assert not odometry.located
+    odometry.update_gps(ORIGIN, 0.0)
+    assert odometry.located
+    lat, lon = odometry.coordinates()
+    assert abs(lat - ORIGIN[0]) < 1e-5 and abs(lon - ORIGIN[1]) < 1e-5
+
+
+def test_pose_history_and_interpolation():
+    odometry = Odometry(ORIGIN, history=10)
+    odometry.set_position(0, 0, 0)
+    for t in range(1, 21):
+        odometry.predict(1.0, float(t))
+    poses = odometry.poses()
+    assert len(poses) == 10
+    assert np.all(np.diff(poses[:, 0]) > 0)
+    assert len(odometry.poses(since=18.0)) == 2
+    x, y, heading = odometry.pose_at(15.5)
+    assert abs(y - 15.5) < 1e-9 and abs(x) < 1e-9
+
+
+def test_dead_reckoning_square():
+    tacho = [0, 1, 2, 3, 4]
+    heading = [0, math.pi / 2, math.pi, 3 * math.pi / 2, 0]
+    positions = dead_reckoning(tacho, heading)
+    assert np.allclose(positions[-1], (0, 0), atol=1e-12)
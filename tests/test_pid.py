@@ -0,0 +1,39 @@
+import numpy as np
+
+from benchmarks.pid_bench import LegacyPID
+from devices.pid import PID, MultiPID, HISTORY
+
+
+def errors(n, seed=0):
+    return np.random.default_rng(seed).normal(0, 100, n)
+
+
+def test_pid_matches_legacy_implementation():
+    params = [0.004, 10, 0.02]
+    pid, legacy = PID(params), LegacyPID(params)
+    for error in errors(5 * HISTORY + 7):
+        assert abs(pid.step(0.01, error) - legacy.step(0.01, error)) < 1e-12
+
+
+def test_pid_output_is_limited():
+    pid = PID([1.0, 0, 0], limit=0.35)
+    assert pid.step(0.01, 1000) == 0.35
+    assert pid.step(0.01, -1000) == -0.35
+
+
+def test_anti_windup_bounds_integral():
+    pid = PID([0.001, 10, 0], limit=0.35, anti_windup=True)
+    for _ in range(3 * HISTORY):
+        pid.step(0.01, 1e6)
+    assert abs(pid.integral) <= 0.35 / (0.001 * 10) + 1e-9
+
+
+def test_multipid_matches_independent_pids():
+    params = [[0.004, 0.002, 0.01], 10, [0, 0.01, 0.02]]
+    multi = MultiPID(3, params)
+    single = [PID([params[0][i], params[1], params[2][i]]) for i in range(3)]
+    values = errors(3 * 2 * HISTORY).reshape(-1, 3)
+    for row in values:
+        outputs = multi.step(0.01, row)
+        expected = [pid.step(0.01, e) for pid, e in zip(single, row)]
+        assert np.allclose(outputs, expected, rtol=0, atol=1e-12)
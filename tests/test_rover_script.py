@@ -0,0 +1,87 @@
+import math
+import threading
+from time import perf_counter as clock
+
+import pytest
+
+from devices import rover_script
+from devices.rover_script import (APPLY_INDEX, IK, POWER, STOP, WAIT, ScriptError, ScriptStore,
+                                  compile_script, run)
+
+
+class Target:
+    def __init__(self):
+        self.start = clock()
+        self.calls = []
+
+    def power(self, motor, power):
+        self.calls.append((clock() - self.start, "power", motor, power))
+
+    def ik(self, axes):
+        self.calls.append((clock() - self.start, "ik", axes))
+
+    def apply_index(self):
+        self.calls.append((clock() - self.start, "apply_index"))
+
+
+def test_compile_resolves_names_and_converts_units():
+    program = compile_script("clamp 193\n0.5 clamp -1 x 90 45 180 0\n1 clamp 0 apply_index\n")
+    assert program.instructions[:2] == ((POWER, (193, -1.0)),
+                                        (IK, (math.pi / 2, math.pi / 4, math.pi, 0.0)))
+    assert program.instructions[2:] == ((WAIT, 0.5), (STOP, 193), (APPLY_INDEX, None), (WAIT, 1.5))
+    assert program.duration == 1.5
+
+
+def test_compile_is_cached_by_content():
+    code = "1 193 0.5\n"
+    assert compile_script(code) is compile_script(code)
+    assert compile_script(code).digest == rover_script.script_digest(code)
+
+
+@pytest.mark.parametrize("code, line", [
+    ("1 foo 0.5", 1),
+    ("low 190\n1 low", 2),
+    ("1 x 1 2 3", 1),
+    ("\n\n2 a -600 0 0 0", 3),
+])
+def test_compile_errors_give_the_line(code, line):
+    with pytest.raises(ScriptError) as error:
+        compile_script(code)
+    assert error.value.line == line
+
+
+def test_run_meets_deadlines_and_emits_at_rate():
+    target = Target()
+    late = run(compile_script("0.2 193 0.5\n0.1 193 0\n"), target, threading.Event(), rate=20)
+    assert late < 0.005
+    emitted = [t for t, kind, *args in target.calls if args == [193, 0.5]]
+    assert len(emitted) == 4
+    assert all(abs(t - 0.05 * i) < 0.01 for i, t in enumerate(emitted))
+    stop = [t for t, kind, *args in target.calls if args == [193, 0]]
+    assert len(stop) == 1 and abs(stop[0] - 0.2) < 0.005
+    assert clock() - target.start >= 0.3
+
+
+def test_run_aborts_promptly():
+    target = Target()
+    abort = threading.Event()
+    threading.Timer(0.05, abort.set).start()
+    start = clock()
+    assert run(compile_script("5 193 1"), target, abort) is None
+    assert clock() - start < 0.1
+
+
+def test_store_shares_programs_and_rejects_bad_scripts():
+    store = ScriptStore()
+    digest = store.put("a", "1 193 0.5")
+    assert store.put("b", "1 193 0.5") == digest
+    assert len(store.programs) == 1
+    store.put("a", "2 193 0.5")
+    store.remove("b")
+    assert store.manifest() == {"a": rover_script.script_digest("2 193 0.5")}
+    assert len(store.programs) == 1
+    with pytest.raises(ScriptError):
+        store.put("a", "1 nope 1")
+    assert store.manifest() == {}
+    with pytest.raises(KeyError):
+        store.get("a")